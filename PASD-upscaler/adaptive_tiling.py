@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Memory-aware tile sizes and an out-of-memory fallback ladder for PASD pipeline calls
+plan_tiles fills in --latent_tiled_size / --encoder_tiled_size / --decoder_tiled_size left
+at auto (None) from the free accelerator memory (host memory on the CPU) and the image
+size, scaled from the former fixed defaults that fit a 24 GB GPU, so they depend on the
+machine and its load: pin all three for reproducible outputs. call_with_fallback retries
+an image that runs out of memory with halved, quartered and finally the smallest auto
+tiles, the last time with model CPU offload, and reports the level that succeeded. Tile
+sizes set explicitly are never changed.
+"""
+import gc
+import math
+import argparse
+
+import torch
+
+TILE_OPTIONS = ("latent_tiled_size", "encoder_tiled_size", "decoder_tiled_size")
+# The former test_pasd.py defaults, for a 24 GB GPU with the fp16 models loaded (~20 GB free).
+# Encoder tiles are in pixels, decoder and UNet tiles in latent pixels (1/8).
+REFERENCE_TILES = {"latent_tiled_size": 320, "encoder_tiled_size": 1024, "decoder_tiled_size": 224}
+REFERENCE_FREE_MB = 20 * 1024
+MIN_TILES = {"latent_tiled_size": 64, "encoder_tiled_size": 256, "decoder_tiled_size": 64}
+FALLBACK_LEVELS = (
+    # (level, tile divisor, model CPU offload)
+    (0, 1, False),
+    (1, 2, False),
+    (2, 4, False),
+    (3, None, True),  # smallest tiles
+)
+
+
+def free_memory_mb(device):
+    """Free memory of the CUDA device, or MemAvailable of the host (None if unknown)"""
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return free / 2**20
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def run_device(args):
+    return "cuda" if getattr(args, "device", "auto") != "cpu" and torch.cuda.is_available() else "cpu"
+
+
+def plan_tiles(args, image_size, batch_size=1):
+    """Tile sizes for one pipeline call on images of image_size (width, height)
+
+    Options set on the command line are kept; the others follow the free memory:
+    activation memory grows with tile area, batch size and bytes per value.
+    """
+    free_mb = free_memory_mb(run_device(args))
+    budget = 1.0 if free_mb is None else free_mb / REFERENCE_FREE_MB
+    budget /= batch_size * (2 if args.mixed_precision == "no" else 1)
+    longest = max(image_size)
+    # No point in tiles larger than the image
+    caps = {"latent_tiled_size": longest // 8, "encoder_tiled_size": longest, "decoder_tiled_size": longest // 8}
+    tiles = {}
+    for name in TILE_OPTIONS:
+        if getattr(args, name, None):
+            tiles[name] = getattr(args, name)
+            continue
+        size = int(REFERENCE_TILES[name] * math.sqrt(budget)) // 8 * 8
+        tiles[name] = max(MIN_TILES[name], min(size, caps[name] // 8 * 8))
+    return tiles
+
+
+def apply_tiles(args, pipeline, tiles):
+    """Call arguments with these tile sizes; re-initialises the tiled VAE if they changed"""
+    vae_tiles = (tiles["encoder_tiled_size"], tiles["decoder_tiled_size"])
+    # The ONNX VAE (--onnx_dir) is not tiled
+    if not getattr(args, "onnx_dir", None) and getattr(pipeline, "vae_tiles", None) != vae_tiles:
+        pipeline._init_tiled_vae(encoder_tile_size=vae_tiles[0], decoder_tile_size=vae_tiles[1])
+        pipeline.vae_tiles = vae_tiles
+    return argparse.Namespace(**{**vars(args), **tiles})
+
+
+def is_out_of_memory(error):
+    if isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    message = str(error).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def without_traceback(error):
+    """error (and the exceptions chained to it) without tracebacks. A traceback references
+    the frames of the failed call and with them its activations, which would stay allocated."""
+    chained = error
+    while chained is not None:
+        chained.__traceback__ = None
+        chained = chained.__cause__ or chained.__context__
+    return error
+
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def enable_offload(pipeline):
+    """Model CPU offload (CUDA only, stays on for the rest of the run); False if unavailable"""
+    if getattr(pipeline, "cpu_offload", False):
+        return True
+    if not torch.cuda.is_available() or not hasattr(pipeline, "enable_model_cpu_offload"):
+        return False
+    try:
+        pipeline.enable_model_cpu_offload()
+    except Exception as e:
+        print(f"Warning: model CPU offload failed: {e}")
+        return False
+    pipeline.cpu_offload = True
+    return True
+
+
+def call_with_fallback(args, pipeline, image_size, call):
+    """call(call_args) with planned tiles, retried down the fallback ladder on out-of-memory
+
+    Only auto tile sizes shrink; explicit ones are kept at every level, so with all three
+    set the ladder only adds offload. Returns (result, record); record has the fallback
+    level that succeeded, its tiles and whether offload was on. Other errors and the last
+    out-of-memory error are raised.
+    """
+    planned = plan_tiles(args, image_size)
+    explicit = {name for name in TILE_OPTIONS if getattr(args, name, None)}
+    error = None
+    previous = None
+    for level, divisor, offload in FALLBACK_LEVELS:
+        if divisor is None:
+            tiles = {name: planned[name] if name in explicit else MIN_TILES[name] for name in TILE_OPTIONS}
+        else:
+            tiles = {name: size if name in explicit else max(MIN_TILES[name], size // divisor // 8 * 8)
+                     for name, size in planned.items()}
+        if tiles == previous and not offload:
+            continue  # already at the smallest (or explicit) tiles
+        if offload and not enable_offload(pipeline):
+            break
+        previous = tiles
+        try:
+            result = call(apply_tiles(args, pipeline, tiles))
+        except Exception as e:
+            if not is_out_of_memory(e):
+                raise
+            error = without_traceback(e)
+        else:
+            if level > 0:
+                print(f"[OK] Succeeded at fallback level {level} (tiles {tiles}{', offload' if offload else ''})")
+            return result, {"fallback_level": level, "tiles": tiles, "offload": offload}
+        # Out of the except block: the failed call's frames are gone, so its memory can be freed
+        print(f"Out of memory at fallback level {level} (tiles {tiles}{', offload' if offload else ''}), retrying smaller")
+        release_memory()
+    raise error
@@ -11,20 +11,68 @@ from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import subprocess
 import glob
+import json
+import argparse
+
+from pasd_worker import PASDWorkerClient
+from output_cache import OutputCache
+from memory_monitor import merge_peaks
+import perf_profile
 
 class PASDBatchProcessor:
-    def __init__(self):
+    def __init__(self, worker_address=None, cache_size_gb=20):
         self.scales = [2, 4, 8]
         self.base_dir = Path(".")
         self.results_dir = self.base_dir / "PASD-results"
         self.examples_dir = self.base_dir / "examples"
         
+        # Resident worker (pasd_worker.py) keeps the models loaded between jobs
+        self.worker = PASDWorkerClient(worker_address) if worker_address else None
+        
+        # Settings passed to test_pasd.py (same as test_single.py); hashed into the output cache key.
+        # model_params are fixed when a resident worker starts; job_params travel per job.
+        self.model_params = {
+            "pretrained_model_path": "checkpoints/stable-diffusion-v1-5",
+            "pasd_model_path": "runs/pasd/pasd/checkpoint-100000",
+            "high_level_info": "classification",
+            "mixed_precision": "fp16",
+        }
+        self.job_params = {
+            "guidance_scale": 7.0,
+            "conditioning_scale": 1.0,
+            "num_inference_steps": 20,
+            "process_size": 512,
+            "prompt": "",
+            "added_prompt": "",
+            "negative_prompt": "",
+            # Explicit tile sizes: auto ones follow the free memory, and so would the outputs
+            "latent_tiled_size": 320,
+            "latent_tiled_overlap": 32,
+            "encoder_tiled_size": 1024,
+            "decoder_tiled_size": 224,
+            "added_noise_level": 0,
+            "seed": None,
+        }
+        # Fastest safe tile sizes of this machine, if calibrated (quick_test.py --calibrate)
+        perf_profile.update_params(self.job_params, perf_profile.load_profile(), self.model_params["mixed_precision"])
+        if self.worker is not None:
+            # A worker runs with the model settings it was started with: key results by those
+            try:
+                self.model_params = self.worker.config()
+            except (ConnectionError, OSError, EOFError) as e:
+                raise SystemExit(f"[ERROR] No PASD worker at {worker_address}: {e}")
+        self.last_config = None
+        self.cache = OutputCache(self.results_dir / ".cache", max_bytes=int(cache_size_gb * 1024**3))
+        # Prompts of each image are generated once and shared by its 2x/4x/8x jobs and reruns
+        self.caption_cache_path = self.results_dir / ".cache" / "captions.sqlite"
+        
         # Processing stats
         self.stats = {
             "total_images": 0,
             "processed": 0,
             "failed": 0,
-            "start_time": time.time()
+            "start_time": time.time(),
+            "peak_memory": {}  # stage -> highest peak RSS / GPU MB of any job
         }
     
     def setup_directories(self):
@@ -71,40 +119,79 @@ class PASDBatchProcessor:
             shutil.copy2(image_path, dest_path)
             print(f"Backed up: {image_path.name}")
     
+    def cache_key(self, image_path, scale):
+        params = {**self.model_params, **self.job_params, "upscale": scale, "scheduler": "UniPCMultistepScheduler"}
+        return self.cache.make_key(image_path, params), params
+
     def upscale_image(self, image_path, scale):
-        """Upscale single image using PASD"""
+        """Upscale single image using PASD, reusing a cached result when nothing changed"""
         set_name = self.get_image_set_name(image_path)
         output_dir = self.results_dir / f"{scale}x_upscaled" / set_name
         output_path = output_dir / f"{image_path.stem}_{scale}x.png"
         
-        if output_path.exists():
-            print(f"Skipping {image_path.name} {scale}x (already exists)")
+        cache_key, key_params = self.cache_key(image_path, scale)
+        if self.cache.restore(cache_key, output_path):
+            print(f"Skipping {image_path.name} {scale}x (cached)")
             return str(output_path)
         
+        result_path = self.run_upscale(image_path, output_dir, output_path, scale)
+        if result_path and self.worker is not None and self.last_config != self.model_params:
+            # The worker was restarted with other settings: key by the ones that produced it
+            self.model_params = self.last_config
+            cache_key, key_params = self.cache_key(image_path, scale)
+        if result_path:
+            self.cache.put(cache_key, result_path, key_params)
+        return result_path
+    
+    def run_upscale(self, image_path, output_dir, output_path, scale):
+        """Run PASD for one job, through the resident worker if there is one"""
         print(f"Processing {image_path.name} -> {scale}x upscale...")
+
+        if self.worker is not None:
+            try:
+                job_params = {k: v for k, v in self.job_params.items() if v is not None}
+                reply = self.worker.upscale_job(image_path, output_dir, output_path.name, upscale=scale, **job_params)
+                self.last_config = reply["config"]
+                merge_peaks(self.stats["peak_memory"], reply.get("memory", {}))
+                print(f"✅ Successfully upscaled {image_path.name} to {scale}x")
+                return reply["output_path"]
+            except Exception as e:
+                print(f"❌ Worker error processing {image_path.name}: {e}")
+                return None
+
+        # test_pasd.py writes straight to output_path and reports it in a per-job manifest
+        manifest_path = self.results_dir / ".manifests" / f"{output_dir.parent.name}_{output_dir.name}_{output_path.stem}.json"
+        manifest_path.unlink(missing_ok=True)
         
         # PASD command with optimal settings (using correct model path)
         cmd = [
-            "python", "test_single.py"
+            "python", "test_pasd.py",
+            "--image_path", str(image_path),
+            "--output_dir", str(output_dir),
+            "--output_name", output_path.name,
+            "--result_manifest", str(manifest_path),
+            "--upscale", str(scale),
+            "--caption_cache", str(self.caption_cache_path),
         ]
-        
-        # Modify the test_single.py arguments for this specific image and scale
-        self.create_custom_test_script(image_path, output_dir, scale)
+        for name, value in {**self.model_params, **self.job_params}.items():
+            if value is not None:
+                cmd += [f"--{name}", str(value)]
         
         try:
             result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
             
             if result.returncode == 0:
-                # Find the generated file
-                generated_files = list(output_dir.glob(f"*{image_path.stem}*"))
-                if generated_files:
-                    # Rename to standardized format
-                    actual_output = generated_files[0]
-                    if actual_output != output_path:
-                        actual_output.rename(output_path)
-                    
+                manifest = {"results": []}
+                if manifest_path.exists():
+                    with open(manifest_path) as f:
+                        manifest = json.load(f)
+                results = manifest["results"]
+                if results and os.path.exists(results[0]["output_path"]):
+                    merge_peaks(self.stats["peak_memory"], manifest.get("memory_peaks", {}))
+                    if manifest.get("peak_rss_mb") is not None:
+                        merge_peaks(self.stats["peak_memory"], {"process": {"peak_rss_mb": manifest["peak_rss_mb"], "peak_cuda_mb": manifest.get("peak_cuda_mb")}})
                     print(f"✅ Successfully upscaled {image_path.name} to {scale}x")
-                    return str(output_path)
+                    return results[0]["output_path"]
                 else:
                     print(f"❌ No output file found for {image_path.name}")
                     return None
@@ -213,6 +300,11 @@ class PASDBatchProcessor:
         """Generate HTML report with all results"""
         print("\\n📊 Generating processing report...")
         
+        memory_rows = ""
+        for stage, peak in sorted(self.stats["peak_memory"].items()):
+            gpu = "n/a" if peak["peak_cuda_mb"] is None else f"{peak['peak_cuda_mb']:.0f} MB"
+            memory_rows += f"<tr><td>{stage}</td><td>{peak['peak_rss_mb'] or 0:.0f} MB</td><td>{gpu}</td></tr>"
+        
         report_html = f"""
         <!DOCTYPE html>
         <html>
@@ -253,6 +345,11 @@ class PASDBatchProcessor:
                 </div>
             </div>
             
+            <h2>🧠 Memory High-Water Marks</h2>
+            <table border="1" cellpadding="6">
+                <tr><th>Stage</th><th>Peak RSS</th><th>Peak GPU</th></tr>{memory_rows}
+            </table>
+            
             <h2>📁 Directory Structure</h2>
             <pre>
 PASD-results/
@@ -302,7 +399,12 @@ PASD-results/
         print(f"Check processing_report.html for summary")
 
 def main():
-    processor = PASDBatchProcessor()
+    parser = argparse.ArgumentParser(description="PASD batch processing")
+    parser.add_argument("--worker", type=str, default=None, help="host:port of a running pasd_worker.py")
+    parser.add_argument("--cache_size_gb", type=float, default=20, help="size limit of the output cache in PASD-results/.cache")
+    args = parser.parse_args()
+
+    processor = PASDBatchProcessor(worker_address=args.worker, cache_size_gb=args.cache_size_gb)
     processor.run(start_with_set5=True)
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+CPU benchmark and self-check of latent_tiler.TilePlan
+Times split + blend against a per-tile slicing loop (the way pipelines usually merge
+tiles) for several latent sizes and both windows, and for a range of overlaps reports the
+tile count and a seam score: every tile gets its own constant offset (tiles that disagree
+after denoising) and the score is the mean absolute gradient the blend leaves behind.
+--check verifies the planning and blending invariants and exits 1 on a failure.
+
+Usage (from PASD-upscaler/):
+    python benchmarks/bench_latent_tiler.py --check
+    python benchmarks/bench_latent_tiler.py --sizes 128,256,512 --tile_size 96 --overlaps 4,8,16,32
+"""
+import os
+import sys
+import time
+import argparse
+import itertools
+
+import torch
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from latent_tiler import WINDOWS, TilePlan
+
+
+def blend_loop(plan, tiles):
+    """Reference merge: one slice-add per tile (the weights are normalised per pixel)"""
+    weights = plan.state(tiles.device)[1]
+    batch, channels = tiles.shape[1:3]
+    out = torch.zeros(batch, channels, plan.height, plan.width, dtype=tiles.dtype)
+    for i, (top, left) in enumerate(plan.tiles):
+        weight = weights[i].view(plan.tile_height, plan.tile_width).to(tiles.dtype)
+        out[:, :, top:top + plan.tile_height, left:left + plan.tile_width] += tiles[i] * weight
+    return out
+
+
+def split_loop(plan, latents):
+    return torch.stack([latents[:, :, top:top + plan.tile_height, left:left + plan.tile_width] for top, left in plan.tiles])
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def seam_score(plan, latents, generator):
+    """Mean absolute gradient left by tiles that are each off by a random constant"""
+    tiles = plan.split(latents)
+    offsets = torch.randn(len(plan), 1, 1, 1, 1, generator=generator, dtype=latents.dtype)
+    error = plan.blend(tiles + offsets) - latents
+    return float((error[..., 1:, :] - error[..., :-1, :]).abs().mean() + (error[..., 1:] - error[..., :-1]).abs().mean()) / 2
+
+
+# Tolerance of blend(split(x)) == x in half precision for |x| < ~5 (one rounding of the result)
+HALF_TOLERANCES = {torch.float16: 0.01, torch.bfloat16: 0.05}
+
+
+def check():
+    """Invariants over a grid of shapes, tile sizes, overlaps and windows; returns failures"""
+    failures = []
+    generator = torch.Generator().manual_seed(0)
+    shapes = [(1, 4, 64, 64), (2, 4, 100, 37), (1, 4, 257, 129), (1, 1, 8, 8)]
+    for shape, tile_size, overlap, window in itertools.product(shapes, (16, 40, 96), (0, 4, 12), WINDOWS):
+        height, width = shape[2:]
+        name = f"{window} {height}x{width} tile {tile_size} overlap {overlap}"
+        plan = TilePlan(height, width, tile_size, overlap, window)
+        for axis, starts, length, tile in (("rows", plan.tops, height, plan.tile_height), ("cols", plan.lefts, width, plan.tile_width)):
+            if starts[0] != 0 or starts[-1] + tile != length:
+                failures.append(f"{name}: {axis} do not cover the latent exactly")
+            gaps = [b - a for a, b in zip(starts, starts[1:])]
+            if any(tile - gap < overlap for gap in gaps):
+                failures.append(f"{name}: neighbouring {axis} overlap by less than {overlap}")
+        if float(plan.state("cpu")[2].min()) <= 0:
+            failures.append(f"{name}: some latent pixels have no weight")
+
+        latents = torch.randn(*shape, generator=generator, dtype=torch.float64)
+        tiles = plan.split(latents)
+        if not torch.equal(tiles, split_loop(plan, latents)):
+            failures.append(f"{name}: split differs from slicing")
+        if not torch.allclose(plan.blend(tiles), latents, atol=1e-10):
+            failures.append(f"{name}: blend(split(x)) != x")
+        if not torch.allclose(plan.blend(tiles * 2), blend_loop(plan, tiles * 2), atol=1e-10):
+            failures.append(f"{name}: blend differs from the per-tile loop")
+        if not torch.allclose(plan.apply(lambda x: x * 3, latents, tiles_per_call=3), latents * 3, atol=1e-10):
+            failures.append(f"{name}: apply(fn) != fn on the whole latent")
+        for dtype, atol in HALF_TOLERANCES.items():
+            half = latents.to(dtype)
+            blended = plan.blend(plan.split(half))
+            if not torch.isfinite(blended).all():
+                failures.append(f"{name}: {dtype} blend is not finite")
+            elif not torch.allclose(blended.double(), half.double(), atol=atol):
+                failures.append(f"{name}: {dtype} blend(split(x)) != x")
+    try:
+        TilePlan(100, 100, 32, 32)
+        failures.append("overlap >= tile size was accepted")
+    except ValueError:
+        pass
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmark and self-check of the latent tiler")
+    parser.add_argument("--check", action="store_true", help="verify the tiler invariants; exit 1 on a failure")
+    parser.add_argument("--sizes", type=str, default="128,256,512", help="comma-separated latent sides")
+    parser.add_argument("--tile_size", type=int, default=96, help="latent tile side")
+    parser.add_argument("--overlap", type=int, default=8, help="overlap of the timing runs")
+    parser.add_argument("--overlaps", type=str, default="4,8,16,32", help="overlaps of the tile count / seam sweep")
+    parser.add_argument("--channels", type=int, default=4, help="latent channels")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions (best is reported)")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads for reproducible numbers")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.check:
+        failures = check()
+        if failures:
+            for failure in failures:
+                print(f"[FAIL] {failure}")
+            sys.exit(1)
+        print("[OK] Tile plans, split and blend are consistent")
+
+    generator = torch.Generator().manual_seed(0)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    print(f"\nsplit + blend, tile {args.tile_size}, overlap {args.overlap} (best of {args.repeat}):")
+    print(f"{'latent':>9} {'window':>9} {'tiles':>6} {'vectorised ms':>14} {'loop ms':>9}")
+    for size, window in itertools.product(sizes, WINDOWS):
+        plan = TilePlan(size, size, args.tile_size, args.overlap, window)
+        latents = torch.randn(1, args.channels, size, size, generator=generator)
+        plan.state(latents.device)  # planning is cached per plan
+        vectorised = best_time(lambda: plan.blend(plan.split(latents)), args.repeat)
+        loop = best_time(lambda: blend_loop(plan, split_loop(plan, latents)), args.repeat)
+        print(f"{size:>9} {window:>9} {len(plan):>6} {vectorised * 1000:>14.2f} {loop * 1000:>9.2f}")
+
+    size = sizes[-1]
+    latents = torch.randn(1, args.channels, size, size, generator=generator)
+    print(f"\nOverlap trade-off on a {size}x{size} latent, tile {args.tile_size} (seam: lower is smoother):")
+    print(f"{'overlap':>8} {'tiles':>6} " + " ".join(f"{window + ' seam':>14}" for window in WINDOWS))
+    for overlap in [int(overlap) for overlap in args.overlaps.split(",")]:
+        plans = [TilePlan(size, size, args.tile_size, overlap, window) for window in WINDOWS]
+        scores = [seam_score(plan, latents, torch.Generator().manual_seed(1)) for plan in plans]
+        print(f"{overlap:>8} {len(plans[0]):>6} " + " ".join(f"{score:>14.5f}" for score in scores))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Orchestration overhead benchmark for full_batch_process.PASDBatchProcessor
+Runs complete batch runs (globbing, ledger, cache, job dispatch, comparisons, report) on
+synthetic images with the stub pipeline from stub_inference.py, CPU only, and reports
+jobs/s, per-job overhead and how both scale with the number of images. Results can be
+saved as a JSON baseline and later runs compared against it.
+
+Usage (from PASD-upscaler/):
+    python benchmarks/bench_orchestration.py --sizes 10,100,1000 --modes subprocess,worker
+    python benchmarks/bench_orchestration.py --save_baseline
+    python benchmarks/bench_orchestration.py --compare
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from pathlib import Path
+from PIL import Image
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from full_batch_process import PASDBatchProcessor
+from pasd_worker import PASDWorkerClient
+
+STUB = BENCH_DIR / "stub_inference.py"
+DEFAULT_BASELINE = BENCH_DIR / "baselines" / "orchestration.json"
+
+
+def make_images(examples_dir, count, size):
+    """count distinct size x size PNGs (distinct pixels, so the output cache never hits)"""
+    set_dir = examples_dir / "Set14"
+    set_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        image = Image.new("RGB", (size, size), color=(i % 256, (i // 256) % 256, (i // 65536) % 256))
+        image.putpixel((0, 0), (255 - i % 256, 0, 0))
+        image.save(set_dir / f"img_{i:06d}.png")
+
+
+def start_stub_worker(address, sleep):
+    process = subprocess.Popen([sys.executable, str(STUB), "--serve", address, "--sleep", str(sleep)])
+    client = PASDWorkerClient(address)
+    deadline = time.time() + 60
+    while not client.ping():
+        if process.poll() is not None or time.time() > deadline:
+            process.kill()
+            raise RuntimeError("stub worker did not start")
+        time.sleep(0.1)
+    return process, client
+
+
+def run_once(mode, images, sleep, image_size, port, verbose=False):
+    """One full batch run in a scratch directory; returns the measurements"""
+    workdir = Path(tempfile.mkdtemp(prefix="pasd_bench_"))
+    cwd = os.getcwd()
+    worker = None
+    try:
+        os.chdir(workdir)
+        setup_start = time.perf_counter()
+        make_images(workdir / "examples", images, image_size)
+        setup_time = time.perf_counter() - setup_start
+
+        address = None
+        if mode == "worker":
+            address = f"127.0.0.1:{port}"
+            worker, _ = start_stub_worker(address, sleep)
+
+        processor = PASDBatchProcessor(worker_address=address, retry_backoff=0.0)
+        processor.inference_cmd = [sys.executable, str(STUB), "--sleep", str(sleep)]
+
+        out = sys.stdout if verbose else open(os.devnull, "w")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            processor.run()
+        wall = time.perf_counter() - start
+        if not verbose:
+            out.close()
+
+        summary = processor.ledger.summary()
+        jobs = summary["done"]
+        job_wall = sum(processor.stats["processing_times"])
+        return {
+            "mode": mode,
+            "images": images,
+            "jobs": jobs,
+            "failed": summary["failed"],
+            "sleep_s": sleep,
+            "wall_s": wall,
+            "jobs_per_s": jobs / wall if wall else 0.0,
+            # everything a job costs beyond the fake denoising
+            "per_job_overhead_ms": (wall - jobs * sleep) / jobs * 1000 if jobs else None,
+            # dispatch cost per job (spawn/imports or socket round trip, manifest, cache)
+            "job_dispatch_ms": (job_wall - jobs * sleep) / jobs * 1000 if jobs else None,
+            # globbing, ledger registration, comparisons and report outside the jobs
+            "orchestration_s": wall - job_wall,
+            "setup_s": setup_time,
+        }
+    finally:
+        if worker is not None:
+            with contextlib.suppress(Exception):
+                PASDWorkerClient(f"127.0.0.1:{port}").shutdown()
+            worker.wait(timeout=10)
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    """Names of the runs whose jobs/s fell more than tolerance below the baseline"""
+    reference = {(r["mode"], r["images"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = reference.get((result["mode"], result["images"]))
+        if base is None:
+            continue
+        change = result["jobs_per_s"] / base["jobs_per_s"] - 1 if base["jobs_per_s"] else 0.0
+        flag = "REGRESSION" if change < -tolerance else "ok"
+        print(f"  {result['mode']:>10} {result['images']:>7} images: {result['jobs_per_s']:8.1f} jobs/s "
+              f"vs {base['jobs_per_s']:8.1f} ({change * 100:+.1f}%) {flag}")
+        if change < -tolerance:
+            regressions.append(f"{result['mode']}/{result['images']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PASDBatchProcessor orchestration overhead with a stub pipeline")
+    parser.add_argument("--sizes", type=str, default="10,100,1000", help="comma-separated image counts (up to 100000)")
+    parser.add_argument("--modes", type=str, default="subprocess,worker", help="subprocess (one process per job) and/or worker (resident stub worker)")
+    parser.add_argument("--sleep", type=float, default=0.0, help="fake denoising seconds per job")
+    parser.add_argument("--image_size", type=int, default=32, help="side of the synthetic input images")
+    parser.add_argument("--max_subprocess_images", type=int, default=1000, help="skip larger subprocess runs (one interpreter start per job)")
+    parser.add_argument("--port", type=int, default=7990, help="port of the stub worker")
+    parser.add_argument("--output", type=str, default=None, help="write this run's results to a JSON file")
+    parser.add_argument("--baseline", type=str, default=str(DEFAULT_BASELINE), help="baseline JSON file")
+    parser.add_argument("--save_baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare against the baseline; exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed jobs/s drop before a run counts as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the batch processor output")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for mode in args.modes.split(","):
+        for images in sizes:
+            if mode == "subprocess" and images > args.max_subprocess_images:
+                print(f"Skipping {mode} with {images} images (> --max_subprocess_images)")
+                continue
+            result = run_once(mode, images, args.sleep, args.image_size, args.port, args.verbose)
+            results.append(result)
+            print(f"{mode:>10} {images:>7} images: {result['jobs']} jobs in {result['wall_s']:.1f}s, "
+                  f"{result['jobs_per_s']:.1f} jobs/s, overhead {result['per_job_overhead_ms']:.1f} ms/job "
+                  f"(dispatch {result['job_dispatch_ms']:.1f} ms), orchestration {result['orchestration_s']:.1f}s")
+
+    report = {
+        "benchmark": "orchestration",
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "sleep_s": args.sleep,
+        "image_size": args.image_size,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"[ERROR] No baseline at {args.baseline}; run with --save_baseline first")
+            sys.exit(1)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with baseline from {baseline['created']} ({baseline['platform']}):")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"[FAIL] Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+        print("[OK] No regressions")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[OK] Baseline saved: {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+CPU benchmark and self-check of tile-parallel denoising (test_pasd.py --tile_workers)
+Runs test_pasd.main on the tiny random-weight checkpoints of bench_tiny_pasd with the
+pipeline's own latent tiling and with every --workers set (local = in-process, cpu = a
+worker process), and reports latency per image and per denoising step. Every worker set
+runs the same tiles with the same blend, so the outputs must match the single "local"
+worker; --check compares them and exits 1 if any pixel differs by more than --max_diff.
+The pipeline tiles on another grid, so against its outputs --check bounds the mean
+difference of 8x8 blocks instead (--pipeline_max_diff): a NaN tile or black corner fails it.
+--mixed_precision fp16/bf16 runs everything in half precision (the blend path that used
+to produce NaNs).
+
+Usage (from PASD-upscaler/):
+    python benchmarks/bench_tile_parallel.py --check
+    python benchmarks/bench_tile_parallel.py --check --mixed_precision fp16
+    python benchmarks/bench_tile_parallel.py --workers local local,cpu cpu,cpu local,cpu,cpu,cpu --cpu_threads 2
+"""
+import os
+import sys
+import glob
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from tiny_pasd import build_tiny_pasd
+from bench_tiny_pasd import bench_inference
+
+
+def load_outputs(folder):
+    return {os.path.basename(path): np.asarray(Image.open(path).convert("RGB"), dtype=np.int16)
+            for path in sorted(glob.glob(os.path.join(folder, "*.png")))}
+
+
+def max_difference(outputs, reference):
+    """Largest pixel difference to the reference outputs (None if the images differ)"""
+    if not reference or outputs.keys() != reference.keys():
+        return None
+    return max(int(np.abs(outputs[name] - reference[name]).max()) for name in reference)
+
+
+def block_difference(outputs, reference, block=8):
+    """Largest mean difference of a block x block region to the reference outputs (None if the images differ)"""
+    if not reference or outputs.keys() != reference.keys():
+        return None
+    worst = 0.0
+    for name in reference:
+        diff = np.abs(outputs[name] - reference[name]).astype(np.float64).mean(axis=2)
+        height, width = diff.shape[0] // block * block, diff.shape[1] // block * block
+        blocks = diff[:height, :width].reshape(height // block, block, width // block, block).mean(axis=(1, 3))
+        worst = max(worst, float(blocks.max()))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmark of tile-parallel denoising on tiny random-weight checkpoints")
+    parser.add_argument("--fixture_dir", type=str, default=None, help="reuse/create the tiny checkpoints here instead of a temp folder")
+    parser.add_argument("--use_pasd_light", action="store_true", help="benchmark the pasd_light UNet/ControlNet")
+    parser.add_argument("--workers", type=str, nargs="+", default=["local", "local,cpu", "cpu,cpu"], help="--tile_workers sets to time; the first is the reference")
+    parser.add_argument("--images", type=int, default=2, help="synthetic input images")
+    parser.add_argument("--image_size", type=int, default=128, help="side of the synthetic input images")
+    parser.add_argument("--upscale", type=int, default=2, help="upsampling scale")
+    parser.add_argument("--steps", type=int, default=4, help="denoising steps per image")
+    parser.add_argument("--tile_size", type=int, default=16, help="--latent_tiled_size (latent pixels)")
+    parser.add_argument("--overlap", type=int, default=8, help="--latent_tiled_overlap (latent pixels)")
+    parser.add_argument("--window", type=str, default="gaussian", choices=["gaussian", "cosine"], help="--tile_window")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="torch threads of every cpu worker process")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads of the main process")
+    parser.add_argument("--check", action="store_true", help="compare the outputs with the first worker set; exit 1 on a mismatch")
+    parser.add_argument("--max_diff", type=int, default=2, help="largest allowed pixel difference (0-255) for --check")
+    parser.add_argument("--pipeline_max_diff", type=float, default=32, help="largest allowed mean difference of an 8x8 block (0-255) to the pipeline tiling outputs for --check")
+    parser.add_argument("--mixed_precision", type=str, default="no", choices=["no", "fp16", "bf16"], help="precision of every run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of weights, inputs and sampling")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    tile_args = ["--latent_tiled_size", str(args.tile_size), "--latent_tiled_overlap", str(args.overlap),
+                 "--mixed_precision", args.mixed_precision]
+    variants = {"pipeline tiling": []}
+    for workers in args.workers:
+        variants[workers] = ["--tile_workers", workers, "--tile_window", args.window] + (
+            ["--cpu_threads", str(args.cpu_threads)] if args.cpu_threads else [])
+
+    workdir = tempfile.mkdtemp(prefix="pasd_tile_parallel_")
+    failures = []
+    try:
+        fixture_dir = args.fixture_dir or os.path.join(workdir, "fixture")
+        if os.path.isdir(os.path.join(fixture_dir, "pasd", "checkpoint-0")):
+            sd_path = os.path.join(fixture_dir, "stable-diffusion-v1-5")
+            pasd_path = os.path.join(fixture_dir, "pasd", "checkpoint-0")
+        else:
+            sd_path, pasd_path = build_tiny_pasd(fixture_dir, args.use_pasd_light, args.seed)
+
+        latent = args.image_size * args.upscale // 8
+        print(f"{args.images} images, {latent}x{latent} latent, tile {args.tile_size}, overlap {args.overlap}, "
+              f"{args.steps} steps, mixed precision {args.mixed_precision}:")
+        print(f"{'workers':>22} {'s/image':>9} {'ms/step':>9} {'max diff':>9} {'vs pipeline':>12}")
+        reference = pipeline_outputs = None
+        for i, (name, extra_args) in enumerate(variants.items()):
+            output_dir = os.path.join(workdir, f"outputs_{i}")
+            result = bench_inference(args, sd_path, pasd_path, workdir, tile_args + extra_args + ["--output_dir", output_dir])
+            if result["failed"]:
+                failures.append(f"{name}: {result['failed']} images failed")
+            outputs = load_outputs(output_dir)
+            difference = pipeline_difference = None
+            if not extra_args:
+                pipeline_outputs = outputs
+                if not outputs:
+                    failures.append(f"{name}: no outputs")
+            else:
+                pipeline_difference = block_difference(outputs, pipeline_outputs)
+                if pipeline_difference is None or pipeline_difference > args.pipeline_max_diff:
+                    failures.append(f"{name}: 8x8 blocks differ from pipeline tiling by {pipeline_difference} (allowed {args.pipeline_max_diff})")
+                if reference is None:
+                    reference = outputs
+                else:
+                    difference = max_difference(outputs, reference)
+                    if difference is None or difference > args.max_diff:
+                        failures.append(f"{name}: outputs differ from {args.workers[0]} by {difference} (allowed {args.max_diff})")
+            per_image = result["processing_s"] / max(result["images"], 1)
+            per_step = 1000 / result["denoise_steps_per_s"] if result["denoise_steps_per_s"] else 0.0
+            vs_pipeline = "-" if pipeline_difference is None else f"{pipeline_difference:.1f}"
+            print(f"{name:>22} {per_image:>9.3f} {per_step:>9.1f} {'-' if difference is None else difference:>9} {vs_pipeline:>12}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.check:
+        if failures:
+            for failure in failures:
+                print(f"[FAIL] {failure}")
+            sys.exit(1)
+        print("[OK] Every worker set produced the reference outputs and stayed close to pipeline tiling")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+End-to-end CPU benchmark of the PASD code paths on tiny random-weight checkpoints
+Inference runs test_pasd.main (load_pasd_pipeline -> pipeline -> wavelet_color_fix ->
+save) on synthetic images, and test_pasd_sdxl.main the same way on the SDXL fixture;
+training runs train_pasd.training_loss with the optimizer setup of train_pasd.main on
+synthetic batches. Reports images/s, denoising steps/s, SDXL images/s and training
+steps/s; results can be saved as a JSON baseline and later runs compared.
+--compare_cpu runs inference with the untuned CPU path, the tuned fp32 path and bf16 autocast.
+
+Usage (from PASD-upscaler/):
+    python benchmarks/bench_tiny_pasd.py
+    python benchmarks/bench_tiny_pasd.py --save_baseline
+    python benchmarks/bench_tiny_pasd.py --compare
+    python benchmarks/bench_tiny_pasd.py --compare_cpu --skip_training --skip_sdxl
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+
+import numpy as np
+import torch
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from tiny_pasd import build_tiny_pasd, build_tiny_pasd_sdxl
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baselines", "tiny_pasd.json")
+METRICS = ("images_per_s", "denoise_steps_per_s", "sdxl_images_per_s", "train_steps_per_s")
+# test_pasd options of each --compare_cpu variant (appended, so they override the defaults)
+CPU_VARIANTS = {
+    "untuned fp32": ["--mixed_precision", "no", "--no_cpu_optimizations"],
+    "tuned fp32": ["--mixed_precision", "no"],
+    "tuned bf16": ["--mixed_precision", "bf16"],
+}
+
+
+def make_images(folder, count, size, seed):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f"img_{i:04d}.png"))
+
+
+def bench_inference(args, sd_path, pasd_path, workdir, extra_args=()):
+    import test_pasd
+
+    input_dir = os.path.join(workdir, "inputs")
+    if not os.path.isdir(input_dir):
+        make_images(input_dir, args.images, args.image_size, args.seed)
+    manifest = os.path.join(workdir, "manifest.json")
+    timings = os.path.join(workdir, "timings.jsonl")
+    pasd_args = test_pasd.parse_args([
+        "--pretrained_model_path", sd_path,
+        "--pasd_model_path", pasd_path,
+        "--image_path", input_dir,
+        "--output_dir", os.path.join(workdir, "outputs"),
+        "--high_level_info",  # no value: no captioner, prompt from --prompt/--added_prompt only
+        "--mixed_precision", "no",
+        "--device", "cpu",
+        "--upscale", str(args.upscale),
+        "--process_size", str(args.image_size * args.upscale),
+        "--num_inference_steps", str(args.steps),
+        "--seed", str(args.seed),
+        "--result_manifest", manifest,
+        "--timings_jsonl", timings,
+    ] + (["--use_pasd_light"] if args.use_pasd_light else []) + list(extra_args))
+
+    start = time.perf_counter()
+    test_pasd.main(pasd_args, enable_xformers_memory_efficient_attention=False)
+    wall = time.perf_counter() - start
+
+    with open(manifest) as f:
+        result = json.load(f)
+    with open(timings) as f:
+        records = [json.loads(line) for line in f]
+    # The median step is robust to the first (warm-up) call
+    steps = [record["seconds"] for record in records if record["stage"] == "denoise_step"]
+    processing = wall - result["model_load_time"]
+    images = len(result["results"])
+    return {
+        "images": images,
+        "failed": len(result["failed"]),
+        "model_load_s": result["model_load_time"],
+        "processing_s": processing,
+        "images_per_s": images / processing if processing else 0.0,
+        "denoise_steps_per_s": 1.0 / statistics.median(steps) if steps else 0.0,
+        "stage_totals": result.get("stage_totals"),
+    }
+
+
+def bench_inference_sdxl(args, sdxl_path, pasd_path, workdir):
+    """test_pasd_sdxl.main on the SDXL fixture (fp32: its fp16 path loads a separate VAE)"""
+    import test_pasd_sdxl
+
+    input_dir = os.path.join(workdir, "inputs")
+    if not os.path.isdir(input_dir):
+        make_images(input_dir, args.images, args.image_size, args.seed)
+    output_dir = os.path.join(workdir, "outputs_sdxl")
+    sdxl_args = test_pasd_sdxl.parse_args([
+        "--pretrained_model_path", sdxl_path,
+        "--pasd_model_path", pasd_path,
+        "--image_path", input_dir,
+        "--output_dir", output_dir,
+        "--high_level_info",
+        "--mixed_precision", "no",
+        "--upscale", str(args.upscale),
+        "--process_size", str(args.image_size * args.upscale),
+        "--num_inference_steps", str(args.steps),
+        "--seed", str(args.seed),
+    ] + (["--use_pasd_light"] if args.use_pasd_light else []))
+
+    start = time.perf_counter()
+    test_pasd_sdxl.main(sdxl_args, enable_xformers_memory_efficient_attention=False)
+    seconds = time.perf_counter() - start
+    images = len(os.listdir(output_dir))
+    # Includes model loading: test_pasd_sdxl.py does not time its stages
+    return {"sdxl_images": images, "sdxl_s": seconds, "sdxl_images_per_s": images / seconds if seconds else 0.0}
+
+
+def bench_training(args, sd_path):
+    import train_pasd
+    from diffusers import AutoencoderKL, DDPMScheduler
+    from transformers import AutoTokenizer
+    if args.use_pasd_light:
+        from pasd.models.pasd_light.unet_2d_condition import UNet2DConditionModel
+        from pasd.models.pasd_light.controlnet import ControlNetModel
+    else:
+        from pasd.models.pasd.unet_2d_condition import UNet2DConditionModel
+        from pasd.models.pasd.controlnet import ControlNetModel
+
+    train_args = train_pasd.parse_args([
+        "--pretrained_model_name_or_path", sd_path,
+        "--train_data_dir", "unused",
+        "--tracker_project_name", "bench_tiny_pasd",
+        "--control_type", "realisr",
+        "--resolution", str(args.train_resolution),
+    ])
+    torch.manual_seed(args.seed)
+
+    # Model setup of train_pasd.main
+    tokenizer = AutoTokenizer.from_pretrained(sd_path, subfolder="tokenizer", use_fast=False)
+    text_encoder_cls = train_pasd.import_model_class_from_model_name_or_path(sd_path, None)
+    noise_scheduler = DDPMScheduler.from_pretrained(sd_path, subfolder="scheduler")
+    text_encoder = text_encoder_cls.from_pretrained(sd_path, subfolder="text_encoder")
+    vae = AutoencoderKL.from_pretrained(sd_path, subfolder="vae")
+    unet = UNet2DConditionModel.from_pretrained_orig(sd_path, subfolder="unet")
+    controlnet = ControlNetModel.from_unet(unet)
+    vae.requires_grad_(False)
+    unet.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    controlnet.train()
+    for name, param in unet.named_parameters():
+        if any(trainable_module_name in name for trainable_module_name in train_args.trainable_modules):
+            param.requires_grad = True
+    optimizer = torch.optim.AdamW(
+        list(controlnet.parameters()) + list(unet.parameters()),
+        lr=train_args.learning_rate,
+        betas=(train_args.adam_beta1, train_args.adam_beta2),
+        weight_decay=train_args.adam_weight_decay,
+        eps=train_args.adam_epsilon,
+    )
+
+    # Batches shaped like Text2ImageDataset's: targets in [-1, 1], conditions in [0, 1]
+    size = train_args.resolution
+    text = ["a photo"] * args.train_batch_size
+    input_ids = tokenizer(text, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt").input_ids
+    def batch():
+        return (
+            torch.rand(args.train_batch_size, 3, size, size) * 2 - 1,
+            text,
+            input_ids,
+            torch.rand(args.train_batch_size, 3, size, size),
+        )
+
+    def step():
+        loss = train_pasd.training_loss(train_args, batch(), vae, text_encoder, unet, controlnet, noise_scheduler, torch.float32, "cpu")
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(list(controlnet.parameters()) + list(unet.parameters()), train_args.max_grad_norm)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=train_args.set_grads_to_none)
+        return loss.item()
+
+    step()  # warm-up
+    start = time.perf_counter()
+    losses = [step() for _ in range(args.train_steps)]
+    seconds = time.perf_counter() - start
+    return {
+        "train_steps": args.train_steps,
+        "train_batch_size": args.train_batch_size,
+        "train_resolution": size,
+        "train_s": seconds,
+        "train_steps_per_s": args.train_steps / seconds if seconds else 0.0,
+        "final_loss": losses[-1] if losses else None,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Names of the metrics that fell more than tolerance below the baseline"""
+    regressions = []
+    for metric in METRICS:
+        if metric not in result or not baseline["result"].get(metric):
+            continue
+        base = baseline["result"][metric]
+        change = result[metric] / base - 1
+        flag = "REGRESSION" if change < -tolerance else "ok"
+        print(f"  {metric:>20}: {result[metric]:8.3f} vs {base:8.3f} ({change * 100:+.1f}%) {flag}")
+        if change < -tolerance:
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmark of PASD inference and training on tiny random-weight checkpoints")
+    parser.add_argument("--fixture_dir", type=str, default=None, help="reuse/create the tiny checkpoints here instead of a temp folder")
+    parser.add_argument("--use_pasd_light", action="store_true", help="benchmark the pasd_light UNet/ControlNet")
+    parser.add_argument("--images", type=int, default=4, help="synthetic input images")
+    parser.add_argument("--image_size", type=int, default=32, help="side of the synthetic input images")
+    parser.add_argument("--upscale", type=int, default=2, help="upsampling scale")
+    parser.add_argument("--steps", type=int, default=4, help="denoising steps per image")
+    parser.add_argument("--train_steps", type=int, default=5, help="timed training steps (after one warm-up step)")
+    parser.add_argument("--train_batch_size", type=int, default=2, help="training batch size")
+    parser.add_argument("--train_resolution", type=int, default=64, help="training crop size")
+    parser.add_argument("--skip_training", action="store_true", help="only benchmark inference")
+    parser.add_argument("--skip_sdxl", action="store_true", help="do not benchmark test_pasd_sdxl.py")
+    parser.add_argument("--compare_cpu", action="store_true", help="also time inference without CPU tuning and with bf16 autocast")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads for reproducible numbers")
+    parser.add_argument("--seed", type=int, default=0, help="seed of weights, inputs and sampling")
+    parser.add_argument("--output", type=str, default=None, help="write this run's results to a JSON file")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save_baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare against the baseline; exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop before a metric counts as a regression")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    workdir = tempfile.mkdtemp(prefix="pasd_tiny_")
+    try:
+        fixture_dir = args.fixture_dir or os.path.join(workdir, "fixture")
+        if os.path.isdir(os.path.join(fixture_dir, "pasd", "checkpoint-0")):
+            sd_path = os.path.join(fixture_dir, "stable-diffusion-v1-5")
+            pasd_path = os.path.join(fixture_dir, "pasd", "checkpoint-0")
+        else:
+            sd_path, pasd_path = build_tiny_pasd(fixture_dir, args.use_pasd_light, args.seed)
+
+        result = bench_inference(args, sd_path, pasd_path, workdir)
+        print(f"Inference: {result['images']} images in {result['processing_s']:.2f}s, {result['images_per_s']:.2f} images/s, "
+              f"{result['denoise_steps_per_s']:.1f} denoising steps/s (model load {result['model_load_s']:.2f}s)")
+        if args.compare_cpu:
+            result["cpu_variants"] = {}
+            for name, extra_args in CPU_VARIANTS.items():
+                variant = bench_inference(args, sd_path, pasd_path, workdir, extra_args)
+                result["cpu_variants"][name] = {key: variant[key] for key in ("images_per_s", "denoise_steps_per_s")}
+                print(f"  {name:13s}: {variant['images_per_s']:.2f} images/s, {variant['denoise_steps_per_s']:.1f} denoising steps/s")
+        if not args.skip_sdxl:
+            sdxl_fixture = os.path.join(fixture_dir, "sdxl")
+            if os.path.isdir(os.path.join(sdxl_fixture, "pasd_sdxl", "checkpoint-0")):
+                sdxl_path = os.path.join(sdxl_fixture, "stable-diffusion-xl-base-1.0")
+                pasd_sdxl_path = os.path.join(sdxl_fixture, "pasd_sdxl", "checkpoint-0")
+            else:
+                sdxl_path, pasd_sdxl_path = build_tiny_pasd_sdxl(sdxl_fixture, args.use_pasd_light, args.seed)
+            result.update(bench_inference_sdxl(args, sdxl_path, pasd_sdxl_path, workdir))
+            print(f"SDXL inference: {result['sdxl_images']} images in {result['sdxl_s']:.2f}s incl. model load, "
+                  f"{result['sdxl_images_per_s']:.2f} images/s")
+        if not args.skip_training:
+            result.update(bench_training(args, sd_path))
+            print(f"Training: {result['train_steps']} steps in {result['train_s']:.2f}s, {result['train_steps_per_s']:.2f} steps/s "
+                  f"(loss {result['final_loss']:.4f})")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "benchmark": "tiny_pasd",
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "threads": torch.get_num_threads(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "save_baseline", "compare")},
+        "result": result,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"[ERROR] No baseline at {args.baseline}; run with --save_baseline first")
+            sys.exit(1)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with baseline from {baseline['created']} ({baseline['platform']}, {baseline['threads']} threads):")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"[FAIL] Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+        print("[OK] No regressions")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[OK] Baseline saved: {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Stub PASD inference for orchestration benchmarks
+Accepts the test_pasd.py command line (or serves the pasd_worker.py protocol with --serve)
+but only does a nearest-neighbour resize plus an optional sleep, so a batch run measures
+the orchestration around the model instead of the model.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def identity_upscale(image_path, output_path, scale, sleep):
+    """Nearest-neighbour upscale + sleep; returns a test_pasd.py style result record"""
+    start_time = time.time()
+    with Image.open(image_path) as image:
+        image = image.convert("RGB")
+        image = image.resize((image.width * scale, image.height * scale), Image.NEAREST)
+    if sleep > 0:
+        time.sleep(sleep)
+    upscale_time = time.time() - start_time
+    image.save(output_path)
+    with open(output_path, "rb") as f:
+        output_hash = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "image_path": str(image_path),
+        "output_path": str(output_path),
+        "width": image.width,
+        "height": image.height,
+        "bytes": os.path.getsize(output_path),
+        "sha256": output_hash,
+        "batch_size": 1,
+        "timings": {"upscale": upscale_time, "save": time.time() - start_time - upscale_time},
+    }
+
+
+def serve(address, sleep):
+    from pasd_worker import PASDWorker
+
+    class StubWorker(PASDWorker):
+        """pasd_worker.py protocol without loading any model"""
+
+        def __init__(self):
+            self.jobs_done = 0
+
+        def config(self):
+            return {"stub": True}
+
+        def upscale(self, image_path, output_dir, output_name=None, params=None):
+            if output_name is None:
+                output_name = f"{os.path.splitext(os.path.basename(image_path))[0]}.png"
+            os.makedirs(output_dir, exist_ok=True)
+            output_path = os.path.join(output_dir, output_name)
+            identity_upscale(image_path, output_path, int((params or {}).get("upscale", 1)), sleep)
+            self.jobs_done += 1
+            return output_path, {}
+
+    StubWorker().serve(address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub PASD inference (identity upscale + sleep)")
+    parser.add_argument("--image_path", type=str, default=None)
+    parser.add_argument("--output_dir", type=str, default="output")
+    parser.add_argument("--output_name", type=str, default=None)
+    parser.add_argument("--result_manifest", type=str, default=None)
+    parser.add_argument("--upscale", type=int, default=1)
+    parser.add_argument("--sleep", type=float, default=0.0, help="seconds of fake denoising per image")
+    parser.add_argument("--serve", type=str, default=None, help="host:port to serve the worker protocol on instead")
+    # Every other test_pasd.py argument is accepted and ignored
+    args, _ = parser.parse_known_args()
+
+    if args.serve is not None:
+        serve(args.serve, args.sleep)
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = args.output_name or f"{os.path.splitext(os.path.basename(args.image_path))[0]}.png"
+    result = identity_upscale(args.image_path, os.path.join(args.output_dir, name), args.upscale, args.sleep)
+
+    if args.result_manifest is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.result_manifest)), exist_ok=True)
+        tmp_path = f"{args.result_manifest}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"results": [result], "failed": [], "model_load_time": 0.0}, f, indent=2)
+        os.replace(tmp_path, args.result_manifest)
+
+
+if __name__ == "__main__":
+    main()
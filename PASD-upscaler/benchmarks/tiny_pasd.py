@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Tiny random-weight PASD checkpoints for CPU benchmarks
+Writes a miniature SD-1.5 layout (scheduler, CLIP text encoder + tokenizer, VAE, UNet,
+feature extractor) and a PASD checkpoint (UNet + ControlNet built from it the way
+train_pasd.py does) with the real module structure but a few thousand parameters per
+block, so load_pasd_pipeline, the pipeline and train_pasd's training step run in seconds
+without downloading anything. Outputs are noise; only speed means something.
+--sdxl writes the same for test_pasd_sdxl.py: two text encoders (the second with a
+projection), the SDXL block layout with text_time conditioning and an Euler scheduler.
+
+Usage (from PASD-upscaler/):
+    python benchmarks/tiny_pasd.py --output_dir fixtures/tiny_pasd
+    python benchmarks/tiny_pasd.py --output_dir fixtures/tiny_pasd_sdxl --sdxl
+"""
+import os
+import sys
+import json
+import argparse
+
+import torch
+from diffusers import AutoencoderKL, DDPMScheduler, EulerDiscreteScheduler
+from diffusers import UNet2DConditionModel as SDUNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer, CLIPImageProcessor
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# SD-1.5 block layout with tiny widths: 4 levels, so the VAE keeps its 8x scale factor
+# and the UNet/ControlNet the same down/up/mid structure and residual count
+UNET_CONFIG = {
+    "sample_size": 8,
+    "in_channels": 4,
+    "out_channels": 4,
+    "down_block_types": ["CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "DownBlock2D"],
+    "up_block_types": ["UpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D"],
+    "block_out_channels": [32, 32, 64, 64],
+    "layers_per_block": 1,
+    "attention_head_dim": 8,
+    "cross_attention_dim": 32,
+    "norm_num_groups": 32,
+}
+VAE_CONFIG = {
+    "in_channels": 3,
+    "out_channels": 3,
+    "down_block_types": ["DownEncoderBlock2D"] * 4,
+    "up_block_types": ["UpDecoderBlock2D"] * 4,
+    "block_out_channels": [32, 32, 32, 32],
+    "layers_per_block": 1,
+    "latent_channels": 4,
+    "norm_num_groups": 32,
+    "sample_size": 64,
+}
+# SDXL layout: 3 levels, linear projections, cross-attention over both text encoders
+# (32 + 32) and text_time embeddings of the pooled second encoder output (32) plus the
+# 6 size/crop conditions (6 x 8)
+SDXL_TEXT_DIM = 32
+SDXL_UNET_CONFIG = {
+    "sample_size": 8,
+    "in_channels": 4,
+    "out_channels": 4,
+    "down_block_types": ["DownBlock2D", "CrossAttnDownBlock2D", "CrossAttnDownBlock2D"],
+    "up_block_types": ["CrossAttnUpBlock2D", "CrossAttnUpBlock2D", "UpBlock2D"],
+    "block_out_channels": [32, 64, 64],
+    "layers_per_block": 1,
+    "attention_head_dim": 4,
+    "transformer_layers_per_block": 1,
+    "use_linear_projection": True,
+    "cross_attention_dim": 2 * SDXL_TEXT_DIM,
+    "addition_embed_type": "text_time",
+    "addition_time_embed_dim": 8,
+    "projection_class_embeddings_input_dim": SDXL_TEXT_DIM + 6 * 8,
+    "norm_num_groups": 32,
+}
+SCHEDULER_CONFIG = {
+    "num_train_timesteps": 1000,
+    "beta_start": 0.00085,
+    "beta_end": 0.012,
+    "beta_schedule": "scaled_linear",
+    "prediction_type": "epsilon",
+    "clip_sample": False,
+    "set_alpha_to_one": False,
+    "steps_offset": 1,
+}
+
+
+def build_tokenizer(path):
+    """CLIP BPE tokenizer with the byte-level base vocabulary and no merges"""
+    os.makedirs(path, exist_ok=True)
+    symbols = list(bytes_to_unicode().values())
+    vocab = symbols + [f"{symbol}</w>" for symbol in symbols] + ["<|startoftext|>", "<|endoftext|>"]
+    vocab_file = os.path.join(path, "vocab.json")
+    merges_file = os.path.join(path, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+    tokenizer.save_pretrained(path)
+    return tokenizer
+
+
+def text_config(tokenizer, hidden_size=32):
+    return CLIPTextConfig(
+        vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=2 * hidden_size, num_hidden_layers=2,
+        num_attention_heads=4, max_position_embeddings=77, projection_dim=hidden_size,
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+    )
+
+
+def pasd_models(use_pasd_light):
+    if use_pasd_light:
+        from pasd.models.pasd_light.unet_2d_condition import UNet2DConditionModel
+        from pasd.models.pasd_light.controlnet import ControlNetModel
+    else:
+        from pasd.models.pasd.unet_2d_condition import UNet2DConditionModel
+        from pasd.models.pasd.controlnet import ControlNetModel
+    return UNet2DConditionModel, ControlNetModel
+
+
+def build_tiny_pasd(output_dir, use_pasd_light=False, seed=0):
+    """Write the fixture; returns (pretrained_model_path, pasd_model_path)"""
+    UNet2DConditionModel, ControlNetModel = pasd_models(use_pasd_light)
+
+    torch.manual_seed(seed)
+    sd_path = os.path.join(output_dir, "stable-diffusion-v1-5")
+    # runs/pasd/checkpoint-N layout: grayscale mode reads the scheduler from the parent
+    pasd_root = os.path.join(output_dir, "pasd")
+    pasd_path = os.path.join(pasd_root, "checkpoint-0")
+
+    scheduler = DDPMScheduler(**SCHEDULER_CONFIG)
+    scheduler.save_pretrained(os.path.join(sd_path, "scheduler"))
+    scheduler.save_pretrained(os.path.join(pasd_root, "scheduler"))
+
+    tokenizer = build_tokenizer(os.path.join(sd_path, "tokenizer"))
+    text_encoder = CLIPTextModel(text_config(tokenizer))
+    text_encoder.save_pretrained(os.path.join(sd_path, "text_encoder"))
+    CLIPImageProcessor().save_pretrained(os.path.join(sd_path, "feature_extractor"))
+    AutoencoderKL(**VAE_CONFIG).save_pretrained(os.path.join(sd_path, "vae"))
+    SDUNet2DConditionModel(**UNET_CONFIG).save_pretrained(os.path.join(sd_path, "unet"))
+
+    # Same initialisation as train_pasd.py: PASD UNet from the SD UNet, ControlNet from the UNet
+    unet = UNet2DConditionModel.from_pretrained_orig(sd_path, subfolder="unet")
+    controlnet = ControlNetModel.from_unet(unet)
+    unet.save_pretrained(os.path.join(pasd_path, "unet"))
+    controlnet.save_pretrained(os.path.join(pasd_path, "controlnet"))
+    return sd_path, pasd_path
+
+
+def build_tiny_pasd_sdxl(output_dir, use_pasd_light=False, seed=0):
+    """Write the SDXL fixture; returns (pretrained_model_path, pasd_model_path) for test_pasd_sdxl.py"""
+    UNet2DConditionModel, ControlNetModel = pasd_models(use_pasd_light)
+
+    torch.manual_seed(seed)
+    sdxl_path = os.path.join(output_dir, "stable-diffusion-xl-base-1.0")
+    pasd_root = os.path.join(output_dir, "pasd_sdxl")
+    pasd_path = os.path.join(pasd_root, "checkpoint-0")
+
+    # realisr reads the scheduler from the checkpoint, grayscale from its parent
+    scheduler = EulerDiscreteScheduler(**SCHEDULER_CONFIG, timestep_spacing="leading")
+    for path in (sdxl_path, pasd_path, pasd_root):
+        scheduler.save_pretrained(os.path.join(path, "scheduler"))
+
+    tokenizer = build_tokenizer(os.path.join(sdxl_path, "tokenizer"))
+    build_tokenizer(os.path.join(sdxl_path, "tokenizer_2"))
+    CLIPTextModel(text_config(tokenizer, SDXL_TEXT_DIM)).save_pretrained(os.path.join(sdxl_path, "text_encoder"))
+    CLIPTextModelWithProjection(text_config(tokenizer, SDXL_TEXT_DIM)).save_pretrained(os.path.join(sdxl_path, "text_encoder_2"))
+    AutoencoderKL(**VAE_CONFIG, scaling_factor=0.13025).save_pretrained(os.path.join(sdxl_path, "vae"))
+    SDUNet2DConditionModel(**SDXL_UNET_CONFIG).save_pretrained(os.path.join(sdxl_path, "unet"))
+
+    unet = UNet2DConditionModel.from_pretrained_orig(sdxl_path, subfolder="unet")
+    controlnet = ControlNetModel.from_unet(unet)
+    unet.save_pretrained(os.path.join(pasd_path, "unet"))
+    controlnet.save_pretrained(os.path.join(pasd_path, "controlnet"))
+    return sdxl_path, pasd_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write tiny random-weight SD-1.5 (or SDXL) + PASD checkpoints")
+    parser.add_argument("--output_dir", type=str, default="fixtures/tiny_pasd", help="fixture folder")
+    parser.add_argument("--use_pasd_light", action="store_true", help="build the pasd_light UNet/ControlNet")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random weights")
+    parser.add_argument("--sdxl", action="store_true", help="build the SDXL fixture for test_pasd_sdxl.py instead")
+    args = parser.parse_args()
+
+    build = build_tiny_pasd_sdxl if args.sdxl else build_tiny_pasd
+    sd_path, pasd_path = build(args.output_dir, args.use_pasd_light, args.seed)
+    print(f"[OK] --pretrained_model_path {sd_path} --pasd_model_path {pasd_path}")
+
+
+if __name__ == "__main__":
+    main()
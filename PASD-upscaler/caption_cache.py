@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Disk-backed cache of PASD validation prompts
+Captioning (CoCa/BLIP), classification or detection results are stored in SQLite, keyed by
+a hash of the input pixels plus the high-level mode, model and prompt arguments, so reruns
+and the 2x/4x/8x jobs of one image only run the high-level net once.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+class CaptionCache:
+    """Prompt key-value store; safe to share between threads and processes"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Several test_pasd.py processes or pool workers may use the same file
+        self.db = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts ("
+            " key TEXT PRIMARY KEY, prompt TEXT NOT NULL, params TEXT, created REAL)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def make_key(digest, params):
+        """digest: pixel digest of the input image; params: everything the prompt depends on"""
+        payload = json.dumps({"input": digest, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT prompt FROM prompts WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, prompt, params=None):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO prompts (key, prompt, params, created) VALUES (?, ?, ?, ?)",
+                (key, prompt, json.dumps(params, sort_keys=True, default=str), time.time()),
+            )
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
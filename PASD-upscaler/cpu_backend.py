@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Device selection and CPU tuning for PASD inference
+Picks CUDA or CPU (--device auto), maps --mixed_precision to what the device supports
+(fp16 becomes bf16 on CPUs with native bf16, fp32 otherwise), sets torch's intra-/inter-op
+thread pools and puts the convolutional models in channels-last layout on CPU. Attention
+stays on diffusers' default scaled_dot_product_attention processor; xformers is CUDA-only.
+"""
+import contextlib
+
+import torch
+
+
+def cpu_supports_bf16():
+    """True if this CPU has native bf16 (AVX512-BF16 or AMX); emulated bf16 is slower than fp32"""
+    for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        supported = getattr(torch.cpu, check, None)
+        if supported is not None and supported():
+            return True
+    return False
+
+
+def resolve_device(device="auto"):
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda" and not torch.cuda.is_available():
+        raise RuntimeError("--device cuda requested but CUDA is not available")
+    return device
+
+
+def resolve_precision(device, mixed_precision):
+    """accelerate mixed_precision value that works on device"""
+    if device != "cpu" or mixed_precision == "no":
+        return mixed_precision
+    if mixed_precision == "fp16" or (mixed_precision == "bf16" and not cpu_supports_bf16()):
+        resolved = "bf16" if cpu_supports_bf16() else "no"
+        print(f"--mixed_precision {mixed_precision} on CPU: using {'bf16' if resolved == 'bf16' else 'fp32'}")
+        return resolved
+    return mixed_precision
+
+
+def configure_threads(threads=None, interop_threads=None):
+    """torch intra-op threads (default: all cores) and inter-op threads"""
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Only possible before the first parallel op of the process
+            print(f"Warning: could not set inter-op threads: {e}")
+
+
+def setup(args):
+    """Resolve args.device / args.mixed_precision in place and tune the CPU backend
+
+    Returns the accelerate `cpu` flag.
+    """
+    args.device = resolve_device(args.device)
+    args.mixed_precision = resolve_precision(args.device, args.mixed_precision)
+    if args.device == "cpu" and not args.no_cpu_optimizations:
+        configure_threads(args.cpu_threads, args.cpu_interop_threads)
+    return args.device == "cpu"
+
+
+def optimize_pipeline(pipeline):
+    """Channels-last layout for the convolution-heavy models (faster oneDNN kernels on CPU)"""
+    for name in ("unet", "controlnet", "vae"):
+        module = getattr(pipeline, name, None)
+        if module is not None:
+            module.to(memory_format=torch.channels_last)
+
+
+def autocast(device, mixed_precision):
+    """bf16 autocast for CPU pipeline calls, so fp32 inputs meet the bf16 weights; a no-op elsewhere"""
+    if device == "cpu" and mixed_precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
@@ -9,6 +9,8 @@ from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import shutil
 
+from job_ledger import JobLedger
+
 class ComparisonFixer:
     def __init__(self):
         self.base_dir = Path(".")
@@ -24,6 +26,43 @@ class ComparisonFixer:
         
         # Images with processing issues (need to be excluded or reprocessed)
         self.problematic_images = ["LQ_sample", "woman", "barbara"]
+        
+        # Job ledger written by full_batch_process.py; results without one
+        # (older runs) fall back to the directory layout
+        ledger_path = self.results_dir / "jobs.sqlite"
+        self.ledger = JobLedger(ledger_path) if ledger_path.exists() else None
+        self.ledger_images = {}
+        if self.ledger is not None:
+            for image_path, set_name in self.ledger.images():
+                self.ledger_images[(Path(image_path).stem, set_name)] = image_path
+            # The ledger knows exactly which jobs failed, so the hand-kept list is not needed
+            self.problematic_images = []
+    
+    def all_images(self):
+        """(image_name, set_name) for every processed image"""
+        if self.ledger is not None:
+            return list(self.ledger_images.keys())
+        
+        all_images = []
+        originals_dir = self.results_dir / "originals"
+        for set_dir in originals_dir.glob("*"):
+            if set_dir.is_dir():
+                for img_file in set_dir.glob("*.png"):
+                    all_images.append((img_file.stem, set_dir.name))
+        return all_images
+    
+    def upscaled_paths(self, image_name, set_name):
+        """{"2x": path, "4x": path, "8x": path} for one image (None if the job never finished)"""
+        if self.ledger is not None:
+            outputs = self.ledger.outputs_for_image(self.ledger_images[(image_name, set_name)])
+            return {
+                f"{scale}x": Path(outputs[scale]) if scale in outputs else None
+                for scale in (2, 4, 8)
+            }
+        return {
+            f"{scale}x": self.results_dir / f"{scale}x_upscaled" / set_name / f"{image_name}_{scale}x.png"
+            for scale in (2, 4, 8)
+        }
     
     def validate_image_set(self, image_name, set_name):
         """Check if an image set has consistent processing results"""
@@ -31,16 +70,14 @@ class ComparisonFixer:
         
         # Paths to check
         original_path = self.results_dir / "originals" / set_name / f"{image_name}.png"
-        upscaled_2x = self.results_dir / "2x_upscaled" / set_name / f"{image_name}_2x.png"
-        upscaled_4x = self.results_dir / "4x_upscaled" / set_name / f"{image_name}_4x.png"
-        upscaled_8x = self.results_dir / "8x_upscaled" / set_name / f"{image_name}_8x.png"
+        upscaled = self.upscaled_paths(image_name, set_name)
         
         # Check if files exist
         files_exist = {
             "original": original_path.exists(),
-            "2x": upscaled_2x.exists(),
-            "4x": upscaled_4x.exists(), 
-            "8x": upscaled_8x.exists()
+            "2x": upscaled["2x"] is not None and upscaled["2x"].exists(),
+            "4x": upscaled["4x"] is not None and upscaled["4x"].exists(), 
+            "8x": upscaled["8x"] is not None and upscaled["8x"].exists()
         }
         
         print(f"Files exist: {files_exist}")
@@ -64,11 +101,7 @@ class ComparisonFixer:
         
         # Load images that exist
         original_path = self.results_dir / "originals" / set_name / f"{image_name}.png"
-        upscaled_paths = {
-            "2x": self.results_dir / "2x_upscaled" / set_name / f"{image_name}_2x.png",
-            "4x": self.results_dir / "4x_upscaled" / set_name / f"{image_name}_4x.png",
-            "8x": self.results_dir / "8x_upscaled" / set_name / f"{image_name}_8x.png"
-        }
+        upscaled_paths = self.upscaled_paths(image_name, set_name)
         
         try:
             # Load original
@@ -78,7 +111,7 @@ class ComparisonFixer:
             
             # Load upscaled versions that exist
             for scale, path in upscaled_paths.items():
-                if path.exists():
+                if path is not None and path.exists():
                     try:
                         upscaled = Image.open(path)
                         images_to_show.append(upscaled)
@@ -160,16 +193,7 @@ class ComparisonFixer:
         """Generate a status report of all processing results"""
         print("\n[REPORT] Generating status report...")
         
-        # Scan all original images
-        originals_dir = self.results_dir / "originals"
-        all_images = []
-        
-        for set_dir in originals_dir.glob("*"):
-            if set_dir.is_dir():
-                set_name = set_dir.name
-                for img_file in set_dir.glob("*.png"):
-                    img_name = img_file.stem
-                    all_images.append((img_name, set_name))
+        all_images = self.all_images()
         
         report = []
         report.append("# PASD Processing Results Analysis")
@@ -216,19 +240,13 @@ class ComparisonFixer:
         print("\n[FIX] Creating fixed comparisons for valid images...")
         
         fixed_count = 0
-        originals_dir = self.results_dir / "originals"
         
-        for set_dir in originals_dir.glob("*"):
-            if set_dir.is_dir():
-                set_name = set_dir.name
-                for img_file in set_dir.glob("*.png"):
-                    img_name = img_file.stem
-                    
-                    # Only process valid images
-                    if self.validate_image_set(img_name, set_name):
-                        result = self.create_fixed_comparison(img_name, set_name)
-                        if result:
-                            fixed_count += 1
+        for img_name, set_name in self.all_images():
+            # Only process valid images
+            if self.validate_image_set(img_name, set_name):
+                result = self.create_fixed_comparison(img_name, set_name)
+                if result:
+                    fixed_count += 1
         
         # Phase 4: Summary
         print("\n" + "="*60)
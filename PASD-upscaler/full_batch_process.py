@@ -11,21 +11,100 @@ from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import subprocess
 import glob
+import json
+import argparse
+import numpy as np
+
+from pasd_worker import PASDWorkerClient
+from worker_pool import WorkerPool, job_cost
+from output_cache import OutputCache
+from job_ledger import JobLedger, DONE
+from memory_monitor import merge_peaks
+import perf_profile
 
 class PASDBatchProcessor:
-    def __init__(self):
+    def __init__(self, worker_address=None, cache_size_gb=20, resume=False, max_attempts=3, retry_backoff=30.0,
+                 devices=None, cpu_threads=None, base_port=7870, cascade=False, cascade_steps=10):
         self.scales = [2, 4, 8]
         self.base_dir = Path(".")
         self.results_dir = self.base_dir / "PASD-results"
         self.examples_dir = self.base_dir / "examples"
         
+        # Resident worker (pasd_worker.py) keeps the models loaded between jobs
+        self.worker = PASDWorkerClient(worker_address) if worker_address else None
+        
+        # Local worker pool: one resident worker per GPU index or "cpu" entry
+        self.devices = devices or []
+        self.cpu_threads = cpu_threads
+        self.base_port = base_port
+        self.pool = None
+        
+        # Every setting that changes the output pixels. All of them are passed to
+        # test_pasd.py explicitly and hashed into the output cache key.
+        # model_params are fixed when a resident worker starts; job_params travel per job.
+        self.model_params = {
+            "pretrained_model_path": "checkpoints/stable-diffusion-v1-5",
+            "pasd_model_path": "runs/pasd/pasd/checkpoint-100000",
+            "high_level_info": "caption",
+            "mixed_precision": "fp16",
+        }
+        self.job_params = {
+            "guidance_scale": 7.0,
+            "num_inference_steps": 20,
+            "conditioning_scale": 1.0,
+            "process_size": 768,
+            "prompt": "",
+            "added_prompt": "clean, high-resolution, 8k",
+            "negative_prompt": "blurry, dotted, noise, raster lines, unclear, lowres, over-smoothed",
+            # Explicit tile sizes: auto ones follow the free memory, and so would the outputs
+            "latent_tiled_size": 320,
+            "latent_tiled_overlap": 8,
+            "encoder_tiled_size": 1024,
+            "decoder_tiled_size": 224,
+            "added_noise_level": 900,
+            "seed": None,
+        }
+        # Fastest safe tile sizes of this machine, if calibrated (quick_test.py --calibrate)
+        perf_profile.update_params(self.job_params, perf_profile.load_profile(), self.model_params["mixed_precision"])
+        if self.worker is not None:
+            # A worker runs with the model settings it was started with: key results by those
+            try:
+                self.model_params = self.worker.config()
+            except (ConnectionError, OSError, EOFError) as e:
+                raise SystemExit(f"[ERROR] No PASD worker at {worker_address}: {e}")
+        self.last_config = None
+        # Settings of each pool worker as reported once they are up (CPU workers resolve precision)
+        self.pool_configs = []
+        self.cache = OutputCache(self.results_dir / ".cache", max_bytes=int(cache_size_gb * 1024**3))
+        # Prompts of each image are generated once and shared by its 2x/4x/8x jobs and reruns
+        self.caption_cache_path = self.results_dir / ".cache" / "captions.sqlite"
+        
+        # Command that runs one job without a worker (benchmarks swap in a stub pipeline)
+        self.inference_cmd = ["python", "test_pasd.py"]
+        
+        # Cascade mode: 4x is a 2x pass over the 2x output, 8x a 2x pass over the 4x output,
+        # each with cascade_steps denoising steps
+        self.cascade = cascade
+        self.cascade_steps = cascade_steps
+        
+        # Persistent (image, scale) job table; survives crashes and drives --resume
+        self.ledger = JobLedger(self.results_dir / "jobs.sqlite")
+        self.resume = resume
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.last_error = None
+        self.last_result = None
+        self.last_memory = None
+        
         # Processing stats
         self.stats = {
             "total_images": 0,
             "processed": 0,
             "failed": 0,
             "start_time": time.time(),
-            "processing_times": []
+            "processing_times": [],
+            "cache_hits": 0,
+            "peak_memory": {}  # stage -> highest peak RSS / CUDA MB of any job in this run
         }
     
     def setup_directories(self):
@@ -72,6 +151,20 @@ class PASDBatchProcessor:
             shutil.copy2(image_path, dest_path)
             print(f"Backed up: {image_path.name}")
     
+    def cache_key(self, source_path, scale, job_params, model_params=None):
+        params = {**(model_params or self.model_params), **job_params, "upscale": scale, "scheduler": "UniPCMultistepScheduler"}
+        return self.cache.make_key(source_path, params), params
+
+    def stage(self, image_path, scale):
+        """(source image, upscale factor, job params) of one job, or None if its cascade input is missing"""
+        if not self.cascade or scale == self.scales[0]:
+            return image_path, scale, self.job_params
+        previous = self.scales[self.scales.index(scale) - 1]
+        row = self.ledger.get(image_path, previous)
+        if row is None or row["state"] != DONE or not row["output_path"] or not os.path.exists(row["output_path"]):
+            return None
+        return Path(row["output_path"]), scale // previous, {**self.job_params, "num_inference_steps": self.cascade_steps}
+
     def upscale_image(self, image_path, scale):
         """Upscale single image using PASD"""
         set_name = self.get_image_set_name(image_path)
@@ -79,56 +172,257 @@ class PASDBatchProcessor:
         output_name = f"{image_path.stem}_{scale}x.png"
         output_path = output_dir / output_name
         
-        if output_path.exists():
-            print(f"Skipping {image_path.name} {scale}x (already exists)")
+        source_path, stage_scale, job_params = self.stage(image_path, scale)
+        cache_key, key_params = self.cache_key(source_path, stage_scale, job_params)
+        if self.cache.restore(cache_key, output_path):
+            self.stats["cache_hits"] += 1
+            print(f"Skipping {image_path.name} {scale}x (cached)")
             return str(output_path)
         
-        print(f"Processing {image_path.name} -> {scale}x upscale...")
+        if source_path == image_path:
+            print(f"Processing {image_path.name} -> {scale}x upscale...")
+        else:
+            print(f"Processing {image_path.name} -> {scale}x upscale (cascade from {Path(source_path).name}, {job_params['num_inference_steps']} steps)...")
         start_time = time.time()
+
+        if self.worker is not None:
+            result_path = self.upscale_with_worker(source_path, output_dir, output_name, stage_scale, job_params, start_time)
+        else:
+            result_path = self.upscale_with_subprocess(source_path, output_dir, output_path, stage_scale, job_params, start_time)
+
+        if result_path and self.worker is not None and self.last_config != self.model_params:
+            # The worker was restarted with other settings: key by the ones that produced it
+            self.model_params = self.last_config
+            cache_key, key_params = self.cache_key(source_path, stage_scale, job_params)
+        if result_path:
+            self.cache.put(cache_key, result_path, key_params)
+        return result_path
+
+    def upscale_with_subprocess(self, image_path, output_dir, output_path, scale, job_params, start_time):
+        """Run one test_pasd.py process for this job"""
+        # test_pasd.py writes straight to output_path and reports it in a per-job manifest
+        manifest_path = self.results_dir / ".manifests" / f"{output_dir.parent.name}_{output_dir.name}_{output_path.stem}.json"
+        manifest_path.unlink(missing_ok=True)
         
         # PASD command
         cmd = [
-            "python", "test_pasd.py",
+            *self.inference_cmd,
             "--image_path", str(image_path),
             "--output_dir", str(output_dir),
+            "--output_name", output_path.name,
+            "--result_manifest", str(manifest_path),
             "--upscale", str(scale),
-            "--pretrained_model_path", "checkpoints/stable-diffusion-v1-5",
-            "--pasd_model_path", "runs/pasd/pasd/checkpoint-100000",
-            "--guidance_scale", "7.0",
-            "--num_inference_steps", "20"
+            "--caption_cache", str(self.caption_cache_path),
         ]
+        for name, value in {**self.model_params, **job_params}.items():
+            if value is not None:
+                cmd += [f"--{name}", str(value)]
         
         try:
             result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
             
             if result.returncode == 0:
-                # Find the generated file and rename it
-                output_files = list(output_dir.glob("*.png"))
-                if output_files:
-                    # Find the most recently created file
-                    latest_file = max(output_files, key=lambda p: p.stat().st_mtime)
-                    if latest_file != output_path:
-                        latest_file.rename(output_path)
+                manifest = {"results": []}
+                if manifest_path.exists():
+                    with open(manifest_path) as f:
+                        manifest = json.load(f)
+                results = manifest["results"]
+                if results and os.path.exists(results[0]["output_path"]):
+                    self.last_result = results[0]
+                    # Per-stage peaks of this image, plus model loading and the whole process
+                    self.last_memory = dict(results[0].get("memory", {}))
+                    if "model_load" in manifest.get("memory_peaks", {}):
+                        self.last_memory["model_load"] = manifest["memory_peaks"]["model_load"]
+                    if manifest.get("peak_rss_mb") is not None:
+                        self.last_memory["process"] = {"peak_rss_mb": manifest["peak_rss_mb"], "peak_cuda_mb": manifest.get("peak_cuda_mb")}
                     
                     processing_time = time.time() - start_time
                     self.stats["processing_times"].append(processing_time)
                     
                     print(f"[SUCCESS] {image_path.name} -> {scale}x ({processing_time:.1f}s)")
-                    return str(output_path)
+                    return results[0]["output_path"]
                 else:
+                    self.last_error = "no output in result manifest"
                     print(f"[ERROR] No output file found for {image_path.name}")
                     return None
             else:
+                self.last_error = result.stderr[-2000:]
                 print(f"[ERROR] Processing failed: {result.stderr[:200]}...")
                 return None
                 
         except subprocess.TimeoutExpired:
+            self.last_error = "timeout after 300s"
             print(f"[TIMEOUT] Processing {image_path.name} took too long")
             return None
         except Exception as e:
+            self.last_error = str(e)
             print(f"[EXCEPTION] Error processing {image_path.name}: {e}")
             return None
-    
+
+    def upscale_with_worker(self, image_path, output_dir, output_name, scale, job_params, start_time):
+        """Send the job to the resident worker; it writes straight to output_name"""
+        try:
+            job_params = {k: v for k, v in job_params.items() if v is not None}
+            reply = self.worker.upscale_job(image_path, output_dir, output_name, upscale=scale, **job_params)
+            output_path = reply["output_path"]
+            self.last_memory = reply.get("memory")
+            self.last_config = reply["config"]
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"[ERROR] Worker failed on {image_path.name}: {e}")
+            return None
+
+        processing_time = time.time() - start_time
+        self.stats["processing_times"].append(processing_time)
+        print(f"[SUCCESS] {image_path.name} -> {scale}x ({processing_time:.1f}s)")
+        return output_path
+
+    def run_job(self, image_path, scale):
+        """Run one (image, scale) job with retries, recording every attempt in the ledger"""
+        job = self.ledger.get(image_path, scale)
+        if self.resume and job is not None and job["state"] == DONE and job["output_path"] and os.path.exists(job["output_path"]):
+            print(f"Skipping {image_path.name} {scale}x (done in a previous run)")
+            return job["output_path"]
+        if self.stage(image_path, scale) is None:
+            self.ledger.start(image_path, scale)
+            self.ledger.fail(image_path, scale, "previous cascade stage failed", final=True)
+            print(f"[ERROR] {image_path.name} {scale}x skipped: previous cascade stage failed")
+            return None
+
+        for attempt in range(1, self.max_attempts + 1):
+            self.ledger.start(image_path, scale)
+            self.last_error = None
+            self.last_result = None
+            self.last_memory = None
+            cache_hits = self.stats["cache_hits"]
+            start_time = time.time()
+
+            upscaled_path = self.upscale_image(image_path, scale)
+            if upscaled_path:
+                self.ledger.finish(image_path, scale, upscaled_path, time.time() - start_time,
+                                   cache_hit=self.stats["cache_hits"] > cache_hits,
+                                   output_hash=self.last_result["sha256"] if self.last_result else None,
+                                   memory=self.last_memory)
+                if self.last_memory:
+                    merge_peaks(self.stats["peak_memory"], self.last_memory)
+                return upscaled_path
+
+            final = attempt == self.max_attempts
+            self.ledger.fail(image_path, scale, self.last_error or "unknown error", final=final)
+            if not final:
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                print(f"[RETRY] {image_path.name} {scale}x attempt {attempt}/{self.max_attempts} failed, retrying in {delay:.0f}s")
+                time.sleep(delay)
+        return None
+
+    def worker_args(self):
+        """test_pasd.py arguments that fix the model inside each pool worker"""
+        args = []
+        for name, value in self.model_params.items():
+            args += [f"--{name}", str(value)]
+        return args + ["--caption_cache", str(self.caption_cache_path)]
+
+    def pool_jobs(self, image_sets, scales):
+        """Pool jobs for the given scales; finished, cached and blocked jobs are settled here"""
+        jobs = []
+        for set_name, images in image_sets.items():
+            for image_path in images:
+                for scale in scales:
+                    row = self.ledger.get(image_path, scale)
+                    if self.resume and row is not None and row["state"] == DONE and row["output_path"] and os.path.exists(row["output_path"]):
+                        print(f"Skipping {image_path.name} {scale}x (done in a previous run)")
+                        self.stats["processed"] += 1
+                        continue
+                    
+                    stage = self.stage(image_path, scale)
+                    if stage is None:
+                        self.ledger.start(image_path, scale)
+                        self.ledger.fail(image_path, scale, "previous cascade stage failed", final=True)
+                        self.stats["failed"] += 1
+                        print(f"[ERROR] {image_path.name} {scale}x skipped: previous cascade stage failed")
+                        continue
+                    source_path, stage_scale, job_params = stage
+                    
+                    output_dir = self.results_dir / f"{scale}x_upscaled" / set_name
+                    output_name = f"{image_path.stem}_{scale}x.png"
+                    # Any worker may run the job: a result of any of their settings will do
+                    cache_keys = [self.cache_key(source_path, stage_scale, job_params, config)[0] for config in self.pool_configs]
+                    if any(self.cache.restore(cache_key, output_dir / output_name) for cache_key in cache_keys):
+                        self.ledger.start(image_path, scale)
+                        self.ledger.finish(image_path, scale, output_dir / output_name, 0.0, cache_hit=True)
+                        self.stats["cache_hits"] += 1
+                        self.stats["processed"] += 1
+                        print(f"Skipping {image_path.name} {scale}x (cached)")
+                        continue
+                    
+                    with Image.open(source_path) as img:
+                        width, height = img.size
+                    jobs.append({
+                        "image_path": image_path, "scale": scale,
+                        "source_path": source_path, "stage_scale": stage_scale,
+                        "job_params": {k: v for k, v in job_params.items() if v is not None},
+                        "key_job_params": job_params,
+                        "output_dir": output_dir, "output_name": output_name,
+                        "cost": job_cost(width, height, stage_scale, job_params["num_inference_steps"], job_params["process_size"]),
+                    })
+        return jobs
+
+    def run_with_pool(self, image_sets):
+        """Dispatch every pending job to the worker pool, costliest first, then build comparisons"""
+        for images in image_sets.values():
+            for image_path in images:
+                self.backup_original(image_path)
+        
+        # Cascade stages depend on the previous scale, so they are dispatched one wave per scale
+        waves = [[scale] for scale in self.scales] if self.cascade else [self.scales]
+        
+        def execute(client, job):
+            return client.upscale_job(job["source_path"], job["output_dir"], job["output_name"], upscale=job["stage_scale"], **job["job_params"])
+        
+        for scales in waves:
+            jobs = self.pool_jobs(image_sets, scales)
+            print(f"Dispatching {len(jobs)} jobs to {len(self.pool.names)} workers (longest first)")
+            for event in self.pool.run(jobs, execute, max_attempts=self.max_attempts, retry_backoff=self.retry_backoff):
+                kind, job, worker = event[:3]
+                image_path, scale = job["image_path"], job["scale"]
+                if kind == "start":
+                    self.ledger.start(image_path, scale)
+                elif kind == "done":
+                    reply, processing_time = event[3:]
+                    output_path, memory = reply["output_path"], reply.get("memory")
+                    self.ledger.finish(image_path, scale, output_path, processing_time, memory=memory)
+                    if memory:
+                        merge_peaks(self.stats["peak_memory"], memory)
+                    # Keyed by the settings of the worker that produced it
+                    cache_key, key_params = self.cache_key(job["source_path"], job["stage_scale"], job["key_job_params"], reply["config"])
+                    self.cache.put(cache_key, output_path, key_params)
+                    self.stats["processing_times"].append(processing_time)
+                    self.stats["processed"] += 1
+                    print(f"[SUCCESS] {image_path.name} -> {scale}x on {worker} ({processing_time:.1f}s)")
+                elif kind == "lost":
+                    # The job goes to another worker (or fails below if none is left)
+                    error = event[3]
+                    self.ledger.fail(image_path, scale, error, final=False)
+                    print(f"[ERROR] Worker {worker} lost while running {image_path.name} {scale}x: {error[:200]}")
+                elif kind == "retry":
+                    error, delay = event[3:]
+                    self.ledger.fail(image_path, scale, error, final=False)
+                    print(f"[RETRY] {image_path.name} {scale}x failed on {worker}, retrying in {delay:.0f}s: {error[:200]}")
+                else:
+                    error = event[3]
+                    self.ledger.fail(image_path, scale, error, final=True)
+                    self.stats["failed"] += 1
+                    print(f"[ERROR] {image_path.name} {scale}x failed on {worker}: {error[:200]}")
+        
+        self.stats["worker_utilisation"] = self.pool.utilisation_report()
+        
+        for images in image_sets.values():
+            for image_path in images:
+                outputs = self.ledger.outputs_for_image(image_path)
+                upscaled_paths = [outputs.get(scale) for scale in self.scales]
+                if any(upscaled_paths):
+                    self.create_comparison_image(image_path, upscaled_paths)
+
     def create_comparison_image(self, original_path, upscaled_paths):
         """Create horizontal comparison: Original | 2x | 4x | 8x"""
         try:
@@ -193,6 +487,7 @@ class PASDBatchProcessor:
             comp_path = comp_dir / f"{original_path.stem}_comparison.png"
             
             comparison.save(comp_path, quality=95)
+            self.ledger.add_comparison(original_path, self.get_image_set_name(original_path), comp_path)
             print(f"[SUCCESS] Created comparison: {comp_path.name}")
             return str(comp_path)
             
@@ -215,7 +510,7 @@ class PASDBatchProcessor:
             success_count = 0
             
             for scale in self.scales:
-                upscaled_path = self.upscale_image(image_path, scale)
+                upscaled_path = self.run_job(image_path, scale)
                 upscaled_paths.append(upscaled_path)
                 
                 if upscaled_path:
@@ -250,18 +545,97 @@ class PASDBatchProcessor:
         
         return image_sets
     
+    def consistency_psnr(self, original_path, upscaled_path):
+        """PSNR (dB) between the original and the upscaled image resized back down to it"""
+        with Image.open(original_path) as original, Image.open(upscaled_path) as upscaled:
+            original = original.convert("RGB")
+            downscaled = upscaled.convert("RGB").resize(original.size, Image.BICUBIC)
+            a = np.asarray(original, dtype=np.float64)
+            b = np.asarray(downscaled, dtype=np.float64)
+        mse = np.mean((a - b) ** 2)
+        return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+    def scale_tradeoff(self):
+        """Per-scale timing and consistency PSNR of the finished jobs, for the report"""
+        durations = self.ledger.durations_by_scale()
+        psnrs = {scale: [] for scale in self.scales}
+        for image_path, _ in self.ledger.images():
+            for scale, output_path in self.ledger.outputs_for_image(image_path).items():
+                if scale in psnrs and os.path.exists(image_path) and os.path.exists(output_path):
+                    psnrs[scale].append(self.consistency_psnr(image_path, output_path))
+        
+        rows = []
+        for i, scale in enumerate(self.scales):
+            cascaded = self.cascade and i > 0
+            times = durations.get(scale, [])
+            rows.append({
+                "scale": scale,
+                "source": f"{self.scales[i - 1]}x output" if cascaded else "original",
+                "steps": self.cascade_steps if cascaded else self.job_params["num_inference_steps"],
+                "jobs": len(times),
+                "avg_time": sum(times) / len(times) if times else 0,
+                "psnr": sum(psnrs[scale]) / len(psnrs[scale]) if psnrs[scale] else None,
+            })
+        return rows
+
     def generate_report(self):
         """Generate HTML report with all results"""
         print("\\nGenerating processing report...")
         
-        # Calculate statistics
+        # Calculate statistics from the job ledger (covers resumed runs too)
+        summary = self.ledger.summary()
         total_time = time.time() - self.stats["start_time"]
-        avg_processing_time = sum(self.stats["processing_times"]) / len(self.stats["processing_times"]) if self.stats["processing_times"] else 0
-        success_rate = (self.stats["processed"] / (self.stats["processed"] + self.stats["failed"]) * 100) if (self.stats["processed"] + self.stats["failed"]) > 0 else 0
+        durations = summary["durations"]
+        avg_processing_time = sum(durations) / len(durations) if durations else 0
+        finished = summary[DONE] + summary["failed"]
+        success_rate = (summary[DONE] / finished * 100) if finished > 0 else 0
+        
+        comparison_images = [row["comparison_path"] for row in self.ledger.comparisons()]
+        
+        # Quality / time trade-off per scale (independent vs. cascaded runs)
+        tradeoff = self.scale_tradeoff()
+        tradeoff_rows = ""
+        for row in tradeoff:
+            psnr = "n/a" if row["psnr"] is None else f"{row['psnr']:.2f} dB"
+            tradeoff_rows += (
+                f"<tr><td>{row['scale']}x</td><td>{row['source']}</td><td>{row['steps']}</td><td>{row['jobs']}</td>"
+                f"<td>{row['avg_time']:.1f}s</td><td>{psnr}</td></tr>"
+            )
+        stage_total = sum(row["avg_time"] for row in tradeoff)
         
-        # Find comparison images
-        comp_dir = self.results_dir / "comparisons" / "grid_comparisons"
-        comparison_images = list(comp_dir.glob("*.png")) if comp_dir.exists() else []
+        # Memory high-water marks from the ledger (every job that reported them, incl. resumed runs)
+        memory_by_scale = self.ledger.memory_by_scale()
+        stage_peaks = {}
+        memory_rows = ""
+        for scale in self.scales:
+            jobs = memory_by_scale.get(scale, [])
+            for job in jobs:
+                merge_peaks(stage_peaks, job)
+            rss = [max((p["peak_rss_mb"] or 0) for p in job.values()) for job in jobs if job]
+            cuda = [max((p["peak_cuda_mb"] or 0) for p in job.values()) for job in jobs if job]
+            memory_rows += (
+                f"<tr><td>{scale}x</td><td>{len(jobs)}</td>"
+                f"<td>{max(rss) if rss else 0:.0f} MB</td><td>{sum(rss) / len(rss) if rss else 0:.0f} MB</td>"
+                f"<td>{max(cuda) if cuda else 0:.0f} MB</td><td>{sum(cuda) / len(cuda) if cuda else 0:.0f} MB</td></tr>"
+            )
+        stage_rows = ""
+        for stage, peak in sorted(stage_peaks.items()):
+            cuda_peak = "n/a" if peak["peak_cuda_mb"] is None else f"{peak['peak_cuda_mb']:.0f} MB"
+            stage_rows += f"<tr><td>{stage}</td><td>{peak['peak_rss_mb'] or 0:.0f} MB</td><td>{cuda_peak}</td></tr>"
+        
+        # Per-worker utilisation (pool runs only)
+        utilisation_html = ""
+        if self.stats.get("worker_utilisation"):
+            rows = "".join(
+                f"<tr><td>{name}</td><td>{u['jobs']}</td><td>{u['failed']}</td><td>{u['busy']/60:.1f} min</td><td>{u['utilisation']*100:.1f}%</td></tr>"
+                for name, u in self.stats["worker_utilisation"].items()
+            )
+            utilisation_html = f'''
+        <h2>Worker Utilisation</h2>
+        <table class="workers">
+            <tr><th>Worker</th><th>Jobs</th><th>Failed</th><th>Busy</th><th>Utilisation</th></tr>{rows}
+        </table>
+'''
         
         report_html = f'''<!DOCTYPE html>
 <html>
@@ -281,6 +655,8 @@ class PASDBatchProcessor:
         .gallery-item img {{ width: 100%; height: auto; }}
         .gallery-item .caption {{ padding: 15px; background: #f8f9fa; }}
         h2 {{ color: #333; border-bottom: 2px solid #667eea; padding-bottom: 10px; }}
+        .workers {{ border-collapse: collapse; width: 100%; }}
+        .workers th, .workers td {{ border: 1px solid #ddd; padding: 8px; text-align: center; }}
     </style>
 </head>
 <body>
@@ -293,17 +669,21 @@ class PASDBatchProcessor:
         
         <div class="stats">
             <div class="stat">
-                <h3>{self.stats['total_images']}</h3>
+                <h3>{summary['images']}</h3>
                 <p>Total Images</p>
             </div>
             <div class="stat">
-                <h3>{self.stats['processed']}</h3>
+                <h3>{summary[DONE]}</h3>
                 <p>Successfully Processed</p>
             </div>
             <div class="stat">
-                <h3>{self.stats['failed']}</h3>
+                <h3>{summary['failed']}</h3>
                 <p>Failed</p>
             </div>
+            <div class="stat">
+                <h3>{summary['cache_hits']}</h3>
+                <p>Served from Cache</p>
+            </div>
             <div class="stat">
                 <h3>{success_rate:.1f}%</h3>
                 <p>Success Rate</p>
@@ -317,6 +697,22 @@ class PASDBatchProcessor:
                 <p>Comparisons Created</p>
             </div>
         </div>
+        {utilisation_html}
+        <h2>Quality / Time by Scale ({"cascade" if self.cascade else "independent"} mode)</h2>
+        <table class="workers">
+            <tr><th>Scale</th><th>Input</th><th>Steps</th><th>Timed Jobs</th><th>Avg Time</th><th>Consistency PSNR</th></tr>{tradeoff_rows}
+        </table>
+        <p>Avg time for all scales of one image: <strong>{stage_total:.1f}s</strong>. Consistency PSNR compares each
+        result, bicubic-downscaled to the original size, with the original (higher = more faithful to the input).</p>
+        
+        <h2>Memory High-Water Marks</h2>
+        <table class="workers">
+            <tr><th>Scale</th><th>Jobs</th><th>Max Peak RSS</th><th>Avg Peak RSS</th><th>Max Peak GPU</th><th>Avg Peak GPU</th></tr>{memory_rows}
+        </table>
+        <p>Highest peak of any job, per stage:</p>
+        <table class="workers">
+            <tr><th>Stage</th><th>Peak RSS</th><th>Peak GPU</th></tr>{stage_rows}
+        </table>
         
         <h2>Directory Structure</h2>
         <div class="directory-tree">PASD-results/
@@ -329,7 +725,7 @@ class PASDBatchProcessor:
 └── processing_report.html - This report</div>
         
         <h2>Processing Summary</h2>
-        <p>Successfully processed <strong>{self.stats['processed']}</strong> image upscales across multiple resolutions.</p>
+        <p>Successfully processed <strong>{summary[DONE]}</strong> image upscales across multiple resolutions.</p>
         <p>Each original image was processed at 2x, 4x, and 8x scales using PASD (Pixel-Aware Stable Diffusion).</p>
         <p>Comparison images show: <strong>Original | 2x Upscaled | 4x Upscaled | 8x Upscaled</strong> with dimensions labeled.</p>
         
@@ -337,7 +733,7 @@ class PASDBatchProcessor:
         <p>Check the <code>comparisons/grid_comparisons/</code> folder for all comparison images.</p>
         <p><strong>Files generated:</strong></p>
         <ul>
-            <li><strong>{len(self.stats['processing_times'])} upscaled images</strong> across 3 different scales</li>
+            <li><strong>{summary[DONE]} upscaled images</strong> across 3 different scales ({summary['attempts']} attempts)</li>
             <li><strong>{len(comparison_images)} comparison grids</strong> for easy quality assessment</li>
             <li><strong>Organized directory structure</strong> for easy access</li>
         </ul>
@@ -372,13 +768,38 @@ class PASDBatchProcessor:
             print("No images found to process!")
             return
         
+        if self.resume and self.ledger.get_meta("cascade", str(self.cascade)) != str(self.cascade):
+            print("Warning: --cascade differs from the run being resumed; finished jobs are kept as they are")
+        self.ledger.set_meta("cascade", self.cascade)
+        
+        # Register every (image, scale) job; without --resume they are all queued again
+        recovered = self.ledger.recover()
+        if recovered:
+            print(f"Recovered {recovered} jobs interrupted by a previous crash")
+        for set_name, images in image_sets.items():
+            for image_path in images:
+                for scale in self.scales:
+                    self.ledger.add_job(image_path, set_name, scale, reset=not self.resume)
+        
         print(f"\\nStarting to process {self.stats['total_images']} images...")
         print(f"Expected outputs: {self.stats['total_images'] * 3} upscaled images + comparisons")
         
-        # Process each set
-        for set_name, images in image_sets.items():
-            if images:
-                self.process_image_set(images, set_name)
+        if self.devices:
+            # One resident worker per device; jobs are dispatched longest-first
+            self.pool = WorkerPool.launch(self.devices, self.worker_args(), base_port=self.base_port, cpu_threads=self.cpu_threads)
+            try:
+                for client in self.pool.clients:
+                    config = client.config()
+                    if config not in self.pool_configs:
+                        self.pool_configs.append(config)
+                self.run_with_pool(image_sets)
+            finally:
+                self.pool.shutdown()
+        else:
+            # Process each set
+            for set_name, images in image_sets.items():
+                if images:
+                    self.process_image_set(images, set_name)
         
         # Generate final report
         self.generate_report()
@@ -391,13 +812,40 @@ class PASDBatchProcessor:
         print(f"Total images processed: {self.stats['total_images']}")
         print(f"Successful upscales: {self.stats['processed']}")
         print(f"Failed upscales: {self.stats['failed']}")
+        print(f"Served from cache: {self.stats['cache_hits']}")
+        for stage in ("process", "job", "model_load", "denoise"):
+            if stage in self.stats["peak_memory"]:
+                peak = self.stats["peak_memory"][stage]
+                cuda_peak = "" if peak["peak_cuda_mb"] is None else f", GPU {peak['peak_cuda_mb']:.0f} MB"
+                print(f"Peak memory ({stage}): RSS {peak['peak_rss_mb'] or 0:.0f} MB{cuda_peak}")
+        for name, u in self.stats.get("worker_utilisation", {}).items():
+            print(f"Worker {name}: {u['jobs']} jobs, {u['utilisation']*100:.1f}% busy")
         print(f"Total processing time: {total_time/60:.1f} minutes")
         print(f"Results saved in: {self.results_dir}")
         print("Check processing_report.html for detailed results")
         print("="*60)
 
 def main():
-    processor = PASDBatchProcessor()
+    parser = argparse.ArgumentParser(description="PASD full batch processing")
+    parser.add_argument("--worker", type=str, default=None, help="host:port of a running pasd_worker.py (default: one subprocess per job)")
+    parser.add_argument("--cache_size_gb", type=float, default=20, help="size limit of the output cache in PASD-results/.cache")
+    parser.add_argument("--resume", action="store_true", help="only dispatch jobs not finished in PASD-results/jobs.sqlite")
+    parser.add_argument("--max_attempts", type=int, default=3, help="attempts per job before it is marked failed")
+    parser.add_argument("--retry_backoff", type=float, default=30.0, help="seconds before the first retry, doubled each attempt")
+    parser.add_argument("--devices", type=str, default=None, help="comma-separated GPU indices and/or 'cpu' entries, one pool worker each (e.g. 0,1 or cpu,cpu)")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="torch threads per CPU pool worker")
+    parser.add_argument("--cascade", action="store_true", help="make 4x from the 2x output and 8x from the 4x output instead of from the original")
+    parser.add_argument("--cascade_steps", type=int, default=10, help="denoising steps of the cascaded 4x and 8x stages")
+    parser.add_argument("--base_port", type=int, default=7870, help="first port used by the pool workers")
+    args = parser.parse_args()
+
+    processor = PASDBatchProcessor(
+        worker_address=args.worker, cache_size_gb=args.cache_size_gb,
+        resume=args.resume, max_attempts=args.max_attempts, retry_backoff=args.retry_backoff,
+        devices=args.devices.split(",") if args.devices else None,
+        cpu_threads=args.cpu_threads, base_port=args.base_port,
+        cascade=args.cascade, cascade_steps=args.cascade_steps,
+    )
     processor.run()
 
 if __name__ == "__main__":
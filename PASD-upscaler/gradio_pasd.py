@@ -1,26 +1,26 @@
 import os
-import einops
 import gradio as gr
 import numpy as np
 import torch
 import random
+import tempfile
 from PIL import Image
 from pathlib import Path
 from torchvision import transforms
-import torch.nn.functional as F
 from torchvision.models import resnet50, ResNet50_Weights
 
-from pytorch_lightning import seed_everything
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPImageProcessor
-from diffusers import AutoencoderKL, DDIMScheduler, PNDMScheduler, DPMSolverMultistepScheduler, UniPCMultistepScheduler
+from diffusers import AutoencoderKL, UniPCMultistepScheduler
 
 from pasd.pipelines.pipeline_pasd import StableDiffusionControlNetPipeline
-from pasd.myutils.misc import load_dreambooth_lora, rand_name
+from pasd.myutils.misc import load_dreambooth_lora
 from pasd.myutils.wavelet_color_fix import wavelet_color_fix
-from pasd.annotator.retinaface import RetinaFaceDetection
+from pasd_worker import PASDWorkerClient
+from prompt_cache import PromptEmbeddingCache
+import cpu_backend
+import perf_profile
 
 use_pasd_light = False
-face_detector = RetinaFaceDetection()
 
 if use_pasd_light:
     from pasd.models.pasd_light.unet_2d_condition import UNet2DConditionModel
@@ -34,46 +34,92 @@ ckpt_path = "runs/pasd/checkpoint-100000"
 #dreambooth_lora_path = "checkpoints/personalized_models/toonyou_beta3.safetensors"
 dreambooth_lora_path = "checkpoints/personalized_models/majicmixRealistic_v6.safetensors"
 #dreambooth_lora_path = "checkpoints/personalized_models/Realistic_Vision_V5.1.safetensors"
-weight_dtype = torch.float16
-device = "cuda"
-
-scheduler = UniPCMultistepScheduler.from_pretrained(pretrained_model_path, subfolder="scheduler")
-text_encoder = CLIPTextModel.from_pretrained(pretrained_model_path, subfolder="text_encoder")
-tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_path, subfolder="tokenizer")
-vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae")
-feature_extractor = CLIPImageProcessor.from_pretrained(f"{pretrained_model_path}/feature_extractor")
-unet = UNet2DConditionModel.from_pretrained(ckpt_path, subfolder="unet")
-controlnet = ControlNetModel.from_pretrained(ckpt_path, subfolder="controlnet")
-vae.requires_grad_(False)
-text_encoder.requires_grad_(False)
-unet.requires_grad_(False)
-controlnet.requires_grad_(False)
-
-unet, vae, text_encoder = load_dreambooth_lora(unet, vae, text_encoder, dreambooth_lora_path)
-
-text_encoder.to(device, dtype=weight_dtype)
-vae.to(device, dtype=weight_dtype)
-unet.to(device, dtype=weight_dtype)
-controlnet.to(device, dtype=weight_dtype)
-
-validation_pipeline = StableDiffusionControlNetPipeline(
-        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, feature_extractor=feature_extractor, 
-        unet=unet, controlnet=controlnet, scheduler=scheduler, safety_checker=None, requires_safety_checker=False,
-    )
-#validation_pipeline.enable_vae_tiling()
-validation_pipeline._init_tiled_vae(decoder_tile_size=224)
-
-weights = ResNet50_Weights.DEFAULT
-preprocess = weights.transforms()
-resnet = resnet50(weights=weights)
-resnet.eval()
+device = cpu_backend.resolve_device()
+# fp16 on the GPU; bf16 on CPUs with native support, fp32 otherwise
+if device == "cuda":
+    weight_dtype = torch.float16
+else:
+    weight_dtype = torch.bfloat16 if cpu_backend.cpu_supports_bf16() else torch.float32
+
+# Set PASD_WORKER=host:port to forward requests to a resident pasd_worker.py
+# instead of loading a second copy of the models in this process.
+worker = PASDWorkerClient(os.environ["PASD_WORKER"]) if os.getenv("PASD_WORKER") else None
+
+if worker is None:
+    scheduler = UniPCMultistepScheduler.from_pretrained(pretrained_model_path, subfolder="scheduler")
+    text_encoder = CLIPTextModel.from_pretrained(pretrained_model_path, subfolder="text_encoder")
+    tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_path, subfolder="tokenizer")
+    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae")
+    feature_extractor = CLIPImageProcessor.from_pretrained(f"{pretrained_model_path}/feature_extractor")
+    unet = UNet2DConditionModel.from_pretrained(ckpt_path, subfolder="unet")
+    controlnet = ControlNetModel.from_pretrained(ckpt_path, subfolder="controlnet")
+    vae.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    unet.requires_grad_(False)
+    controlnet.requires_grad_(False)
+
+    unet, vae, text_encoder = load_dreambooth_lora(unet, vae, text_encoder, dreambooth_lora_path)
+
+    text_encoder.to(device, dtype=weight_dtype)
+    vae.to(device, dtype=weight_dtype)
+    unet.to(device, dtype=weight_dtype)
+    controlnet.to(device, dtype=weight_dtype)
+
+    validation_pipeline = StableDiffusionControlNetPipeline(
+            vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, feature_extractor=feature_extractor, 
+            unet=unet, controlnet=controlnet, scheduler=scheduler, safety_checker=None, requires_safety_checker=False,
+        )
+    #validation_pipeline.enable_vae_tiling()
+    # Calibrated VAE tiles and attention backend of this machine (quick_test.py --calibrate)
+    profile = perf_profile.load_profile(device=device)
+    precision = {torch.float16: "fp16", torch.bfloat16: "bf16"}.get(weight_dtype, "no")
+    vae_tiles = perf_profile.update_params({"decoder_tiled_size": 224}, profile, precision, add=True)
+    tile_kwargs = {"decoder_tile_size": vae_tiles["decoder_tiled_size"]}
+    if "encoder_tiled_size" in vae_tiles:
+        tile_kwargs["encoder_tile_size"] = vae_tiles["encoder_tiled_size"]
+    validation_pipeline._init_tiled_vae(**tile_kwargs)
+    if profile is not None and profile["recommended"].get("attention") == "xformers":
+        unet.enable_xformers_memory_efficient_attention()
+        controlnet.enable_xformers_memory_efficient_attention()
+    if device == "cpu":
+        cpu_backend.optimize_pipeline(validation_pipeline)
+    # Requests usually repeat the added and negative prompts
+    PromptEmbeddingCache(max_entries=64).wrap(validation_pipeline)
+
+    weights = ResNet50_Weights.DEFAULT
+    preprocess = weights.transforms()
+    resnet = resnet50(weights=weights)
+    resnet.eval()
+
+def inference_with_worker(input_image, prompt, a_prompt, n_prompt, denoise_steps, upscale, alpha, cfg, seed):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, "input.png")
+        input_image.convert('RGB').save(input_path)
+        try:
+            output_path = worker.upscale(
+                input_path, tmp_dir, "output.png", upscale=int(upscale), prompt=prompt, added_prompt=a_prompt,
+                negative_prompt=n_prompt, num_inference_steps=int(denoise_steps), conditioning_scale=alpha,
+                guidance_scale=cfg, seed=int(seed),
+            )
+            image = Image.open(output_path)
+            image.load()
+        except Exception as e:
+            print(e)
+            image = Image.new(mode="RGB", size=(512, 512))
+    return image
 
 def inference(input_image, prompt, a_prompt, n_prompt, denoise_steps, upscale, alpha, cfg, seed):
+    if worker is not None:
+        return inference_with_worker(input_image, prompt, a_prompt, n_prompt, denoise_steps, upscale, alpha, cfg, seed)
+
     process_size = 768
     resize_preproc = transforms.Compose([
         transforms.Resize(process_size, interpolation=transforms.InterpolationMode.BILINEAR),
     ])
 
+    # pytorch_lightning is only needed here; importing it costs seconds at startup
+    from pytorch_lightning import seed_everything
+
     with torch.no_grad():
         seed_everything(seed)
         generator = torch.Generator(device=device)
@@ -103,10 +149,11 @@ def inference(input_image, prompt, a_prompt, n_prompt, denoise_steps, upscale, a
         resize_flag = True #
 
         try:
-            image = validation_pipeline(
-                    None, prompt, input_image, num_inference_steps=denoise_steps, generator=generator, height=height, width=width, guidance_scale=cfg, 
-                    negative_prompt=n_prompt, conditioning_scale=alpha, eta=0.0,
-                ).images[0]
+            with cpu_backend.autocast(device, "bf16" if weight_dtype == torch.bfloat16 else "no"):
+                image = validation_pipeline(
+                        None, prompt, input_image, num_inference_steps=denoise_steps, generator=generator, height=height, width=width, guidance_scale=cfg, 
+                        negative_prompt=n_prompt, conditioning_scale=alpha, eta=0.0,
+                    ).images[0]
             
             if True: #alpha<1.0:
                 image = wavelet_color_fix(image, input_image)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Persistent job ledger for PASD batch runs
+One SQLite row per (image, scale) with state, attempts, timings and output hash, so a crash
+or OOM partway through a run loses nothing and --resume only dispatches unfinished jobs.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class JobLedger:
+    """SQLite-backed table of batch jobs; every state change is committed immediately"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.db_path))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " image_path TEXT NOT NULL, set_name TEXT, scale INTEGER NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+            " output_path TEXT, output_hash TEXT, cache_hit INTEGER NOT NULL DEFAULT 0,"
+            " queued_at REAL, started_at REAL, finished_at REAL, duration REAL, error TEXT,"
+            " UNIQUE(image_path, scale))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS comparisons ("
+            " image_path TEXT PRIMARY KEY, set_name TEXT, comparison_path TEXT, created_at REAL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Per-stage memory peaks (JSON), added after the first ledger version
+        columns = [row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "memory" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN memory TEXT")
+        self.db.commit()
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def add_job(self, image_path, set_name, scale, reset=False):
+        """Register a job; with reset=True an existing row is queued again"""
+        now = time.time()
+        self.db.execute(
+            "INSERT OR IGNORE INTO jobs (image_path, set_name, scale, queued_at) VALUES (?, ?, ?, ?)",
+            (str(image_path), set_name, scale, now),
+        )
+        if reset:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, error = NULL, queued_at = ? WHERE image_path = ? AND scale = ?",
+                (PENDING, now, str(image_path), scale),
+            )
+        self.db.commit()
+
+    def recover(self):
+        """Jobs left 'running' by a crashed run go back to the queue"""
+        count = self.db.execute("UPDATE jobs SET state = ? WHERE state = ?", (PENDING, RUNNING)).rowcount
+        self.db.commit()
+        return count
+
+    def get(self, image_path, scale):
+        return self.db.execute(
+            "SELECT * FROM jobs WHERE image_path = ? AND scale = ?", (str(image_path), scale)
+        ).fetchone()
+
+    def start(self, image_path, scale):
+        self.db.execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ? WHERE image_path = ? AND scale = ?",
+            (RUNNING, time.time(), str(image_path), scale),
+        )
+        self.db.commit()
+
+    def finish(self, image_path, scale, output_path, duration, cache_hit=False, output_hash=None, memory=None):
+        """Mark a job done; the output hash is taken from the result manifest when available
+
+        memory: {stage: {"peak_rss_mb", "peak_cuda_mb"}} reported by the job, if any
+        """
+        if output_hash is None:
+            output_hash = file_sha256(output_path)
+        self.db.execute(
+            "UPDATE jobs SET state = ?, output_path = ?, output_hash = ?, cache_hit = ?, finished_at = ?,"
+            " duration = ?, error = NULL, memory = ? WHERE image_path = ? AND scale = ?",
+            (DONE, str(output_path), output_hash, int(cache_hit), time.time(), duration,
+             json.dumps(memory) if memory else None, str(image_path), scale),
+        )
+        self.db.commit()
+
+    def fail(self, image_path, scale, error, final=True):
+        """Record a failed attempt; non-final failures go back to pending for a retry"""
+        self.db.execute(
+            "UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE image_path = ? AND scale = ?",
+            (FAILED if final else PENDING, error, time.time(), str(image_path), scale),
+        )
+        self.db.commit()
+
+    def add_comparison(self, image_path, set_name, comparison_path):
+        self.db.execute(
+            "INSERT OR REPLACE INTO comparisons (image_path, set_name, comparison_path, created_at) VALUES (?, ?, ?, ?)",
+            (str(image_path), set_name, str(comparison_path), time.time()),
+        )
+        self.db.commit()
+
+    def jobs(self, state=None):
+        if state is None:
+            return self.db.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return self.db.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,)).fetchall()
+
+    def images(self):
+        """(image_path, set_name) of every image with at least one job"""
+        return [
+            (row["image_path"], row["set_name"])
+            for row in self.db.execute("SELECT image_path, set_name, MIN(id) FROM jobs GROUP BY image_path ORDER BY MIN(id)")
+        ]
+
+    def outputs_for_image(self, image_path):
+        """{scale: output_path} of the finished jobs of one image"""
+        rows = self.db.execute(
+            "SELECT scale, output_path FROM jobs WHERE image_path = ? AND state = ?", (str(image_path), DONE)
+        )
+        return {row["scale"]: row["output_path"] for row in rows}
+
+    def durations_by_scale(self):
+        """{scale: [duration]} of the jobs that actually ran (cache hits excluded)"""
+        durations = {}
+        for row in self.db.execute(
+            "SELECT scale, duration FROM jobs WHERE state = ? AND cache_hit = 0 AND duration IS NOT NULL", (DONE,)
+        ):
+            durations.setdefault(row["scale"], []).append(row["duration"])
+        return durations
+
+    def memory_by_scale(self):
+        """{scale: [per-stage memory peaks of one job]} of the jobs that reported memory"""
+        memory = {}
+        for row in self.db.execute("SELECT scale, memory FROM jobs WHERE state = ? AND memory IS NOT NULL", (DONE,)):
+            memory.setdefault(row["scale"], []).append(json.loads(row["memory"]))
+        return memory
+
+    def comparisons(self):
+        return self.db.execute("SELECT * FROM comparisons ORDER BY created_at").fetchall()
+
+    def summary(self):
+        counts = {state: 0 for state in (PENDING, RUNNING, DONE, FAILED)}
+        for row in self.db.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+            counts[row["state"]] = row["n"]
+        durations = [
+            row["duration"] for row in self.db.execute(
+                "SELECT duration FROM jobs WHERE state = ? AND cache_hit = 0 AND duration IS NOT NULL", (DONE,)
+            )
+        ]
+        counts["cache_hits"] = self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = ? AND cache_hit = 1", (DONE,)
+        ).fetchone()[0]
+        counts["images"] = self.db.execute("SELECT COUNT(DISTINCT image_path) FROM jobs").fetchone()[0]
+        counts["attempts"] = self.db.execute("SELECT COALESCE(SUM(attempts), 0) FROM jobs").fetchone()[0]
+        counts["durations"] = durations
+        return counts
+
+    def close(self):
+        self.db.close()
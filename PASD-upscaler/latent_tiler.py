@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Tile planning and weighted overlap blending for latents
+TilePlan covers a height x width latent with equally sized tiles of at most tile_size,
+overlapping their neighbours by at least overlap and spread evenly (no sliver tiles at the
+far edges). split cuts a latent into its tiles and blend merges per-tile results back,
+weighting every tile with a Gaussian or cosine window (normalised per pixel in float64,
+so fp16 and bf16 tiles blend without NaNs); both are single gather/index_add calls over
+all tiles. Independent of the PASD pipeline, so it runs and is checked on the
+CPU (benchmarks/bench_latent_tiler.py --check).
+"""
+import math
+
+import torch
+
+WINDOWS = ("gaussian", "cosine")
+
+
+def tile_starts(length, tile, overlap):
+    """Start offsets of tiles of size tile covering length with at least overlap between neighbours"""
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def gaussian_window(size, sigma):
+    """Bell curve over size samples; sigma is relative to size (0.1: edges weigh ~4e-6)"""
+    x = (torch.arange(size, dtype=torch.float64) + 0.5) / size - 0.5
+    return torch.exp(-0.5 * (x / sigma) ** 2)
+
+
+def cosine_window(size, ramp_before, ramp_after):
+    """1 in the middle, raised-cosine ramps over the overlaps with the previous / next tile.
+    Ramps of neighbours over the same samples sum to exactly 1."""
+    window = torch.ones(size, dtype=torch.float64)
+    if ramp_before > 0:
+        x = (torch.arange(ramp_before, dtype=torch.float64) + 0.5) / ramp_before
+        window[:ramp_before] *= 0.5 - 0.5 * torch.cos(math.pi * x)
+    if ramp_after > 0:
+        x = (torch.arange(ramp_after, dtype=torch.float64) + 0.5) / ramp_after
+        window[size - ramp_after:] *= 0.5 + 0.5 * torch.cos(math.pi * x)
+    return window
+
+
+class TilePlan:
+    """Tiles of a height x width latent
+
+    tile_size: largest tile side (clamped to the latent); overlap: minimum overlap between
+    neighbouring tiles (larger: smoother seams, more tiles). window: "gaussian" or "cosine".
+    """
+
+    def __init__(self, height, width, tile_size, overlap=8, window="gaussian", sigma=0.1):
+        if window not in WINDOWS:
+            raise ValueError(f"window must be one of {WINDOWS}, not {window!r}")
+        self.height, self.width = height, width
+        self.tile_height, self.tile_width = min(tile_size, height), min(tile_size, width)
+        if overlap >= tile_size and (height > tile_size or width > tile_size):
+            raise ValueError(f"overlap {overlap} must be smaller than the tile size {tile_size}")
+        self.overlap = overlap
+        self.window = window
+        self.sigma = sigma
+        self.tops = tile_starts(height, self.tile_height, overlap)
+        self.lefts = tile_starts(width, self.tile_width, overlap)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.tops) * len(self.lefts)
+
+    @property
+    def tiles(self):
+        """(top, left) of every tile, row by row"""
+        return [(top, left) for top in self.tops for left in self.lefts]
+
+    def axis_windows(self, starts, tile):
+        """One window per start offset along an axis"""
+        if self.window == "gaussian":
+            return [gaussian_window(tile, self.sigma)] * len(starts)
+        windows = []
+        for i, start in enumerate(starts):
+            before = starts[i - 1] + tile - start if i > 0 else 0
+            after = start + tile - starts[i + 1] if i + 1 < len(starts) else 0
+            windows.append(cosine_window(tile, before, after))
+        return windows
+
+    def state(self, device):
+        """Pixel indices (N, h*w), tile weights (N, h*w) and the per-pixel sum of the raw
+        window weights (H*W) on device. The weights are divided by that sum in float64, so
+        the ones covering a pixel add up to 1: Gaussian corner weights (~1e-11) would round
+        to 0 in fp16 and turn a division at blend time into 0/0."""
+        key = str(device)
+        if key not in self._cache:
+            rows = torch.tensor(self.tops).view(-1, 1, 1, 1) + torch.arange(self.tile_height).view(1, 1, -1, 1)
+            cols = torch.tensor(self.lefts).view(1, -1, 1, 1) + torch.arange(self.tile_width).view(1, 1, 1, -1)
+            # (rows, cols, h, w) -> (N, h*w) flat indices into the H*W latent
+            index = (rows * self.width + cols).reshape(len(self), -1)
+            row_windows = torch.stack(self.axis_windows(self.tops, self.tile_height))
+            col_windows = torch.stack(self.axis_windows(self.lefts, self.tile_width))
+            weights = (row_windows[:, None, :, None] * col_windows[None, :, None, :]).reshape(len(self), -1)
+            total = torch.zeros(self.height * self.width, dtype=torch.float64).index_add_(0, index.flatten(), weights.flatten())
+            weights = weights / total[index]
+            self._cache[key] = (index.to(device), weights.to(device), total.to(device))
+        return self._cache[key]
+
+    def split(self, latents):
+        """(B, C, H, W) -> (N, B, C, h, w) tiles in the order of self.tiles"""
+        batch, channels = latents.shape[:2]
+        index = self.state(latents.device)[0]
+        tiles = latents.reshape(batch, channels, -1)[:, :, index.flatten()]
+        return tiles.view(batch, channels, len(self), self.tile_height, self.tile_width).permute(2, 0, 1, 3, 4)
+
+    def blend(self, tiles):
+        """(N, B, C, h, w) per-tile results -> (B, C, H, W), weighted by the tile windows"""
+        count, batch, channels = tiles.shape[:3]
+        index, weights = self.state(tiles.device)[:2]
+        # fp16 / bf16 tiles are summed in float32 and cast back
+        dtype = torch.float32 if tiles.dtype in (torch.float16, torch.bfloat16) else tiles.dtype
+        weighted = tiles.reshape(count, batch, channels, -1).to(dtype) * weights[:, None, None, :].to(dtype)
+        weighted = weighted.permute(1, 2, 0, 3).reshape(batch, channels, -1)
+        out = torch.zeros(batch, channels, self.height * self.width, dtype=dtype, device=tiles.device)
+        out.index_add_(2, index.flatten(), weighted)
+        return out.view(batch, channels, self.height, self.width).to(tiles.dtype)
+
+    def apply(self, fn, latents, tiles_per_call=1):
+        """blend(fn(tile batch)) over all tiles; fn takes and returns (k*B, C, h, w)"""
+        tiles = self.split(latents)
+        count, batch = tiles.shape[:2]
+        outputs = []
+        for start in range(0, count, tiles_per_call):
+            chunk = tiles[start:start + tiles_per_call]
+            result = fn(chunk.reshape(-1, *chunk.shape[2:]))
+            outputs.append(result.view(len(chunk), batch, *result.shape[1:]))
+        return self.blend(torch.cat(outputs))
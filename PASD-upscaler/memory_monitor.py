@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Memory high-water marks for PASD jobs
+Peak process RSS is sampled by a background thread while stages are running; peak
+accelerator memory comes from torch.cuda's peak counters, kept correct across nested
+stages.
+"""
+import os
+import time
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def lifetime_peak_rss_mb():
+    """Peak RSS of this process since it started"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return peak / 2**20 if os.uname().sysname == "Darwin" else peak / 2**10
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return lifetime_peak_rss_mb()
+
+
+class MemoryMonitor:
+    """Tracks peak RSS and peak accelerator memory between begin() and end()
+
+    cuda: the torch.cuda module to also track accelerator memory, or None.
+    Accelerator tracking resets the global peak counter, so it is only used for stages
+    on the thread that drives the accelerator (begin(accelerator=True)).
+    """
+
+    def __init__(self, cuda=None, interval=0.02):
+        self.cuda = cuda
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.next_token = 0
+        self.local = threading.local()
+        self.sampler = None
+
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                rss = current_rss_mb()
+                for token in self.active:
+                    self.active[token] = max(self.active[token], rss)
+
+    def begin(self, accelerator=False):
+        with self.lock:
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample, daemon=True)
+                self.sampler.start()
+            token = self.next_token
+            self.next_token += 1
+            self.active[token] = current_rss_mb() or 0.0
+        cuda_stack = None
+        if accelerator and self.cuda is not None:
+            # Fold the running peak into the enclosing stage before resetting the counter
+            cuda_stack = getattr(self.local, "cuda_stack", [])
+            self.local.cuda_stack = cuda_stack
+            if cuda_stack:
+                cuda_stack[-1] = max(cuda_stack[-1], self.cuda.max_memory_allocated())
+            self.cuda.reset_peak_memory_stats()
+            cuda_stack.append(self.cuda.memory_allocated())
+        return token, cuda_stack
+
+    def end(self, handle):
+        """{"peak_rss_mb": ..., "peak_cuda_mb": ... or None} of the stage started by begin()"""
+        token, cuda_stack = handle
+        with self.lock:
+            peak_rss = max(self.active.pop(token), current_rss_mb() or 0.0)
+        peak_cuda = None
+        if cuda_stack is not None:
+            peak = max(cuda_stack.pop(), self.cuda.max_memory_allocated())
+            if cuda_stack:
+                cuda_stack[-1] = max(cuda_stack[-1], peak)
+            peak_cuda = peak / 2**20
+        return {"peak_rss_mb": peak_rss, "peak_cuda_mb": peak_cuda}
+
+
+def merge_peaks(peaks, more):
+    """Stage-wise maximum of two {stage: {"peak_rss_mb", "peak_cuda_mb"}} dicts (into peaks)"""
+    for stage, values in more.items():
+        merged = peaks.setdefault(stage, {"peak_rss_mb": None, "peak_cuda_mb": None})
+        for key, value in values.items():
+            if value is not None:
+                merged[key] = value if merged.get(key) is None else max(merged[key], value)
+    return peaks
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Single-file PASD model bundle
+pack: builds the pipeline once with load_pasd_pipeline (so personalized and LCM LoRAs are
+fused and every weight is cast to --mixed_precision), then writes all weights into one
+safetensors file; module classes and configs, the scheduler, tokenizer files and the
+feature extractor config go into its metadata.
+load_bundle: maps that file and creates each module directly on the target device in its
+stored dtype, without fp32 random initialisation or a host-side copy of every weight.
+
+Usage (from PASD-upscaler/):
+    python model_bundle.py --output checkpoints/pasd_bundle_fp16.safetensors --pasd_model_path runs/pasd/pasd/checkpoint-100000
+    python test_pasd.py --model_bundle checkpoints/pasd_bundle_fp16.safetensors --image_path examples/Set5
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import importlib
+from types import SimpleNamespace
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+BUNDLE_FORMAT = "pasd-bundle-1"
+MODULES = ("unet", "controlnet", "vae", "text_encoder")
+# Settings baked into the weights; a run asking for different ones gets a warning
+BAKED_SETTINGS = ("pretrained_model_path", "pasd_model_path", "control_type", "mixed_precision", "use_pasd_light",
+                  "use_lcm_lora", "lcm_lora_path", "use_personalized_model", "personalized_model_path",
+                  "blending_alpha", "multiplier")
+
+
+def class_path(obj):
+    cls = obj if isinstance(obj, type) else type(obj)
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def import_class(path):
+    module_name, _, class_name = path.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def module_spec(module):
+    """Class and config of a diffusers or transformers model"""
+    if hasattr(module.config, "to_dict"):  # transformers PretrainedConfig
+        return {"class": class_path(module), "config_class": class_path(module.config), "config": module.config.to_dict()}
+    return {"class": class_path(module), "config": dict(module.config)}
+
+
+def pack(args, output_path):
+    """Write the bundle for the model settings in args"""
+    from test_pasd import load_pasd_pipeline
+
+    args = argparse.Namespace(**{**vars(args), "model_bundle": None, "onnx_dir": None, "tile_workers": None, "prompt_cache_size": 0})
+    # Build and cast on the CPU; load_pasd_pipeline only needs device and mixed_precision
+    target = SimpleNamespace(device=torch.device("cpu"), mixed_precision=args.mixed_precision)
+    pipeline = load_pasd_pipeline(args, target, False)
+    if args.use_lcm_lora and hasattr(pipeline, "unload_lora_weights"):
+        # The LoRA is fused into the base weights; drop its now redundant layers
+        pipeline.unload_lora_weights()
+
+    tensors, specs = {}, {}
+    for name in MODULES:
+        module = getattr(pipeline, name)
+        specs[name] = module_spec(module)
+        for key, value in module.state_dict().items():
+            if "lora" in key:
+                continue
+            tensors[f"{name}.{key}"] = value.detach().contiguous()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pipeline.tokenizer.save_pretrained(tmp_dir)
+        tokenizer_files = {}
+        for file_name in os.listdir(tmp_dir):
+            with open(os.path.join(tmp_dir, file_name)) as f:
+                tokenizer_files[file_name] = f.read()
+
+    metadata = {
+        "format": BUNDLE_FORMAT,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "modules": json.dumps(specs, default=str),
+        "scheduler": json.dumps({"class": class_path(pipeline.scheduler), "config": dict(pipeline.scheduler.config)}, default=str),
+        "tokenizer": json.dumps({"class": class_path(pipeline.tokenizer), "files": tokenizer_files}),
+        "feature_extractor": json.dumps({"class": class_path(pipeline.feature_extractor), "config": pipeline.feature_extractor.to_dict()}, default=str),
+        "settings": json.dumps({name: getattr(args, name) for name in BAKED_SETTINGS}, default=str),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.tmp"
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def load_bundle(path, device, args=None):
+    """Pipeline components from a bundle, created on device; args (optional) is checked
+    against the settings the bundle was packed with"""
+    from accelerate import init_empty_weights
+
+    with safe_open(path, framework="pt", device=str(device)) as f:
+        metadata = f.metadata()
+        if metadata.get("format") != BUNDLE_FORMAT:
+            raise ValueError(f"{path} is not a PASD model bundle")
+        settings = json.loads(metadata["settings"])
+        if args is not None:
+            for name in BAKED_SETTINGS:
+                if name in ("pretrained_model_path", "pasd_model_path"):
+                    continue
+                if str(getattr(args, name, None)) != str(settings.get(name)):
+                    print(f"Warning: {path} was packed with --{name} {settings.get(name)}, not {getattr(args, name, None)}")
+
+        keys = list(f.keys())
+        components = {}
+        for name, spec in json.loads(metadata["modules"]).items():
+            prefix = f"{name}."
+            # Weights go straight from the mapped file to the device in their stored dtype
+            state = {key[len(prefix):]: f.get_tensor(key) for key in keys if key.startswith(prefix)}
+            cls = import_class(spec["class"])
+            with init_empty_weights():
+                if "config_class" in spec:
+                    module = cls(import_class(spec["config_class"]).from_dict(spec["config"]))
+                else:
+                    module = cls.from_config(spec["config"])
+            module.load_state_dict(state, strict=True, assign=True)
+            # Non-persistent buffers were created on the CPU
+            module.to(device)
+            module.requires_grad_(False)
+            module.eval()
+            components[name] = module
+
+    scheduler = json.loads(metadata["scheduler"])
+    components["scheduler"] = import_class(scheduler["class"]).from_config(scheduler["config"])
+
+    tokenizer = json.loads(metadata["tokenizer"])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file_name, content in tokenizer["files"].items():
+            with open(os.path.join(tmp_dir, file_name), "w") as f:
+                f.write(content)
+        components["tokenizer"] = import_class(tokenizer["class"]).from_pretrained(tmp_dir)
+
+    feature_extractor = json.loads(metadata["feature_extractor"])
+    components["feature_extractor"] = import_class(feature_extractor["class"]).from_dict(feature_extractor["config"])
+    return components
+
+
+def main():
+    from test_pasd import build_parser
+
+    parser = build_parser()
+    parser.description = "Pack the PASD pipeline selected by the test_pasd.py model options into one safetensors bundle"
+    parser.add_argument("--output", type=str, required=True, help="bundle file to write (.safetensors)")
+    args = parser.parse_args()
+
+    start = time.time()
+    pack(args, args.output)
+    size_gb = os.path.getsize(args.output) / 1024**3
+    print(f"[OK] Wrote {args.output} ({size_gb:.2f} GB, {args.mixed_precision}) in {time.time() - start:.1f}s")
+    print(f"Use it with: python test_pasd.py --model_bundle {args.output}")
+
+
+if __name__ == "__main__":
+    main()
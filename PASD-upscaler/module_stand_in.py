@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Weightless stand-ins for pipeline modules
+stand_in builds an object of a module's own class (with a mixin's methods first), so the
+pipeline's isinstance checks and config lookups still pass while calls go elsewhere: to an
+onnxruntime session (onnx_backend.py) or to tile-parallel workers (tile_parallel.py).
+"""
+import torch
+
+# Instance attributes not copied: the tiled VAE hook's forward / original_forward
+# (_init_tiled_vae) would shadow the mixin's forward and keep calling (and holding) the
+# PyTorch module
+SKIPPED_ATTRIBUTES = ("forward", "original_forward")
+
+
+def stand_in(module, mixin, **attributes):
+    """Weightless stand-in for module: same class (with mixin's methods first), config and
+    plain attributes, plus attributes"""
+    cls = type(module)
+    stand_in_cls = type(f"{mixin.__name__}{cls.__name__}", (mixin, cls), {"__module__": cls.__module__})
+    replacement = stand_in_cls.__new__(stand_in_cls)
+    torch.nn.Module.__init__(replacement)
+    for key, value in vars(module).items():
+        if key in SKIPPED_ATTRIBUTES:
+            continue
+        if key == "_internal_dict" or not key.startswith("_"):
+            replacement.__dict__[key] = value
+    replacement.__dict__.update(attributes)
+    return replacement
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime backend for the PASD UNet, ControlNet and VAE
+export: builds the pipeline with load_pasd_pipeline in fp32 on the CPU and runs one small
+pipeline call that records how the UNet, the ControlNet (with its pixel-aware conditioning
+input) and the VAE encoder/decoder are called: tensor inputs, constant options and the
+structure of their outputs. Each is then exported with torch.onnx, checked against the
+PyTorch module on the recorded inputs and, with --quantize, also written as an int8
+dynamically quantised copy (MatMul/Gemm weights, i.e. attention and linear layers).
+load_onnx_modules: used by load_pasd_pipeline --onnx_dir; replaces those modules with
+onnxruntime sessions on the CPU execution provider with every graph optimisation on. The
+VAE is not tiled on this backend.
+
+Usage (from PASD-upscaler/):
+    python onnx_backend.py --onnx_output onnx/pasd --pasd_model_path runs/pasd/pasd/checkpoint-100000 --quantize
+    python test_pasd.py --onnx_dir onnx/pasd --onnx_int8 --device cpu --image_path examples/Set5
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+from types import SimpleNamespace
+
+import torch
+from PIL import Image
+
+from model_bundle import BAKED_SETTINGS, class_path, import_class
+from module_stand_in import stand_in
+
+SPEC_FILE = "onnx_spec.json"
+SPEC_FORMAT = "pasd-onnx-1"
+# Exported module -> its attribute path on the pipeline
+TARGETS = {"unet": "unet", "controlnet": "controlnet", "vae_encoder": "vae.encoder", "vae_decoder": "vae.decoder"}
+
+
+def flatten(value, tensors):
+    """JSON template of a call argument or result; its tensors are appended to tensors"""
+    if torch.is_tensor(value):
+        tensors.append(value)
+        return ["tensor", len(tensors) - 1]
+    if value is None or isinstance(value, (bool, str)):
+        return ["const", value]
+    if isinstance(value, (int, float)):
+        # Numbers such as conditioning_scale stay graph inputs instead of being baked in
+        tensors.append(torch.tensor(value, dtype=torch.int64 if isinstance(value, int) else torch.float32))
+        return ["tensor", len(tensors) - 1]
+    if hasattr(value, "to_tuple"):  # diffusers BaseOutput
+        return ["output", class_path(value), {key: flatten(item, tensors) for key, item in value.items()}]
+    if isinstance(value, dict):
+        return ["dict", {key: flatten(value[key], tensors) for key in sorted(value)}]
+    if isinstance(value, (list, tuple)):
+        return ["tuple" if isinstance(value, tuple) else "list", [flatten(item, tensors) for item in value]]
+    raise TypeError(f"cannot export a call argument of type {type(value).__name__}")
+
+
+def rebuild(template, tensors):
+    """Inverse of flatten"""
+    kind = template[0]
+    if kind == "tensor":
+        return tensors[template[1]]
+    if kind == "const":
+        return template[1]
+    if kind == "output":
+        return import_class(template[1])(**{key: rebuild(item, tensors) for key, item in template[2].items()})
+    if kind == "dict":
+        return {key: rebuild(item, tensors) for key, item in template[1].items()}
+    items = [rebuild(item, tensors) for item in template[1]]
+    return tuple(items) if kind == "tuple" else items
+
+
+def call_template(args, kwargs, tensors):
+    # Through JSON so templates built at run time compare equal to the stored ones
+    return json.loads(json.dumps(flatten({"args": list(args), "kwargs": kwargs}, tensors)))
+
+
+class FlatCall(torch.nn.Module):
+    """A module called the way it was recorded, taking and returning flat tensor tuples"""
+
+    def __init__(self, module, template):
+        super().__init__()
+        self.module = module
+        self.template = template
+        # The tiled VAE hook replaces encoder/decoder.forward; export the untiled network
+        self.call = getattr(module, "original_forward", module)
+
+    def forward(self, *tensors):
+        call = rebuild(self.template, tensors)
+        outputs = []
+        flatten(self.call(*call["args"], **call["kwargs"]), outputs)
+        return tuple(outputs)
+
+
+def dynamic_axes(prefix, tensors):
+    """Batch, height/width (4-D) and sequence length (3-D) of every tensor are dynamic"""
+    axes = {}
+    for i, tensor in enumerate(tensors):
+        dims = {0: f"{prefix}{i}_batch"} if tensor.dim() >= 1 else {}
+        if tensor.dim() == 4:
+            dims.update({2: f"{prefix}{i}_height", 3: f"{prefix}{i}_width"})
+        elif tensor.dim() == 3:
+            dims[1] = f"{prefix}{i}_length"
+        axes[f"{prefix}{i}"] = dims
+    return axes
+
+
+def resolve(pipeline, attribute):
+    """(owner, name) of a dotted attribute path such as vae.encoder"""
+    owner = pipeline
+    *parents, name = attribute.split(".")
+    for parent in parents:
+        owner = getattr(owner, parent)
+    return owner, name
+
+
+def record_calls(pipeline):
+    """Forward hooks keeping the inputs and outputs of the first call of every target"""
+    calls, handles = {}, []
+    for name, attribute in TARGETS.items():
+        owner, attr = resolve(pipeline, attribute)
+        def hook(module, args, kwargs, output, name=name):
+            if name not in calls:
+                tensors = []
+                template = flatten({"args": list(args), "kwargs": kwargs}, tensors)
+                call = rebuild(template, [tensor.detach().clone() for tensor in tensors])
+                calls[name] = (call["args"], call["kwargs"], output)
+        handles.append(getattr(owner, attr).register_forward_hook(hook, with_kwargs=True))
+    return calls, handles
+
+
+def create_session(path, threads=None):
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("[ERROR] onnxruntime is not installed: pip install onnxruntime")
+        raise
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def run_session(session, entry, tensors):
+    """Feed the flat input tensors (cast to the exported dtypes) and return torch outputs"""
+    feeds = {}
+    for i, (tensor, dtype) in enumerate(zip(tensors, entry["input_dtypes"])):
+        feeds[f"input_{i}"] = tensor.detach().to("cpu", getattr(torch, dtype)).numpy()
+    return [torch.from_numpy(output) for output in session.run(None, feeds)]
+
+
+def max_error(expected, actual):
+    """Largest absolute difference, also relative to the largest reference value"""
+    diff = max(float((e.float() - a.float()).abs().max()) for e, a in zip(expected, actual))
+    scale = max(float(e.float().abs().max()) for e in expected) or 1.0
+    return diff, diff / scale
+
+
+def quantize(model_path, output_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8,
+                     op_types_to_quantize=["MatMul", "Gemm"], use_external_data_format=True)
+
+
+def export(args, output_dir, quantize_int8=False, opset=17, image_size=200, tolerance=1e-3):
+    """Export the modules of the pipeline selected by args; returns the parity results"""
+    from test_pasd import load_pasd_pipeline, denoise
+
+    args = argparse.Namespace(**{**vars(args), "model_bundle": None, "onnx_dir": None, "tile_workers": None, "prompt_cache_size": 0,
+                                 "mixed_precision": "no", "device": "cpu", "no_cpu_optimizations": True,
+                                 "num_inference_steps": 1})
+    target = SimpleNamespace(device=torch.device("cpu"), mixed_precision="no")
+    pipeline = load_pasd_pipeline(args, target, False)
+
+    # One step on a small image. Its latent side (size/8) is not a multiple of 8, so the
+    # UNet traces the upsampling path that follows the skip connection sizes, which is
+    # valid for every image size.
+    calls, handles = record_calls(pipeline)
+    prepared = {"image": Image.new("RGB", (image_size, image_size), (128, 128, 128)),
+                "prompt": f"{args.prompt}{args.added_prompt}", "negative_prompt": args.negative_prompt}
+    with torch.no_grad():
+        image = denoise(args, pipeline, prepared, torch.Generator().manual_seed(0))
+    for handle in handles:
+        handle.remove()
+    if image is None:
+        raise RuntimeError("the recording pipeline call failed")
+
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False  # the TorchScript exporter understands dynamic_axes
+    os.makedirs(output_dir, exist_ok=True)
+    spec = {"format": SPEC_FORMAT, "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "settings": {name: getattr(args, name) for name in BAKED_SETTINGS if name != "mixed_precision"},
+            "modules": {}}
+    parity = {}
+    for name, attribute in TARGETS.items():
+        if name not in calls:
+            print(f"Warning: {attribute} was not called by the pipeline, not exporting it")
+            continue
+        call_args, call_kwargs, output = calls[name]
+        owner, attr = resolve(pipeline, attribute)
+        inputs = []
+        template = call_template(call_args, call_kwargs, inputs)
+        expected = []
+        output_template = json.loads(json.dumps(flatten(output, expected)))
+
+        # Every module in its own folder: weights over 2 GB go to external data files
+        module_dir = os.path.join(output_dir, name)
+        os.makedirs(module_dir, exist_ok=True)
+        path = os.path.join(module_dir, "model.onnx")
+        start = time.time()
+        with torch.no_grad():
+            torch.onnx.export(
+                FlatCall(getattr(owner, attr), template).eval(), tuple(inputs), path,
+                input_names=[f"input_{i}" for i in range(len(inputs))],
+                output_names=[f"output_{i}" for i in range(len(expected))],
+                dynamic_axes={**dynamic_axes("input_", inputs), **dynamic_axes("output_", expected)},
+                opset_version=opset, do_constant_folding=True, **export_kwargs,
+            )
+        entry = {"attribute": attribute, "template": template, "output_template": output_template,
+                 "input_dtypes": [str(tensor.dtype).replace("torch.", "") for tensor in inputs], "fp32": f"{name}/model.onnx"}
+        print(f"[OK] Exported {attribute} ({len(inputs)} inputs, {len(expected)} outputs) in {time.time() - start:.1f}s")
+
+        # Parity with the PyTorch module on the recorded call
+        diff, relative = max_error(expected, run_session(create_session(path, args.cpu_threads), entry, inputs))
+        parity[name] = {"max_abs": diff, "max_rel": relative, "ok": relative <= tolerance}
+        print(f"  {'[OK]' if relative <= tolerance else '[FAIL]'} fp32 parity: max abs {diff:.2e}, relative {relative:.2e}")
+        if quantize_int8:
+            int8_path = os.path.join(module_dir, "model.int8.onnx")
+            quantize(path, int8_path)
+            entry["int8"] = f"{name}/model.int8.onnx"
+            diff, relative = max_error(expected, run_session(create_session(int8_path, args.cpu_threads), entry, inputs))
+            parity[f"{name}_int8"] = {"max_abs": diff, "max_rel": relative}
+            print(f"  int8: max abs {diff:.2e}, relative {relative:.2e} (quantisation error, not checked)")
+        spec["modules"][name] = entry
+
+    spec["parity"] = parity
+    with open(os.path.join(output_dir, SPEC_FILE), "w") as f:
+        json.dump(spec, f, indent=2)
+    return parity
+
+
+class OrtModule:
+    """Mixed into the class of a replaced module, so isinstance checks in the pipeline still
+    pass; calls go to an onnxruntime session"""
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def forward(self, *args, **kwargs):
+        tensors = []
+        if call_template(args, kwargs, tensors) != self.ort_entry["template"]:
+            raise ValueError(f"{self.ort_entry['attribute']} is called differently than when it was exported; re-export it")
+        device = tensors[0].device if tensors else torch.device("cpu")
+        outputs = run_session(self.ort_session, self.ort_entry, tensors)
+        return rebuild(self.ort_entry["output_template"], [output.to(device) for output in outputs])
+
+
+def ort_module(module, session, entry):
+    return stand_in(module, OrtModule, ort_session=session, ort_entry=entry)
+
+
+def load_onnx_modules(pipeline, onnx_dir, quantized=False, threads=None, args=None):
+    """Replace the exported modules of pipeline with onnxruntime sessions"""
+    with open(os.path.join(onnx_dir, SPEC_FILE)) as f:
+        spec = json.load(f)
+    if spec.get("format") != SPEC_FORMAT:
+        raise ValueError(f"{onnx_dir} is not a PASD ONNX export")
+    if args is not None:
+        for name, value in spec["settings"].items():
+            if name in ("pretrained_model_path", "pasd_model_path"):
+                continue
+            if str(getattr(args, name, None)) != str(value):
+                print(f"Warning: {onnx_dir} was exported with --{name} {value}, not {getattr(args, name, None)}")
+
+    for name, entry in spec["modules"].items():
+        file_name = entry["fp32"]
+        if quantized:
+            if "int8" in entry:
+                file_name = entry["int8"]
+            else:
+                print(f"Warning: no int8 {name} in {onnx_dir} (export with --quantize), using fp32")
+        owner, attr = resolve(pipeline, entry["attribute"])
+        session = create_session(os.path.join(onnx_dir, file_name), threads)
+        setattr(owner, attr, ort_module(getattr(owner, attr), session, entry))
+    return pipeline
+
+
+def main():
+    from test_pasd import build_parser
+
+    parser = build_parser()
+    parser.description = "Export the PASD UNet, ControlNet and VAE selected by the test_pasd.py model options to ONNX"
+    parser.add_argument("--onnx_output", type=str, required=True, help="folder for the ONNX graphs and onnx_spec.json")
+    parser.add_argument("--quantize", action="store_true", help="also write int8 dynamically quantised graphs")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+    parser.add_argument("--export_image_size", type=int, default=200, help="side of the image of the recording pipeline call")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="max relative fp32 difference to the PyTorch modules")
+    args = parser.parse_args()
+
+    start = time.time()
+    parity = export(args, args.onnx_output, args.quantize, args.opset, args.export_image_size, args.tolerance)
+    print(f"[OK] Wrote {args.onnx_output} in {time.time() - start:.1f}s")
+    print(f"Use it with: python test_pasd.py --onnx_dir {args.onnx_output}{' --onnx_int8' if args.quantize else ''} --device cpu")
+    failed = [name for name, result in parity.items() if result.get("ok") is False]
+    if failed:
+        print(f"[FAIL] Parity check failed for: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache for PASD outputs
+Keys are a hash of the input pixels plus every output-affecting parameter, so renamed or
+same-stem images never collide and changed settings never reuse stale results.
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+from pathlib import Path
+from PIL import Image
+
+
+def pixel_digest(img):
+    """SHA-256 of a PIL image's RGB pixels"""
+    img = img.convert("RGB")
+    h = hashlib.sha256()
+    h.update(f"{img.width}x{img.height}".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def image_digest(image_path):
+    """SHA-256 of the decoded RGB pixels (independent of file name and PNG encoding)"""
+    with Image.open(image_path) as img:
+        return pixel_digest(img)
+
+
+class OutputCache:
+    """Size-bounded LRU cache of upscaled images, indexed in SQLite"""
+
+    def __init__(self, cache_dir, max_bytes=20 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.digests = {}
+
+        self.db = sqlite3.connect(str(self.cache_dir / "index.sqlite"))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, file TEXT NOT NULL, size INTEGER NOT NULL,"
+            " params TEXT, created REAL, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)")
+        self.db.commit()
+
+    def input_digest(self, image_path):
+        """Pixel digest, memoised per (path, mtime, size) so the 2x/4x/8x jobs hash once"""
+        stat = os.stat(image_path)
+        memo_key = (str(image_path), stat.st_mtime_ns, stat.st_size)
+        if memo_key not in self.digests:
+            self.digests[memo_key] = image_digest(image_path)
+        return self.digests[memo_key]
+
+    def make_key(self, image_path, params):
+        payload = json.dumps({"input": self.input_digest(image_path), "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def object_path(self, key):
+        return self.objects_dir / key[:2] / f"{key}.png"
+
+    def get(self, key):
+        """Return the cached file for key (marking it recently used), or None"""
+        row = self.db.execute("SELECT file FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = Path(row[0])
+        if not path.exists():
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.db.commit()
+            return None
+        self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return path
+
+    def restore(self, key, dest_path):
+        """Copy a cached result to dest_path; returns False on a miss"""
+        cached = self.get(key)
+        if cached is None:
+            return False
+        dest_path = Path(dest_path)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(cached, dest_path)
+        return True
+
+    def put(self, key, output_path, params=None):
+        """Store a copy of output_path under key and evict least recently used entries"""
+        obj = self.object_path(key)
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(output_path, obj)
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries (key, file, size, params, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, str(obj), obj.stat().st_size, json.dumps(params, sort_keys=True, default=str), now, now),
+        )
+        self.db.commit()
+        self.evict()
+
+    def total_bytes(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for key, file, size in self.db.execute("SELECT key, file, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            Path(file).unlink(missing_ok=True)
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
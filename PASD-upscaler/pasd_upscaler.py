@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+In-process PASD upscaler
+Owns the pipeline built by load_pasd_pipeline and upscales PIL/NumPy images without touching disk
+"""
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+from accelerate import Accelerator
+
+from test_pasd import parse_args, load_pasd_pipeline, load_high_level_net, build_resize_preproc, upscale_pil
+from stage_timer import null_timer
+from caption_cache import CaptionCache
+import cpu_backend
+
+# Arguments that only affect a single call (tile sizes included: the tiled VAE is
+# re-initialised per call when they change). Everything else (model paths, precision,
+# high-level net) is baked into the loaded models.
+JOB_PARAMS = {
+    "upscale", "prompt", "added_prompt", "negative_prompt", "guidance_scale",
+    "conditioning_scale", "num_inference_steps", "process_size", "seed",
+    "latent_tiled_size", "latent_tiled_overlap", "encoder_tiled_size", "decoder_tiled_size",
+    "init_latent_with_noise", "added_noise_level", "offset_noise_scale",
+}
+# Fixed arguments that change the output; with a job's JOB_PARAMS they identify its result
+MODEL_PARAMS = (
+    "pretrained_model_path", "pasd_model_path", "model_bundle", "control_type", "use_pasd_light",
+    "use_lcm_lora", "lcm_lora_path", "use_personalized_model", "personalized_model_path",
+    "blending_alpha", "multiplier", "high_level_info", "use_blip", "device", "mixed_precision",
+    "onnx_dir", "onnx_int8", "tile_workers", "tile_window",
+)
+
+
+class PASDUpscaler:
+    """Keeps the PASD pipeline and high-level net warm across calls
+
+    Example:
+        upscaler = PASDUpscaler(pasd_model_path="runs/pasd/pasd/checkpoint-100000")
+        x2, x4 = upscaler.upscale(Image.open("examples/Set5/bird.png"), scales=[2, 4])
+    """
+
+    def __init__(self, args=None, enable_xformers_memory_efficient_attention=True, **overrides):
+        # Start from the test_pasd.py CLI defaults so both entry points behave the same; a
+        # caller's Namespace from an older option set gets defaults for the newer options
+        defaults = vars(parse_args([]))
+        self.args = argparse.Namespace(**{**defaults, **vars(args or argparse.Namespace()), **overrides})
+
+        cpu = cpu_backend.setup(self.args)
+        self.accelerator = Accelerator(mixed_precision=self.args.mixed_precision, cpu=cpu)
+        self.device = self.accelerator.device
+        self.pipeline = load_pasd_pipeline(self.args, self.accelerator, enable_xformers_memory_efficient_attention)
+        self.model, self.preprocess, self.category = load_high_level_net(self.args, self.device)
+        self.caption_cache = CaptionCache(self.args.caption_cache) if self.args.caption_cache else None
+
+    def config(self):
+        """The MODEL_PARAMS this upscaler runs with (device and precision as resolved)"""
+        return {name: getattr(self.args, name, None) for name in MODEL_PARAMS}
+
+    def job_args(self, params):
+        """Overlay per-call parameters on the loaded configuration"""
+        unknown = set(params) - JOB_PARAMS
+        if unknown:
+            raise ValueError(f"parameters {sorted(unknown)} are fixed when the upscaler is created")
+        return argparse.Namespace(**{**vars(self.args), **params})
+
+    @staticmethod
+    def to_pil(image):
+        if isinstance(image, Image.Image):
+            return image.convert("RGB")
+        if isinstance(image, np.ndarray):
+            if image.dtype != np.uint8:
+                image = (np.clip(image, 0.0, 1.0) * 255).round().astype(np.uint8)
+            return Image.fromarray(image).convert("RGB")
+        return Image.open(image).convert("RGB")
+
+    def upscale_one(self, image, scale=None, output_type="pil", timer=null_timer, **params):
+        """Upscale a single image (PIL, HxWxC array or path) and return it as PIL or NumPy
+
+        timer: optional stage_timer.StageTimer recording per-stage time and memory
+        """
+        if scale is not None:
+            params["upscale"] = scale
+        args = self.job_args(params)
+
+        generator = torch.Generator(device=self.device)
+        if args.seed is not None:
+            generator.manual_seed(args.seed)
+
+        with torch.no_grad():
+            result = upscale_pil(
+                args, self.pipeline, self.model, self.preprocess, self.category,
+                build_resize_preproc(args), generator, self.to_pil(image), self.device, timer, self.caption_cache,
+            )
+        if result is None:
+            raise RuntimeError("PASD pipeline failed")
+        if output_type == "np":
+            return np.asarray(result)
+        return result
+
+    def upscale(self, images, scales=2, output_type="pil", **params):
+        """Upscale one or more images at one or more scales
+
+        images: a single image or a list of images (PIL, HxWxC uint8/float array or path)
+        scales: an int, or a list of ints
+        output_type: "pil" or "np"
+
+        Returns results[i] for an int scale, or results[i][j] (image i at scales[j])
+        for a list of scales. A single input image drops the outer list.
+        """
+        single_image = not isinstance(images, (list, tuple))
+        single_scale = isinstance(scales, int)
+        images = [images] if single_image else list(images)
+        scales = [scales] if single_scale else list(scales)
+
+        results = []
+        for image in images:
+            image = self.to_pil(image)
+            outputs = [self.upscale_one(image, scale, output_type, **params) for scale in scales]
+            results.append(outputs[0] if single_scale else outputs)
+        return results[0] if single_image else results
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+PASD Resident Worker
+Loads the PASD pipeline and high-level net once and serves upscale jobs over a local socket
+"""
+import os
+import secrets
+import traceback
+from multiprocessing.connection import Client, Listener
+
+from stage_timer import StageTimer
+from memory_monitor import MemoryMonitor
+
+DEFAULT_ADDRESS = "127.0.0.1:7870"
+# Key of workers started without --authkey / PASD_WORKER_AUTHKEY, readable by this user only
+DEFAULT_KEY_FILE = os.path.join(os.path.expanduser("~"), ".pasd_worker_key")
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+def parse_address(address):
+    """Turn 'host:port' into a (host, port) tuple"""
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def client_authkey(authkey=None):
+    """authkey, else PASD_WORKER_AUTHKEY, else the key a local worker wrote to DEFAULT_KEY_FILE"""
+    authkey = authkey or os.environ.get("PASD_WORKER_AUTHKEY")
+    if not authkey and os.path.exists(DEFAULT_KEY_FILE):
+        with open(DEFAULT_KEY_FILE) as f:
+            authkey = f.read().strip()
+    if not authkey:
+        raise ValueError(f"no worker key: pass --authkey, set PASD_WORKER_AUTHKEY or start a local worker (writes {DEFAULT_KEY_FILE})")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def server_authkey(address, authkey=None):
+    """Key a worker listens with. Messages are unpickled, so there is no well-known default:
+    a non-loopback address needs an explicit key, a loopback one gets a random key that is
+    written to DEFAULT_KEY_FILE for local clients (reused while the file exists)."""
+    authkey = authkey or os.environ.get("PASD_WORKER_AUTHKEY")
+    if not authkey:
+        if address[0] not in LOOPBACK_HOSTS:
+            raise ValueError(f"listening on {address[0]} needs an explicit --authkey or PASD_WORKER_AUTHKEY")
+        if os.path.exists(DEFAULT_KEY_FILE):
+            return client_authkey()
+        authkey = secrets.token_hex(16)
+        fd = os.open(DEFAULT_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(authkey)
+        print(f"Worker key written to {DEFAULT_KEY_FILE}")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class PASDWorkerClient:
+    """Client for a running pasd_worker.py process"""
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, timeout=None):
+        self.address = parse_address(address) if isinstance(address, str) else address
+        # Resolved per request: a local worker may write its key file after the client exists
+        self.authkey = authkey
+        self.timeout = timeout
+
+    def request(self, message):
+        """Send one request and wait for the reply (one connection per request)
+
+        Raises TimeoutError if there is no reply within self.timeout seconds (None: wait forever).
+        """
+        conn = Client(self.address, authkey=client_authkey(self.authkey))
+        try:
+            conn.send(message)
+            if self.timeout is not None and not conn.poll(self.timeout):
+                raise TimeoutError(f"no reply from the worker within {self.timeout:.0f}s")
+            return conn.recv()
+        finally:
+            conn.close()
+
+    def config(self):
+        """Output-affecting settings the worker was started with (pasd_upscaler.MODEL_PARAMS)"""
+        return self.request({"cmd": "ping"})["config"]
+
+    def ping(self):
+        """Return True if a worker is listening at the address"""
+        try:
+            return self.request({"cmd": "ping"}).get("status") == "ok"
+        except (ConnectionError, OSError, EOFError, ValueError):
+            return False
+
+    def upscale(self, image_path, output_dir, output_name=None, **params):
+        """Upscale one image on the worker and return the exact output path"""
+        return self.upscale_job(image_path, output_dir, output_name, **params)["output_path"]
+
+    def upscale_job(self, image_path, output_dir, output_name=None, **params):
+        """Like upscale, but return the whole reply (output_path, per-stage memory peaks, worker config)"""
+        reply = self.request({
+            "cmd": "upscale",
+            "image_path": str(image_path),
+            "output_dir": str(output_dir),
+            "output_name": output_name,
+            "params": params,
+        })
+        if reply.get("status") != "ok":
+            raise RuntimeError(reply.get("error", "worker returned no output"))
+        return reply
+
+    def shutdown(self):
+        return self.request({"cmd": "shutdown"})
+
+
+class PASDWorker:
+    """Owns a PASDUpscaler and runs jobs one at a time"""
+
+    def __init__(self, args, enable_xformers_memory_efficient_attention=True):
+        import torch
+        from pasd_upscaler import PASDUpscaler
+
+        print("Loading PASD pipeline...")
+        self.upscaler = PASDUpscaler(args, enable_xformers_memory_efficient_attention)
+        self.memory = MemoryMonitor(cuda=torch.cuda if torch.cuda.is_available() else None)
+        self.jobs_done = 0
+        print(f"[OK] Models resident on {self.upscaler.device}")
+
+    def upscale(self, image_path, output_dir, output_name=None, params=None):
+        """Run one job; returns the output path and its per-stage memory peaks"""
+        timer = StageTimer(memory=self.memory)
+        with timer.stage("job", sync=True):
+            image = self.upscaler.upscale_one(image_path, timer=timer, **(params or {}))
+
+            if output_name is None:
+                output_name = f"{os.path.splitext(os.path.basename(image_path))[0]}.png"
+            os.makedirs(output_dir, exist_ok=True)
+            output_path = os.path.join(output_dir, output_name)
+            with timer.stage("save"):
+                image.save(output_path)
+        self.jobs_done += 1
+        return output_path, timer.peaks()
+
+    def config(self):
+        return self.upscaler.config()
+
+    def handle(self, message):
+        cmd = message.get("cmd")
+        if cmd == "ping":
+            return {"status": "ok", "jobs_done": self.jobs_done, "config": self.config()}
+        if cmd == "upscale":
+            output_path, memory = self.upscale(
+                message["image_path"], message["output_dir"],
+                message.get("output_name"), message.get("params"),
+            )
+            # Clients key cached results by the settings that produced them
+            return {"status": "ok", "output_path": output_path, "memory": memory, "config": self.config()}
+        raise ValueError(f"unknown command: {cmd}")
+
+    def serve(self, address=DEFAULT_ADDRESS, authkey=None):
+        address = parse_address(address) if isinstance(address, str) else address
+        authkey = server_authkey(address, authkey)
+        with Listener(address, authkey=authkey) as listener:
+            print(f"[OK] PASD worker listening on {address[0]}:{address[1]}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"[ERROR] Rejected connection: {e}")
+                    continue
+                with conn:
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        continue
+                    if message.get("cmd") == "shutdown":
+                        conn.send({"status": "ok"})
+                        print("Shutting down worker")
+                        return
+                    try:
+                        reply = self.handle(message)
+                    except Exception as e:
+                        traceback.print_exc()
+                        reply = {"status": "error", "error": str(e)}
+                    conn.send(reply)
+
+
+def main():
+    from test_pasd import build_parser
+
+    parser = build_parser()
+    parser.add_argument("--address", type=str, default=DEFAULT_ADDRESS, help="host:port to listen on")
+    parser.add_argument("--authkey", type=str, default=None, help="shared secret for clients (or set PASD_WORKER_AUTHKEY); required off loopback, else random in ~/.pasd_worker_key")
+    parser.add_argument("--disable_xformers", action="store_true", help="use standard attention")
+    args = parser.parse_args()
+
+    worker = PASDWorker(args, enable_xformers_memory_efficient_attention=not args.disable_xformers)
+    worker.serve(args.address, args.authkey)
+
+
+if __name__ == "__main__":
+    main()
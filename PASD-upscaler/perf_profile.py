@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Per-machine performance profile written by `python quick_test.py --calibrate`
+Holds measured UNet step times per latent size, VAE tile throughput, the speed of each
+attention backend and the fastest tile sizes that fit in memory. load_pasd_pipeline, the
+Gradio demo and the batch scripts pick it up from pasd_profile.json; a profile calibrated
+on other hardware is ignored.
+"""
+import os
+import json
+import time
+import platform
+
+PROFILE_FORMAT = "pasd-profile-1"
+DEFAULT_PROFILE = "pasd_profile.json"
+TILE_OPTIONS = ("latent_tiled_size", "encoder_tiled_size", "decoder_tiled_size")
+
+
+def hardware(device=None):
+    """What a profile is valid for: device type and name (and memory / core count)"""
+    # torch only when a profile is actually used: the batch scripts run without it
+    import torch
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        props = torch.cuda.get_device_properties(torch.cuda.current_device())
+        return {"device": "cuda", "name": props.name, "memory_mb": round(props.total_memory / 2**20)}
+    return {"device": "cpu", "name": platform.processor() or platform.machine(), "cpu_count": os.cpu_count()}
+
+
+def save_profile(profile, path=DEFAULT_PROFILE):
+    profile = {"format": PROFILE_FORMAT, "created": time.strftime("%Y-%m-%d %H:%M:%S"), **profile}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_profile(path=DEFAULT_PROFILE, device=None):
+    """The profile at path if it was calibrated on this hardware, else None"""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read {path}: {e}")
+        return None
+    if profile.get("format") != PROFILE_FORMAT:
+        print(f"Warning: {path} is not a PASD performance profile, ignoring it")
+        return None
+    current = hardware(device)
+    calibrated = profile["hardware"]
+    if (calibrated["device"], calibrated["name"]) != (current["device"], current["name"]):
+        print(f"Warning: {path} was calibrated on {calibrated['name']} ({calibrated['device']}), "
+              f"not {current['name']} ({current['device']}); ignoring it")
+        return None
+    return profile
+
+
+def tile_sizes(profile, mixed_precision):
+    """Recommended tile sizes; none if the profile was measured at another precision"""
+    if profile is None:
+        return {}
+    if profile["settings"]["mixed_precision"] != mixed_precision:
+        print(f"Note: the performance profile was calibrated with --mixed_precision {profile['settings']['mixed_precision']}, "
+              f"not {mixed_precision}; not using its tile sizes")
+        return {}
+    return {name: profile["recommended"][name] for name in TILE_OPTIONS if profile["recommended"].get(name)}
+
+
+def apply_profile(args, profile, enable_xformers_memory_efficient_attention=True):
+    """Fill tile options left at auto with the profile's sizes; returns whether to use xformers"""
+    if profile is None:
+        return enable_xformers_memory_efficient_attention
+    for name, size in tile_sizes(profile, args.mixed_precision).items():
+        if getattr(args, name, None) is None:
+            setattr(args, name, size)
+    if profile["recommended"].get("attention") == "sdpa":
+        return False
+    return enable_xformers_memory_efficient_attention
+
+
+def update_params(params, profile, mixed_precision, add=False):
+    """Replace the tile options in a batch script's parameter dict (add missing ones if add)"""
+    for name, size in tile_sizes(profile, mixed_precision).items():
+        if add or name in params:
+            params[name] = size
+    return params
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+LRU cache of text-encoder outputs for PASD pipelines
+Wraps a pipeline's encode_prompt/_encode_prompt so a (tokenizer, text encoder, prompt,
+negative prompt, call options) combination seen before skips the text encoders (both of
+them for SDXL). --added_prompt and --negative_prompt are usually constant across a run,
+so repeated prompts hit almost every time.
+"""
+import functools
+import threading
+import collections
+
+ENCODE_METHODS = ("encode_prompt", "_encode_prompt")
+ENCODER_ATTRIBUTES = ("tokenizer", "text_encoder", "tokenizer_2", "text_encoder_2")
+
+
+class Uncacheable(Exception):
+    """A call argument (e.g. precomputed embeddings) that cannot be part of a key"""
+
+
+def freeze(value):
+    """Hashable form of a call argument"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if type(value).__name__ in ("device", "dtype"):  # torch.device / torch.dtype
+        return str(value)
+    raise Uncacheable(type(value).__name__)
+
+
+class PromptEmbeddingCache:
+    """Thread-safe LRU of encode_prompt results, up to max_entries calls"""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def wrap(self, pipeline):
+        """Route the pipeline's prompt encoding through the cache; returns the pipeline"""
+        for name in ENCODE_METHODS:
+            if hasattr(pipeline, name):
+                setattr(pipeline, name, self.cached(pipeline, getattr(pipeline, name)))
+        return pipeline
+
+    def cached(self, pipeline, encode):
+        @functools.wraps(encode)
+        def encode_cached(*args, **kwargs):
+            try:
+                # Encoders are looked up per call, so swapping a text encoder never hits stale entries
+                encoders = tuple(id(getattr(pipeline, name, None)) for name in ENCODER_ATTRIBUTES)
+                key = (encode.__name__, encoders, freeze(args), freeze(sorted(kwargs.items())))
+            except Uncacheable:
+                return encode(*args, **kwargs)
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+            result = encode(*args, **kwargs)
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = result
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return result
+        return encode_cached
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -1,12 +1,30 @@
 #!/usr/bin/env python3
 """
 PASD Quick Test and Setup Verification
+With --calibrate, micro-benchmarks the real pipeline on this machine and writes
+pasd_profile.json: UNet step time per latent size, VAE tile throughput, attention backend
+speed and the fastest tile sizes that fit in memory. test_pasd.py, gradio_pasd.py and the
+batch scripts apply it automatically.
+
+Usage (from PASD-upscaler/):
+    python quick_test.py
+    python quick_test.py --calibrate --pasd_model_path runs/pasd/pasd/checkpoint-100000
 """
 import os
 import sys
+import time
+import argparse
+import statistics
 import torch
 from PIL import Image
 
+# Share of the GPU memory a calibration run may peak at; the rest is headroom for the
+# captioner and fragmentation
+SAFE_MEMORY_FRACTION = 0.85
+# Padding the tiled VAE adds around each encoder (pixels) / decoder (latent pixels) tile
+VAE_TILE_PADDING = {"encoder": 32, "decoder": 11}
+DEFAULT_SIZES = {"cuda": "64,96,128,160,192,256,320,384,448,512", "cpu": "32,48,64,96,128"}
+
 def check_system():
     """Check system requirements"""
     print("PASD System Check")
@@ -105,6 +123,169 @@ def show_next_steps():
     
     print("Read SETUP_GUIDE.md for detailed instructions")
 
+def out_of_memory(e):
+    from adaptive_tiling import is_out_of_memory, release_memory
+    if not is_out_of_memory(e):
+        raise e
+    release_memory()
+
+
+def measure(fn, device):
+    """(seconds, peak CUDA MB) of fn(), or None if it ran out of memory"""
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    try:
+        with torch.no_grad():
+            fn()
+    except Exception as e:
+        out_of_memory(e)
+        return None
+    if device == "cuda":
+        torch.cuda.synchronize()
+        return time.perf_counter() - start, torch.cuda.max_memory_allocated() / 2**20
+    return time.perf_counter() - start, None
+
+
+def fits(peak_mb, device):
+    if device != "cuda":
+        return True
+    return peak_mb <= SAFE_MEMORY_FRACTION * torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory / 2**20
+
+
+def time_unet_steps(args, pipeline, latent_size, device, steps=3):
+    """Median denoising step (UNet + ControlNet) on an untiled latent of latent_size, or None"""
+    import cpu_backend
+    from adaptive_tiling import apply_tiles
+    from test_pasd import step_timing
+    from stage_timer import StageTimer
+
+    size = latent_size * 8
+    # Small VAE tiles, so the peak memory is the UNet's
+    call_args = apply_tiles(args, pipeline, {"latent_tiled_size": latent_size, "encoder_tiled_size": 512, "decoder_tiled_size": 64})
+    call_args.num_inference_steps = steps
+    timer = StageTimer(sync=torch.cuda.synchronize if device == "cuda" else None, detailed=True)
+    image = Image.new("RGB", (size, size), (128, 128, 128))
+    def run():
+        with cpu_backend.autocast(args.device, args.mixed_precision):
+            pipeline(call_args, "calibration", image, num_inference_steps=steps, generator=torch.Generator(device=device).manual_seed(0),
+                     guidance_scale=args.guidance_scale, negative_prompt="", conditioning_scale=args.conditioning_scale, **step_timing(timer))
+    result = measure(run, device)
+    if result is None:
+        return None
+    # The first step also includes text and VAE encoding
+    step_times = [record["seconds"] for record in timer.records if record["stage"] == "denoise_step"][1:]
+    return statistics.median(step_times), result[1]
+
+
+def time_vae(pipeline, kind, size, device):
+    """(seconds, peak MB) of one untiled VAE encode (size in pixels) or decode (size in latent pixels)"""
+    from adaptive_tiling import apply_tiles
+    vae = pipeline.vae
+    tiles = {"latent_tiled_size": 64, "encoder_tiled_size": size, "decoder_tiled_size": size}
+    apply_tiles(argparse.Namespace(onnx_dir=None), pipeline, tiles)
+    if kind == "encoder":
+        x = torch.randn(1, 3, size, size, device=device, dtype=vae.dtype)
+        fn = lambda: vae.encode(x)
+    else:
+        x = torch.randn(1, 4, size, size, device=device, dtype=vae.dtype)
+        fn = lambda: vae.decode(x)
+    measure(fn, device)  # warm-up
+    return measure(fn, device)
+
+
+def calibrate(options, model_args):
+    """Benchmark the pipeline selected by the test_pasd.py model options; returns the profile"""
+    import cpu_backend
+    import perf_profile
+    from accelerate import Accelerator
+    from diffusers.utils.import_utils import is_xformers_available
+    from test_pasd import parse_args, load_pasd_pipeline
+
+    args = parse_args(model_args)
+    args.perf_profile = ""  # measure the defaults, not an older profile
+    cpu = cpu_backend.setup(args)
+    accelerator = Accelerator(mixed_precision=args.mixed_precision, cpu=cpu)
+    device = accelerator.device.type
+    print(f"Calibrating on {perf_profile.hardware(device)['name']} ({device}, {args.mixed_precision})")
+    pipeline = load_pasd_pipeline(args, accelerator, False)
+    sizes = [int(size) for size in (options.sizes or DEFAULT_SIZES[device]).split(",")]
+
+    # UNet + ControlNet step time per latent size, until out of memory or too slow
+    unet = {}
+    for latent_size in sizes:
+        result = time_unet_steps(args, pipeline, latent_size, device)
+        if result is None:
+            print(f"  latent {latent_size}: out of memory")
+            break
+        seconds, peak_mb = result
+        unet[latent_size] = {"step_s": seconds, "peak_mb": peak_mb, "safe": fits(peak_mb, device)}
+        print(f"  latent {latent_size}: {seconds:.3f}s/step" + (f", peak {peak_mb:.0f} MB" if peak_mb else ""))
+        if seconds > options.max_step_seconds:
+            break
+
+    # VAE tiles: megapixels of output (decoder) / input (encoder) per second
+    vae = {"encoder": {}, "decoder": {}}
+    for kind in vae:
+        for latent_size in sizes:
+            size = latent_size * 8 if kind == "encoder" else latent_size
+            result = time_vae(pipeline, kind, size, device)
+            if result is None:
+                print(f"  VAE {kind} tile {size}: out of memory")
+                break
+            seconds, peak_mb = result
+            pixels = size * size * (64 if kind == "decoder" else 1)
+            vae[kind][size] = {"mpx_per_s": pixels / seconds / 1e6, "seconds": seconds, "peak_mb": peak_mb, "safe": fits(peak_mb, device)}
+            print(f"  VAE {kind} tile {size}: {vae[kind][size]['mpx_per_s']:.2f} MP/s")
+            if seconds > options.max_step_seconds:
+                break
+
+    # Attention backends at a mid-sized latent that fitted
+    attention = {}
+    if unet:
+        probe = list(unet)[len(unet) // 2]
+        attention["sdpa"] = unet[probe]["step_s"]
+        if device == "cuda" and is_xformers_available():
+            try:
+                pipeline.unet.enable_xformers_memory_efficient_attention()
+                pipeline.controlnet.enable_xformers_memory_efficient_attention()
+                result = time_unet_steps(args, pipeline, probe, device)
+                if result is not None:
+                    attention["xformers"] = result[0]
+            except Exception as e:
+                print(f"Warning: xformers failed: {e}")
+            finally:
+                pipeline.unet.disable_xformers_memory_efficient_attention()
+                pipeline.controlnet.disable_xformers_memory_efficient_attention()
+        print("  attention: " + ", ".join(f"{name} {seconds:.3f}s/step" for name, seconds in attention.items()))
+
+    # Fastest safe tile: least time per latent/output pixel a tile adds once overlap and
+    # padding are discounted
+    def fastest(results, cost, overlap):
+        safe = {size: result for size, result in results.items() if result["safe"]}
+        if not safe:
+            return None
+        return min(safe, key=lambda size: cost(safe[size]) / max(1, size - overlap) ** 2)
+    recommended = {
+        "latent_tiled_size": fastest(unet, lambda r: r["step_s"], args.latent_tiled_overlap),
+        "encoder_tiled_size": fastest(vae["encoder"], lambda r: r["seconds"], 2 * VAE_TILE_PADDING["encoder"]),
+        "decoder_tiled_size": fastest(vae["decoder"], lambda r: r["seconds"], 2 * VAE_TILE_PADDING["decoder"]),
+        "attention": min(attention, key=attention.get) if attention else None,
+    }
+    max_safe = {name: max((size for size, r in results.items() if r["safe"]), default=None)
+                for name, results in (("latent_tiled_size", unet), ("encoder_tiled_size", vae["encoder"]), ("decoder_tiled_size", vae["decoder"]))}
+    return {
+        "hardware": perf_profile.hardware(device),
+        "settings": {"mixed_precision": args.mixed_precision, "use_pasd_light": args.use_pasd_light, "torch": torch.__version__},
+        "unet": unet,
+        "vae": vae,
+        "attention_step_s": attention,
+        "max_safe_tiles": max_safe,
+        "recommended": recommended,
+    }
+
+
 def main():
     """Main test function"""
     print("PASD Image Upscaler - Quick Setup Test")
@@ -124,4 +305,17 @@ def main():
     print()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="PASD setup check; --calibrate writes a performance profile (other options go to test_pasd.py)")
+    parser.add_argument("--calibrate", action="store_true", help="benchmark the pipeline on this machine and write the profile")
+    parser.add_argument("--profile", type=str, default="pasd_profile.json", help="profile file to write")
+    parser.add_argument("--sizes", type=str, default=None, help="comma-separated latent tile sizes to try (default depends on the device)")
+    parser.add_argument("--max_step_seconds", type=float, default=30.0, help="stop growing a tile size once one step/tile takes longer")
+    options, model_args = parser.parse_known_args()
+    if options.calibrate:
+        import perf_profile
+        profile = calibrate(options, model_args)
+        perf_profile.save_profile(profile, options.profile)
+        print(f"[OK] Profile written: {options.profile}")
+        print(f"     Recommended: {profile['recommended']}")
+    else:
+        main()
\ No newline at end of file
@@ -9,14 +9,25 @@ from PIL import Image
 import subprocess
 import argparse
 
-def upscale_single_image(input_path, output_dir, scale=2):
-    """Upscale a single image using PASD"""
+from pasd_worker import PASDWorkerClient
+
+def upscale_single_image(input_path, output_dir, scale=2, worker=None):
+    """Upscale a single image using PASD (via a resident worker if one is given)"""
     
     print(f"Upscaling {input_path} -> {scale}x")
     
     # Create output directory
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
+    if worker is not None:
+        try:
+            output_path = worker.upscale(input_path, output_dir, upscale=scale, guidance_scale=7.0, num_inference_steps=20)
+            print(f"[SUCCESS] Success: {input_path.name}")
+            return Path(output_path)
+        except Exception as e:
+            print(f"[ERROR] Worker error: {e}")
+            return None
+    
     # PASD command
     cmd = [
         "python", "test_pasd.py",
@@ -56,6 +67,11 @@ def upscale_single_image(input_path, output_dir, scale=2):
 
 def main():
     """Test with Set5 butterfly image"""
+    parser = argparse.ArgumentParser(description="Simple PASD upscaling test")
+    parser.add_argument("--worker", type=str, default=None, help="host:port of a running pasd_worker.py")
+    args = parser.parse_args()
+    worker = PASDWorkerClient(args.worker) if args.worker else None
+    
     input_image = Path("examples/Set5/butterfly.png")
     output_dir = Path("simple_test_output")
     
@@ -68,7 +84,7 @@ def main():
     print(f"Output: {output_dir}")
     
     # Test 2x upscaling
-    result = upscale_single_image(input_image, output_dir, scale=2)
+    result = upscale_single_image(input_image, output_dir, scale=2, worker=worker)
     
     if result:
         print(f"Success! Generated: {result}")
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing for the PASD inference path
+Records one entry per stage execution (model loading, prompt, resizes, text encoding,
+every denoising step, VAE decode, color fix, save) and writes them as JSONL and/or
+Prometheus text format. With a MemoryMonitor attached, every stage also records its
+peak RSS and peak accelerator memory.
+"""
+import json
+import time
+import functools
+import threading
+import contextlib
+
+from memory_monitor import merge_peaks
+
+
+class StageTimer:
+    """Thread-safe collector of stage timings
+
+    sync: optional callable (e.g. torch.cuda.synchronize) run around accelerator stages so
+    asynchronous kernels are charged to the stage that launched them.
+    detailed: also time text encoding, VAE calls and every denoising step.
+    memory: optional memory_monitor.MemoryMonitor for per-stage high-water marks.
+    """
+
+    def __init__(self, sync=None, detailed=False, enabled=True, memory=None):
+        self.sync = sync
+        self.detailed = detailed
+        self.enabled = enabled
+        self.memory = memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        """Attach labels (e.g. image=...) to every stage recorded by this thread inside the block"""
+        previous = getattr(self.local, "labels", {})
+        self.local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def add(self, stage, seconds, **labels):
+        if not self.enabled:
+            return
+        record = {"stage": stage, "seconds": seconds, "time": time.time(), **getattr(self.local, "labels", {}), **labels}
+        with self.lock:
+            self.records.append(record)
+        self.local.mark = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, sync=False, **labels):
+        if not self.enabled:
+            yield
+            return
+        if sync and self.sync is not None:
+            self.sync()
+        handle = self.memory.begin(accelerator=sync) if self.memory is not None else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync and self.sync is not None:
+                self.sync()
+            seconds = time.perf_counter() - start
+            if handle is not None:
+                labels.update(self.memory.end(handle))
+            self.add(name, seconds, **labels)
+
+    def wrap(self, fn, name):
+        """Return fn timed as stage name (accelerator-synchronised)"""
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self.stage(name, sync=True):
+                return fn(*args, **kwargs)
+        return timed
+
+    def start_steps(self):
+        self.local.mark = time.perf_counter()
+
+    def step_callback(self, step, timestep, latents):
+        """Pipeline callback: time since the previous step (or the last recorded stage)"""
+        if self.sync is not None:
+            self.sync()
+        now = time.perf_counter()
+        self.add("denoise_step", now - getattr(self.local, "mark", now), step=step)
+
+    def totals(self):
+        """{stage: {"seconds": total, "count": n}}"""
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                total = totals.setdefault(record["stage"], {"seconds": 0.0, "count": 0})
+                total["seconds"] += record["seconds"]
+                total["count"] += 1
+        return totals
+
+    def peaks(self, image=None):
+        """{stage: {"peak_rss_mb", "peak_cuda_mb"}} over all records, or those of one image"""
+        peaks = {}
+        with self.lock:
+            records = [record for record in self.records if "peak_rss_mb" in record]
+        for record in records:
+            if image is not None:
+                labelled = record.get("image")
+                if labelled != image and not (isinstance(labelled, list) and image in labelled):
+                    continue
+            merge_peaks(peaks, {record["stage"]: {"peak_rss_mb": record["peak_rss_mb"], "peak_cuda_mb": record["peak_cuda_mb"]}})
+        return peaks
+
+    def write_jsonl(self, path):
+        with self.lock:
+            records = list(self.records)
+        with open(path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def write_prometheus(self, path, prefix="pasd_stage_seconds"):
+        """Summary metric per stage, e.g. for the node_exporter textfile collector"""
+        lines = [
+            f"# HELP {prefix} Time spent in each PASD inference stage",
+            f"# TYPE {prefix} summary",
+        ]
+        for stage, total in sorted(self.totals().items()):
+            lines.append(f'{prefix}_sum{{stage="{stage}"}} {total["seconds"]:.6f}')
+            lines.append(f'{prefix}_count{{stage="{stage}"}} {total["count"]}')
+        peaks = self.peaks()
+        for key, metric in (("peak_rss_mb", "pasd_stage_peak_rss_megabytes"), ("peak_cuda_mb", "pasd_stage_peak_cuda_megabytes")):
+            values = {stage: peak[key] for stage, peak in sorted(peaks.items()) if peak[key] is not None}
+            if values:
+                lines.append(f"# TYPE {metric} gauge")
+                lines += [f'{metric}{{stage="{stage}"}} {value:.1f}' for stage, value in values.items()]
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+null_timer = StageTimer(enabled=False)
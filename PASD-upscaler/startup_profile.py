@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Import-time profiling for the CLI entry points
+install() wraps __import__ and charges the wall time of every top-level import statement
+(including everything it pulls in) to the module it names; report() prints the breakdown.
+Installed by test_pasd.py when --profile_startup is on the command line, before its own
+heavy imports run.
+"""
+import sys
+import time
+import builtins
+
+process_start = time.perf_counter()
+imports = {}  # module -> seconds, for imports that were not already loaded
+_depth = 0
+_original_import = None
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if _depth > 0 or level > 0 or name in sys.modules:
+        _depth += 1
+        try:
+            return _original_import(name, globals, locals, fromlist, level)
+        finally:
+            _depth -= 1
+    _depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        imports[name] = imports.get(name, 0.0) + time.perf_counter() - start
+
+
+def install():
+    global _original_import
+    if _original_import is None:
+        _original_import = builtins.__import__
+        builtins.__import__ = _timed_import
+
+
+def uninstall():
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+
+def report(top=15):
+    """Print the slowest imports and the time since this module was loaded"""
+    total = sum(imports.values())
+    print(f"Startup: {time.perf_counter() - process_start:.2f}s so far, {total:.2f}s in imports")
+    for name, seconds in sorted(imports.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {seconds:7.3f}s {100 * seconds / total if total else 0:5.1f}%  {name}")
@@ -1,28 +1,47 @@
 import os
+import gc
 import sys
-import cv2
+
+# Before the heavy imports, so they show up in the breakdown
+if "--profile_startup" in sys.argv or "--profile-startup" in sys.argv:
+    import startup_profile
+    startup_profile.install()
+
 import glob
+import json
+import time
+import hashlib
 import argparse
-import open_clip
+import itertools
+import threading
+import contextlib
+import collections
 import numpy as np
 from PIL import Image
-import safetensors.torch
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torchvision import transforms
 import torch.utils.checkpoint
 
-from accelerate import Accelerator
-from accelerate.logging import get_logger
-from accelerate.utils import set_seed
-from diffusers import AutoencoderKL, PNDMScheduler, LCMScheduler, UniPCMultistepScheduler, DPMSolverMultistepScheduler#, StableDiffusionControlNetPipeline
+# open_clip, cv2, accelerate, LoRA loading and LCMScheduler are imported where they are
+# needed (--high_level_info caption, --control_type grayscale, main, personalized models,
+# --use_lcm_lora): every batch job starts a fresh process
+from diffusers import AutoencoderKL, UniPCMultistepScheduler#, StableDiffusionControlNetPipeline
 from diffusers.utils import check_min_version
 from diffusers.utils.import_utils import is_xformers_available
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPImageProcessor
 
 from pasd.pipelines.pipeline_pasd import StableDiffusionControlNetPipeline
-from pasd.myutils.misc import load_dreambooth_lora
 from pasd.myutils.wavelet_color_fix import wavelet_color_fix
+from stage_timer import StageTimer, null_timer
+from memory_monitor import MemoryMonitor, lifetime_peak_rss_mb
+from caption_cache import CaptionCache
+from prompt_cache import PromptEmbeddingCache
+from output_cache import pixel_digest, image_digest
+import cpu_backend
+import adaptive_tiling
+import perf_profile
 #from annotator.retinaface import RetinaFaceDetection
 
 sys.path.append('PASD')
@@ -30,9 +49,8 @@ sys.path.append('PASD')
 # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
 check_min_version("0.18.0.dev0")
 
-logger = get_logger(__name__, log_level="INFO")
-
-def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_attention):
+def load_pasd_components(args, accelerator, timer=null_timer):
+    """Every pipeline component from the SD-1.5 and PASD checkpoints, cast and moved to the device"""
     if args.use_pasd_light:
         from pasd.models.pasd_light.unet_2d_condition import UNet2DConditionModel
         from pasd.models.pasd_light.controlnet import ControlNetModel
@@ -40,20 +58,26 @@ def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_atten
         from pasd.models.pasd.unet_2d_condition import UNet2DConditionModel
         from pasd.models.pasd.controlnet import ControlNetModel
     # Load scheduler, tokenizer and models.
-    if args.control_type=="grayscale":
-        scheduler = UniPCMultistepScheduler.from_pretrained("/".join(args.pasd_model_path.split("/")[:-1]), subfolder="scheduler")
-    else:
-        scheduler = UniPCMultistepScheduler.from_pretrained(args.pretrained_model_path, subfolder="scheduler")
-    text_encoder = CLIPTextModel.from_pretrained(args.pretrained_model_path, subfolder="text_encoder")
-    tokenizer = CLIPTokenizer.from_pretrained(args.pretrained_model_path, subfolder="tokenizer")
-    vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae")
+    with timer.stage("load_scheduler"):
+        if args.control_type=="grayscale":
+            scheduler = UniPCMultistepScheduler.from_pretrained("/".join(args.pasd_model_path.split("/")[:-1]), subfolder="scheduler")
+        else:
+            scheduler = UniPCMultistepScheduler.from_pretrained(args.pretrained_model_path, subfolder="scheduler")
+    with timer.stage("load_text_encoder"):
+        text_encoder = CLIPTextModel.from_pretrained(args.pretrained_model_path, subfolder="text_encoder")
+        tokenizer = CLIPTokenizer.from_pretrained(args.pretrained_model_path, subfolder="tokenizer")
+    with timer.stage("load_vae"):
+        vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae")
     feature_extractor = CLIPImageProcessor.from_pretrained(f"{args.pretrained_model_path}/feature_extractor")
-    unet = UNet2DConditionModel.from_pretrained(args.pasd_model_path, subfolder="unet")
-    controlnet = ControlNetModel.from_pretrained(args.pasd_model_path, subfolder="controlnet")
+    with timer.stage("load_unet"):
+        unet = UNet2DConditionModel.from_pretrained(args.pasd_model_path, subfolder="unet")
+    with timer.stage("load_controlnet"):
+        controlnet = ControlNetModel.from_pretrained(args.pasd_model_path, subfolder="controlnet")
 
     personalized_model_root = "checkpoints/personalized_models"
     if args.use_personalized_model and args.personalized_model_path is not None:
         if os.path.isfile(f"{personalized_model_root}/{args.personalized_model_path}"):
+            from pasd.myutils.misc import load_dreambooth_lora
             unet, vae, text_encoder = load_dreambooth_lora(unet, vae, text_encoder, f"{personalized_model_root}/{args.personalized_model_path}", 
                                                            blending_alpha=args.blending_alpha, multiplier=args.multiplier)
         else:
@@ -74,12 +98,32 @@ def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_atten
         weight_dtype = torch.bfloat16
 
     # Move text_encode and vae to gpu and cast to weight_dtype
-    text_encoder.to(accelerator.device, dtype=weight_dtype)
-    vae.to(accelerator.device, dtype=weight_dtype)
-    unet.to(accelerator.device, dtype=weight_dtype)
-    controlnet.to(accelerator.device, dtype=weight_dtype)
+    with timer.stage("to_device", sync=True):
+        text_encoder.to(accelerator.device, dtype=weight_dtype)
+        vae.to(accelerator.device, dtype=weight_dtype)
+        unet.to(accelerator.device, dtype=weight_dtype)
+        controlnet.to(accelerator.device, dtype=weight_dtype)
+
+    return {
+        "vae": vae, "text_encoder": text_encoder, "tokenizer": tokenizer, "feature_extractor": feature_extractor,
+        "unet": unet, "controlnet": controlnet, "scheduler": scheduler,
+    }
+
+def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_attention, timer=null_timer):
+    # Calibrated tile sizes and attention backend of this machine (quick_test.py --calibrate)
+    profile = perf_profile.load_profile(args.perf_profile, accelerator.device.type)
+    enable_xformers_memory_efficient_attention = perf_profile.apply_profile(args, profile, enable_xformers_memory_efficient_attention)
+    if args.model_bundle:
+        # Pre-cast, LoRA-fused weights mapped straight onto the device (see model_bundle.py)
+        from model_bundle import load_bundle
+        with timer.stage("load_bundle", sync=True):
+            components = load_bundle(args.model_bundle, accelerator.device, args)
+    else:
+        components = load_pasd_components(args, accelerator, timer)
+    unet, controlnet = components["unet"], components["controlnet"]
 
-    if enable_xformers_memory_efficient_attention:
+    # xformers is CUDA-only; on CPU the default SDPA attention processor is used
+    if enable_xformers_memory_efficient_attention and accelerator.device.type == "cuda":
         if is_xformers_available():
             try:
                 unet.enable_xformers_memory_efficient_attention()
@@ -92,21 +136,56 @@ def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_atten
 
     # Get the validation pipeline
     validation_pipeline = StableDiffusionControlNetPipeline(
-        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, feature_extractor=feature_extractor, 
-        unet=unet, controlnet=controlnet, scheduler=scheduler, safety_checker=None, requires_safety_checker=False,
+        **components, safety_checker=None, requires_safety_checker=False,
     )
     #validation_pipeline.enable_vae_tiling()
-    validation_pipeline._init_tiled_vae(encoder_tile_size=args.encoder_tiled_size, decoder_tile_size=args.decoder_tiled_size)
-
-    if args.use_lcm_lora:
-        # load and fuse lcm lora
-        validation_pipeline.load_lora_weights(args.lcm_lora_path)
-        validation_pipeline.fuse_lora()
+    # Auto (None) tile sizes are planned per call from the free memory (adaptive_tiling.py)
+    vae_tiles = (args.encoder_tiled_size or adaptive_tiling.REFERENCE_TILES["encoder_tiled_size"],
+                 args.decoder_tiled_size or adaptive_tiling.REFERENCE_TILES["decoder_tiled_size"])
+    validation_pipeline._init_tiled_vae(encoder_tile_size=vae_tiles[0], decoder_tile_size=vae_tiles[1])
+    validation_pipeline.vae_tiles = vae_tiles
+    if accelerator.device.type == "cpu" and not args.no_cpu_optimizations:
+        cpu_backend.optimize_pipeline(validation_pipeline)
+
+    if args.use_lcm_lora and not args.model_bundle:
+        from diffusers import LCMScheduler
+        if not args.onnx_dir:
+            # load and fuse lcm lora (the exported ONNX graphs already contain it)
+            validation_pipeline.load_lora_weights(args.lcm_lora_path)
+            validation_pipeline.fuse_lora()
         validation_pipeline.scheduler = LCMScheduler.from_config(validation_pipeline.scheduler.config)
 
+    if args.onnx_dir:
+        # UNet, ControlNet and VAE encoder/decoder run in onnxruntime (see onnx_backend.py)
+        from onnx_backend import load_onnx_modules
+        with timer.stage("load_onnx"):
+            load_onnx_modules(validation_pipeline, args.onnx_dir, args.onnx_int8, args.cpu_threads, args)
+
+    if args.tile_workers:
+        # Latent tiles of every step are denoised in parallel (see tile_parallel.py)
+        if args.onnx_dir:
+            raise ValueError("--tile_workers cannot be combined with --onnx_dir")
+        import tile_parallel
+        with timer.stage("tile_workers"):
+            tile_parallel.install(validation_pipeline, args.tile_workers, args.tile_window, args.cpu_threads)
+
+    if timer.detailed:
+        instrument_pipeline(validation_pipeline, timer)
+    # Outside the timing wrapper: cache hits record no text_encoding stage
+    if args.prompt_cache_size > 0:
+        PromptEmbeddingCache(args.prompt_cache_size).wrap(validation_pipeline)
+
     return validation_pipeline
 
-def load_high_level_net(args, device='cuda'):
+def instrument_pipeline(pipeline, timer):
+    """Time text encoding and the (tiled) VAE encode/decode of every pipeline call"""
+    for name in ("encode_prompt", "_encode_prompt"):
+        if hasattr(pipeline, name):
+            setattr(pipeline, name, timer.wrap(getattr(pipeline, name), "text_encoding"))
+    pipeline.vae.encode = timer.wrap(pipeline.vae.encode, "vae_encode")
+    pipeline.vae.decode = timer.wrap(pipeline.vae.decode, "vae_decode")
+
+def load_high_level_net(args, device=None):
     if args.high_level_info == "classification":
         from torchvision.models import resnet50, ResNet50_Weights
         weights = ResNet50_Weights.DEFAULT
@@ -124,7 +203,7 @@ def load_high_level_net(args, device='cuda'):
             model, vis_processors, _ = load_model_and_preprocess(name="blip_caption", model_type="base_coco", is_eval=True, device=device)
             return model, vis_processors, None
         else:
-            #import open_clip
+            import open_clip
             model, _, transform = open_clip.create_model_and_transforms(
                 model_name="coca_ViT-L-14",
                 pretrained="mscoco_finetuned_laion2B-s13B-b90k"
@@ -133,18 +212,16 @@ def load_high_level_net(args, device='cuda'):
     else:
         return None, None, None
     
-def get_validation_prompt(args, image, model, preprocess, category, device='cuda'):
+def get_validation_prompt(args, image, model, preprocess, category, device=None):
     validation_prompt = ""
+    device = device or cpu_backend.resolve_device()
 
     if args.high_level_info == "classification":
-        batch = preprocess(image).unsqueeze(0)
-        prediction = model(batch).squeeze(0).softmax(0)
-        class_id = prediction.argmax().item()
-        score = prediction[class_id].item()
-        category_name = category[class_id]
-        #print(f"{category_name}: {100 * score:.1f}%")
-        if score >= 0.1:
-            validation_prompt = f"{category_name}, " if args.prompt=="" else f"{args.prompt}, {category_name}, "
+        weight = next(model.parameters())
+        batch = preprocess(image).unsqueeze(0).to(weight.device, weight.dtype)
+        with torch.inference_mode():
+            prediction = model(batch).squeeze(0).float().softmax(0)
+        validation_prompt = classification_prompt(args, prediction, category)
     elif args.high_level_info == "detection":
         clses, confs, names = model.detect(image)
         #print(cls, conf, names)
@@ -162,23 +239,376 @@ def get_validation_prompt(args, image, model, preprocess, category, device='cuda
         if args.use_blip:
             image = preprocess["eval"](image).unsqueeze(0).to(device)
             caption = model.generate({"image": image}, num_captions=1)[0]
-            caption = caption.replace("blurry", "clear").replace("noisy", "clean") #
-            validation_prompt = caption if args.prompt=="" else f"{caption}, {args.prompt}"
+            validation_prompt = caption_prompt(args, caption)
         else:
+            import open_clip
             image = preprocess(image).unsqueeze(0)
-            with torch.no_grad(), torch.cuda.amp.autocast():
+            with torch.no_grad(), torch.autocast("cuda", enabled=torch.cuda.is_available()):
                 generated = model.generate(image)
-            caption = open_clip.decode(generated[0]).split("<end_of_text>")[0].replace("<start_of_text>", "")
-            caption = caption.replace("blurry", "clear").replace("noisy", "clean") #
-            validation_prompt = caption if args.prompt=="" else f"{caption} {args.prompt}"
+            validation_prompt = caption_prompt(args, open_clip.decode(generated[0]))
     else:
         validation_prompt = "" if args.prompt=="" else f"{args.prompt}, "
     
     return validation_prompt
 
+def classification_prompt(args, prediction, category):
+    """Prompt from one softmax row of the classifier (empty below 10% confidence)"""
+    class_id = prediction.argmax().item()
+    score = prediction[class_id].item()
+    category_name = category[class_id]
+    #print(f"{category_name}: {100 * score:.1f}%")
+    if score < 0.1:
+        return ""
+    return f"{category_name}, " if args.prompt=="" else f"{args.prompt}, {category_name}, "
+
+def caption_prompt(args, caption):
+    """Prompt from a BLIP caption or a decoded CoCa sequence"""
+    caption = caption.split("<end_of_text>")[0].replace("<start_of_text>", "")
+    caption = caption.replace("blurry", "clear").replace("noisy", "clean") #
+    if args.prompt == "":
+        return caption
+    return f"{caption}, {args.prompt}" if args.use_blip else f"{caption} {args.prompt}"
+
+def get_validation_prompts(args, images, model, preprocess, category, device=None, dtype=torch.float32):
+    """get_validation_prompt for a list of images, batched on device (model already there, in dtype)"""
+    device = device or cpu_backend.resolve_device()
+    device_type = torch.device(device).type
+    autocast = torch.autocast(device_type, dtype=dtype, enabled=dtype != torch.float32)
+    if args.high_level_info == "classification":
+        batch = torch.stack([preprocess(image) for image in images]).to(device, dtype)
+        with torch.inference_mode():
+            predictions = model(batch).float().softmax(1)
+        return [classification_prompt(args, prediction, category) for prediction in predictions]
+    if args.high_level_info == "caption":
+        if args.use_blip:
+            batch = torch.stack([preprocess["eval"](image) for image in images]).to(device)
+            with torch.inference_mode(), autocast:
+                captions = model.generate({"image": batch}, num_captions=1)
+        else:
+            import open_clip
+            batch = torch.stack([preprocess(image) for image in images]).to(device, dtype)
+            with torch.inference_mode(), autocast:
+                generated = model.generate(batch)
+            captions = [open_clip.decode(sequence) for sequence in generated]
+        return [caption_prompt(args, caption) for caption in captions]
+    # YOLO detection has no batched API
+    return [get_validation_prompt(args, image, model, preprocess, category, device) for image in images]
+
+def caption_phase(args, image_names, caption_cache, device, timer=null_timer):
+    """Two-phase mode, phase 1: prompts of every uncached image, generated in batches on the
+    accelerator at half precision and stored in caption_cache; the high-level net is freed afterwards"""
+    params = caption_params(args)
+    missing = []
+    for image_name in image_names:
+        with Image.open(image_name) as image:
+            digest = pixel_digest(image)
+        if caption_cache.get(caption_cache.make_key(digest, params)) is None:
+            missing.append((image_name, digest))
+    print(f"Phase 1: {len(image_names) - len(missing)} prompts cached, generating {len(missing)}")
+    if not missing:
+        return
+
+    dtype = torch.float32
+    if args.mixed_precision == "fp16":
+        dtype = torch.float16
+    elif args.mixed_precision == "bf16":
+        dtype = torch.bfloat16
+    with timer.stage("load_high_level_net", sync=True):
+        model, preprocess, category = load_high_level_net(args, device)
+        if args.high_level_info == "classification" or (args.high_level_info == "caption" and not args.use_blip):
+            model.to(device, dtype)
+        # BLIP is loaded on device by lavis and runs under autocast; YOLO keeps its own placement
+
+    batch_size = max(1, args.caption_batch_size)
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        images = []
+        for image_name, _ in chunk:
+            image = Image.open(image_name).convert("RGB")
+            if args.control_type == "grayscale":
+                image = image.convert("L").convert("RGB")
+            images.append(image)
+        try:
+            with timer.stage("caption_batch", sync=True, batch_size=len(chunk)):
+                prompts = get_validation_prompts(args, images, model, preprocess, category, device, dtype)
+        except Exception as e:
+            # Left uncached: phase 2 then loads the net and prompts these images itself
+            print(f"Captioning batch of {len(chunk)} failed: {e}")
+            continue
+        for (image_name, digest), prompt in zip(chunk, prompts):
+            caption_cache.put(caption_cache.make_key(digest, params), prompt, params)
+
+    del model, preprocess, category
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def caption_params(args):
+    """Everything besides the input pixels that get_validation_prompt depends on"""
+    if args.high_level_info == "classification":
+        model = "resnet50:IMAGENET1K_V2"
+    elif args.high_level_info == "detection":
+        model = "yolo"
+    elif args.use_blip:
+        model = "blip_caption:base_coco"
+    else:
+        model = "coca_ViT-L-14:mscoco_finetuned_laion2B-s13B-b90k"
+    return {"high_level_info": args.high_level_info, "model": model, "prompt": args.prompt, "control_type": args.control_type}
+
+def cached_prompt(args, caption_cache, digest, compute):
+    """compute() the validation prompt unless caption_cache already holds it for this image"""
+    if caption_cache is None or args.high_level_info is None:
+        return compute()
+    params = caption_params(args)
+    key = caption_cache.make_key(digest, params)
+    validation_prompt = caption_cache.get(key)
+    if validation_prompt is None:
+        validation_prompt = compute()
+        caption_cache.put(key, validation_prompt, params)
+    return validation_prompt
+
+def prompts_cached(args, caption_cache, image_names):
+    """True if caption_cache holds the prompt of every image, so the high-level net is not needed"""
+    if caption_cache is None or args.high_level_info is None:
+        return False
+    params = caption_params(args)
+    return all(caption_cache.get(caption_cache.make_key(image_digest(name), params)) is not None for name in image_names)
+
+def build_resize_preproc(args):
+    return transforms.Compose([
+        transforms.Resize(args.process_size, interpolation=transforms.InterpolationMode.BILINEAR),
+    ] if args.control_type=="realisr" else [
+        transforms.Resize(args.process_size, max_size=args.process_size*2, interpolation=transforms.InterpolationMode.BILINEAR),
+    ])
+
+def prepare_input(args, model, preprocess, category, resize_preproc, validation_image, device, caption_lock=None, timer=null_timer, caption_cache=None):
+    """CPU side of a job: prompt generation and the resize chain.
+
+    caption_lock serialises the high-level net when several prefetch threads share it.
+    caption_cache: optional CaptionCache answering prompts of previously seen images.
+    """
+    #validation_image = Image.new(mode='RGB', size=validation_image.size, color=(0,0,0))
+    orig_img = None
+    if caption_lock is None:
+        caption_lock = contextlib.nullcontext()
+    # Prompts are keyed by the input pixels (before the grayscale conversion)
+    digest = pixel_digest(validation_image) if caption_cache is not None else None
+    if args.control_type == "realisr":
+        with caption_lock, timer.stage("prompt"):
+            validation_prompt = cached_prompt(args, caption_cache, digest,
+                lambda: get_validation_prompt(args, validation_image, model, preprocess, category, device))
+        validation_prompt += args.added_prompt # clean, extremely detailed, best quality, sharp, clean
+        negative_prompt = args.negative_prompt #dirty, messy, low quality, frames, deformed, 
+    elif args.control_type == "grayscale":
+        validation_image = validation_image.convert("L").convert("RGB")
+        orig_img = validation_image.copy()
+        with caption_lock, timer.stage("prompt"):
+            validation_prompt = cached_prompt(args, caption_cache, digest,
+                lambda: get_validation_prompt(args, validation_image, model, preprocess, category, device))
+        validation_prompt = validation_prompt.replace("black and white", "color")
+        negative_prompt = "b&w, color bleeding"
+    else:
+        raise NotImplementedError
+    
+    print(validation_prompt)
+
+    ori_width, ori_height = validation_image.size
+    rscale = args.upscale if args.control_type=="realisr" else 1
+
+    with timer.stage("resize"):
+        validation_image = validation_image.resize((validation_image.size[0]*rscale, validation_image.size[1]*rscale))
+
+        if min(validation_image.size) < args.process_size or args.control_type=="grayscale":
+            validation_image = resize_preproc(validation_image)
+
+        validation_image = validation_image.resize((validation_image.size[0]//8*8, validation_image.size[1]//8*8))
+    #width, height = validation_image.size
+
+    return {
+        "image": validation_image,
+        "prompt": validation_prompt,
+        "negative_prompt": negative_prompt,
+        "ori_size": (ori_width, ori_height),
+        "rscale": rscale,
+        "orig_img": orig_img,
+    }
+
+def step_timing(timer):
+    """Pipeline kwargs that report every denoising step to the timer"""
+    if not timer.detailed:
+        return {}
+    timer.start_steps()
+    return {"callback": timer.step_callback, "callback_steps": 1}
+
+def tile_parallel_args(pipeline, args):
+    """With --tile_workers the tile pool, not the pipeline, tiles the latent"""
+    if getattr(pipeline, "tile_parallel", None) is None:
+        return args
+    import tile_parallel
+    return tile_parallel.prepare(pipeline, args)
+
+def denoise(args, pipeline, prepared, generator, timer=null_timer):
+    """Accelerator side of a job: the PASD pipeline call (None if it failed)
+
+    Out-of-memory errors are retried with smaller tiles, then with model CPU offload; the
+    level that succeeded is recorded in prepared["tiling"].
+    """
+    def call(call_args):
+        if generator is not None and args.seed is not None:
+            # Every attempt starts from the same noise
+            generator.manual_seed(generator.initial_seed())
+        call_args = tile_parallel_args(pipeline, call_args)
+        with timer.stage("denoise", sync=True), cpu_backend.autocast(args.device, args.mixed_precision):
+            return pipeline(
+                    call_args, prepared["prompt"], prepared["image"], num_inference_steps=args.num_inference_steps, generator=generator, #height=height, width=width,
+                    guidance_scale=args.guidance_scale, negative_prompt=prepared["negative_prompt"], conditioning_scale=args.conditioning_scale,
+                    **step_timing(timer),
+                ).images[0]
+    try:
+        image, prepared["tiling"] = adaptive_tiling.call_with_fallback(args, pipeline, prepared["image"].size, call)
+        return image
+    except Exception as e:
+        print(e)
+        return None
+
+def denoise_batch(args, pipeline, batch, generators, timer=null_timer):
+    """One pipeline call for several prepared jobs of the same size (None if it failed)
+
+    No fallback ladder here: the caller retries failed batches one image at a time.
+    """
+    try:
+        tiles = adaptive_tiling.plan_tiles(args, batch[0]["image"].size, len(batch))
+        call_args = tile_parallel_args(pipeline, adaptive_tiling.apply_tiles(args, pipeline, tiles))
+        with timer.stage("denoise", sync=True, batch_size=len(batch)), cpu_backend.autocast(args.device, args.mixed_precision):
+            images = pipeline(
+                    call_args, [prepared["prompt"] for prepared in batch], [prepared["image"] for prepared in batch],
+                    num_inference_steps=args.num_inference_steps, generator=generators,
+                    guidance_scale=args.guidance_scale, negative_prompt=[prepared["negative_prompt"] for prepared in batch],
+                    conditioning_scale=args.conditioning_scale, **step_timing(timer),
+                ).images
+        for prepared in batch:
+            prepared["tiling"] = {"fallback_level": 0, "tiles": tiles, "offload": getattr(pipeline, "cpu_offload", False)}
+        return images
+    except Exception as e:
+        print(e)
+        adaptive_tiling.release_memory()
+        return None
+
+def finish_output(args, image, prepared, timer=null_timer):
+    """CPU post-processing: color fix, resize back to the target size, grayscale recolor"""
+    resize_flag = True #
+    if args.control_type=="realisr": 
+        if True: #args.conditioning_scale < 1.0:
+            with timer.stage("wavelet_color_fix"):
+                image = wavelet_color_fix(image, prepared["image"])
+
+        if resize_flag: 
+            ori_width, ori_height = prepared["ori_size"]
+            with timer.stage("resize_output"):
+                image = image.resize((ori_width*prepared["rscale"], ori_height*prepared["rscale"]))
+
+    if args.control_type=='grayscale':
+        with timer.stage("recolor"):
+            import cv2
+            orig_img = prepared["orig_img"]
+            np_image = np.asarray(image)[:,:,::-1]
+            color_np = cv2.resize(np_image, orig_img.size)
+            orig_np = np.asarray(orig_img)
+            color_yuv = cv2.cvtColor(color_np, cv2.COLOR_BGR2YUV)
+            orig_yuv = cv2.cvtColor(orig_np, cv2.COLOR_BGR2YUV)
+            hires = np.copy(orig_yuv)
+            hires[:, :, 1:3] = color_yuv[:, :, 1:3]
+            np_image = cv2.cvtColor(hires, cv2.COLOR_YUV2BGR)
+            image = Image.fromarray(np_image[:,:,::-1])
+
+    return image
+
+def upscale_pil(args, pipeline, model, preprocess, category, resize_preproc, generator, validation_image, device, timer=null_timer, caption_cache=None):
+    """Run PASD on an RGB PIL image and return the post-processed result (None if the pipeline failed)."""
+    prepared = prepare_input(args, model, preprocess, category, resize_preproc, validation_image, device, timer=timer, caption_cache=caption_cache)
+    image = denoise(args, pipeline, prepared, generator, timer)
+    if image is None:
+        return None
+    return finish_output(args, image, prepared, timer)
+
+def load_job(args, model, preprocess, category, resize_preproc, image_name, device, caption_lock=None, timer=null_timer, caption_cache=None):
+    """Decode one image file and prepare it for denoising (runs on a prefetch thread)"""
+    start_time = time.time()
+    with timer.labels(image=image_name):
+        with timer.stage("decode"):
+            validation_image = Image.open(image_name).convert("RGB")
+        prepared = prepare_input(args, model, preprocess, category, resize_preproc, validation_image, device, caption_lock, timer, caption_cache)
+    prepared["image_path"] = image_name
+    prepared["timings"] = {"prepare": time.time() - start_time}
+    return prepared
+
+def save_job(args, image, prepared, output_path=None, timer=null_timer):
+    """Post-process and save one result (runs on a writer thread); returns the manifest record"""
+    start_time = time.time()
+    image_name = prepared["image_path"]
+    with timer.labels(image=image_name):
+        image = finish_output(args, image, prepared, timer)
+        if output_path is None:
+            name, ext = os.path.splitext(os.path.basename(image_name))
+            output_path = f'{args.output_dir}/{name}.png'
+        with timer.stage("save"):
+            image.save(output_path)
+
+        with timer.stage("hash"), open(output_path, "rb") as f:
+            output_hash = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "image_path": image_name,
+        "output_path": output_path,
+        "width": image.width,
+        "height": image.height,
+        "bytes": os.path.getsize(output_path),
+        "sha256": output_hash,
+        "batch_size": prepared.get("batch_size", 1),
+        "tiling": prepared.get("tiling"),
+        "timings": {**prepared["timings"], "save": time.time() - start_time},
+    }
+
+def prefetch(executor, fn, items, depth):
+    """Yield futures of fn(item) in order, keeping up to depth items in flight on executor"""
+    pending = collections.deque()
+    items = iter(items)
+    for item in itertools.islice(items, depth):
+        pending.append(executor.submit(fn, item))
+    while pending:
+        future = pending.popleft()
+        for item in itertools.islice(items, 1):
+            pending.append(executor.submit(fn, item))
+        yield future
+
+def write_result_manifest(path, results, **extra):
+    """Write the job manifest atomically so readers never see a partial file"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"results": results, **extra}, f, indent=2)
+    os.replace(tmp_path, path)
+
+def collect_write(write, results, failed):
+    image_name, future = write
+    try:
+        results.append(future.result())
+    except Exception as e:
+        print(f"Failed to save {image_name}: {e}")
+        failed.append(image_name)
+
 def main(args, enable_xformers_memory_efficient_attention=True,):
+    from accelerate import Accelerator
+    from accelerate.utils import set_seed
+
+    if args.profile_startup:
+        import startup_profile
+        startup_profile.report()
+
+    # --device auto picks CUDA or CPU; on CPU fp16 becomes bf16/fp32 and the thread pools are set
+    cpu = cpu_backend.setup(args)
     accelerator = Accelerator(
         mixed_precision=args.mixed_precision,
+        cpu=cpu,
     )
 
     # If passed along, set the training seed now.
@@ -194,87 +624,142 @@ def main(args, enable_xformers_memory_efficient_attention=True,):
     if accelerator.is_main_process:
         accelerator.init_trackers("PASD")
 
-    pipeline = load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_attention)
-    model, preprocess, category = load_high_level_net(args, accelerator.device)
+    # Stage timings; text encoding, VAE calls and single denoising steps are only timed
+    # (with accelerator syncs) when an output for them is requested
+    detailed = args.timings_jsonl is not None or args.timings_prometheus is not None
+    # Every stage also records its peak RSS and (on CUDA) peak accelerator memory
+    memory = MemoryMonitor(cuda=torch.cuda if torch.cuda.is_available() else None)
+    timer = StageTimer(sync=torch.cuda.synchronize if detailed and torch.cuda.is_available() else None, detailed=detailed, memory=memory)
 
-    resize_preproc = transforms.Compose([
-        transforms.Resize(args.process_size, interpolation=transforms.InterpolationMode.BILINEAR),
-    ] if args.control_type=="realisr" else [
-        transforms.Resize(args.process_size, max_size=args.process_size*2, interpolation=transforms.InterpolationMode.BILINEAR),
-    ])
-                
-    if accelerator.is_main_process:
-        generator = torch.Generator(device=accelerator.device)
+    if os.path.isdir(args.image_path):
+        image_names = sorted(glob.glob(f'{args.image_path}/*.*'))
+    else:
+        image_names = [args.image_path]
+    if args.output_name is not None and len(image_names) > 1:
+        raise ValueError("--output_name only works with a single input image")
+
+    # Every process takes every num_processes-th image of the sorted list. The seed is
+    # derived from the image's position in that list, so the output of an image does
+    # not depend on how many processes share the folder.
+    indices = range(accelerator.process_index, len(image_names), accelerator.num_processes)
+
+    caption_cache = CaptionCache(args.caption_cache) if args.caption_cache else None
+    if args.two_phase and args.high_level_info is not None:
+        # Phase 1 runs before the diffusion models are loaded; without --caption_cache the
+        # prompts only live in memory for phase 2
+        if caption_cache is None:
+            caption_cache = CaptionCache(":memory:")
+        with timer.stage("caption_phase", sync=True):
+            caption_phase(args, [image_names[index] for index in indices], caption_cache, accelerator.device, timer)
+
+    load_start = time.time()
+    with timer.stage("model_load", sync=True):
+        pipeline = load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_attention, timer)
+        with timer.stage("load_high_level_net"):
+            if prompts_cached(args, caption_cache, [image_names[index] for index in indices]):
+                print("All prompts cached, not loading the high-level net")
+                model, preprocess, category = None, None, None
+            else:
+                model, preprocess, category = load_high_level_net(args, accelerator.device)
+    model_load_time = time.time() - load_start
+    if args.profile_startup:
+        print(f"Models loaded in {model_load_time:.2f}s; per stage:")
+        for stage, total in timer.totals().items():
+            print(f"  {total['seconds']:7.3f}s  {stage}")
+
+    resize_preproc = build_resize_preproc(args)
+
+    generator = torch.Generator(device=accelerator.device)
+
+    # Streaming pipeline: prefetch threads decode, caption and resize the next images,
+    # the denoiser runs here, and writer threads color-fix, encode and save the results,
+    # so the accelerator does not wait for the CPU stages.
+    accelerator.wait_for_everyone()
+    caption_lock = threading.Lock()
+    def load(index):
+        return load_job(args, model, preprocess, category, resize_preproc, image_names[index], accelerator.device, caption_lock, timer, caption_cache)
+
+    results, failed, writes = [], [], collections.deque()
+    groups = collections.OrderedDict()  # (width, height) after the resize chain -> [(index, prepared)]
+    batch_size = max(1, args.batch_size)
+
+    def run_batch(batch):
+        """Denoise images of one size together, falling back to one call per image"""
         if args.seed is not None:
-            generator.manual_seed(args.seed)
-
-        if os.path.isdir(args.image_path):
-            image_names = sorted(glob.glob(f'{args.image_path}/*.*'))
+            generators = [torch.Generator(device=accelerator.device).manual_seed(args.seed + index) for index, _ in batch]
         else:
-            image_names = [args.image_path]
-
-        for image_name in image_names[:]:
-            validation_image = Image.open(image_name).convert("RGB")
-            #validation_image = Image.new(mode='RGB', size=validation_image.size, color=(0,0,0))
-            if args.control_type == "realisr":
-                validation_prompt = get_validation_prompt(args, validation_image, model, preprocess, category)
-                validation_prompt += args.added_prompt # clean, extremely detailed, best quality, sharp, clean
-                negative_prompt = args.negative_prompt #dirty, messy, low quality, frames, deformed, 
-            elif args.control_type == "grayscale":
-                validation_image = validation_image.convert("L").convert("RGB")
-                orig_img = validation_image.copy()
-                validation_prompt = get_validation_prompt(args, validation_image, model, preprocess, category, accelerator.device)
-                validation_prompt = validation_prompt.replace("black and white", "color")
-                negative_prompt = "b&w, color bleeding"
-            else:
-                raise NotImplementedError
-            
-            print(validation_prompt)
-
-            ori_width, ori_height = validation_image.size
-            resize_flag = False
-            rscale = args.upscale if args.control_type=="realisr" else 1
-
-            validation_image = validation_image.resize((validation_image.size[0]*rscale, validation_image.size[1]*rscale))
-
-            if min(validation_image.size) < args.process_size or args.control_type=="grayscale":
-                validation_image = resize_preproc(validation_image)
-
-            validation_image = validation_image.resize((validation_image.size[0]//8*8, validation_image.size[1]//8*8))
-            #width, height = validation_image.size
-            resize_flag = True #
-
+            generators = [generator] * len(batch)
+        start_time = time.time()
+        images = None
+        if len(batch) > 1:
+            with timer.labels(image=[image_names[index] for index, _ in batch]):
+                images = denoise_batch(args, pipeline, [prepared for _, prepared in batch], generators, timer)
+            if images is None:
+                print(f"Batch of {len(batch)} failed, retrying one image at a time")
+        if images is None:
+            images = []
+            for (index, prepared), g in zip(batch, generators):
+                with timer.labels(image=image_names[index]):
+                    images.append(denoise(args, pipeline, prepared, g, timer))
+        elapsed = (time.time() - start_time) / len(batch)
+
+        for (index, prepared), image in zip(batch, images):
+            if image is None:
+                failed.append(image_names[index])
+                continue
+            prepared["timings"]["upscale"] = elapsed
+            prepared["batch_size"] = len(batch)
+            output_path = None
+            if args.output_name is not None:
+                output_path = os.path.join(args.output_dir, args.output_name)
+            writes.append((image_names[index], writers.submit(save_job, args, image, prepared, output_path, timer)))
+        # Bound the decoded results waiting for the writers
+        while len(writes) > max(args.prefetch_depth, batch_size):
+            collect_write(writes.popleft(), results, failed)
+
+    with ThreadPoolExecutor(max(1, args.prefetch_workers)) as loaders, ThreadPoolExecutor(max(1, args.writer_workers)) as writers:
+        for index, future in zip(indices, prefetch(loaders, load, indices, max(args.prefetch_depth, batch_size))):
             try:
-                image = pipeline(
-                        args, validation_prompt, validation_image, num_inference_steps=args.num_inference_steps, generator=generator, #height=height, width=width,
-                        guidance_scale=args.guidance_scale, negative_prompt=negative_prompt, conditioning_scale=args.conditioning_scale,
-                    ).images[0]
+                prepared = future.result()
             except Exception as e:
-                print(e)
+                print(f"Failed to load {image_names[index]}: {e}")
+                failed.append(image_names[index])
                 continue
 
-            if args.control_type=="realisr": 
-                if True: #args.conditioning_scale < 1.0:
-                    image = wavelet_color_fix(image, validation_image)
-
-                if resize_flag: 
-                    image = image.resize((ori_width*rscale, ori_height*rscale))
-
-            name, ext = os.path.splitext(os.path.basename(image_name))
-            if args.control_type=='grayscale':
-                np_image = np.asarray(image)[:,:,::-1]
-                color_np = cv2.resize(np_image, orig_img.size)
-                orig_np = np.asarray(orig_img)
-                color_yuv = cv2.cvtColor(color_np, cv2.COLOR_BGR2YUV)
-                orig_yuv = cv2.cvtColor(orig_np, cv2.COLOR_BGR2YUV)
-                hires = np.copy(orig_yuv)
-                hires[:, :, 1:3] = color_yuv[:, :, 1:3]
-                np_image = cv2.cvtColor(hires, cv2.COLOR_YUV2BGR)
-                cv2.imwrite(f'{args.output_dir}/{name}.png', np_image)
-            else:
-                image.save(f'{args.output_dir}/{name}.png')
-
-if __name__ == "__main__":
+            # Images with the same final geometry share a latent shape and can be batched
+            group = groups.setdefault(prepared["image"].size, [])
+            group.append((index, prepared))
+            if len(group) >= batch_size:
+                run_batch(groups.pop(prepared["image"].size))
+            elif sum(len(g) for g in groups.values()) >= max(args.prefetch_depth, batch_size):
+                # Too many mixed sizes held back: run the largest group as it is
+                run_batch(groups.pop(max(groups, key=lambda size: len(groups[size]))))
+        for size in list(groups):
+            run_batch(groups.pop(size))
+        while writes:
+            collect_write(writes.popleft(), results, failed)
+
+    for result in results:
+        result["memory"] = timer.peaks(image=result["image_path"])
+    memory_peaks = timer.peaks()
+    cuda_peaks = [peak["peak_cuda_mb"] for peak in memory_peaks.values() if peak["peak_cuda_mb"] is not None]
+    print(f"Peak memory: RSS {lifetime_peak_rss_mb() or 0:.0f} MB" + (f", CUDA {max(cuda_peaks):.0f} MB" if cuda_peaks else ""))
+    fallbacks = collections.Counter(result["tiling"]["fallback_level"] for result in results if result.get("tiling"))
+    if any(level > 0 for level in fallbacks):
+        print("Out-of-memory fallbacks: " + ", ".join(f"level {level}: {count} images" for level, count in sorted(fallbacks.items())))
+
+    rank_suffix = f".rank{accelerator.process_index}" if accelerator.num_processes > 1 else ""
+    if args.result_manifest is not None:
+        write_result_manifest(f"{args.result_manifest}{rank_suffix}", results, failed=failed, model_load_time=model_load_time,
+                              stage_totals=timer.totals(), memory_peaks=memory_peaks,
+                              peak_rss_mb=lifetime_peak_rss_mb(), peak_cuda_mb=max(cuda_peaks) if cuda_peaks else None)
+    if args.timings_jsonl is not None:
+        timer.write_jsonl(f"{args.timings_jsonl}{rank_suffix}")
+    if args.timings_prometheus is not None:
+        timer.write_prometheus(f"{args.timings_prometheus}{rank_suffix}")
+    accelerator.wait_for_everyone()
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pretrained_model_path", type=str, default="checkpoints/stable-diffusion-v1-5", help="path of base SD model")
     parser.add_argument("--lcm_lora_path", type=str, default="checkpoints/lcm-lora-sdv1-5", help="path of LCM lora model")
@@ -288,15 +773,19 @@ if __name__ == "__main__":
     parser.add_argument("--image_path", type=str, default="examples/dog.png", help="test image path or folder")
     parser.add_argument("--output_dir", type=str, default="output", help="output folder")
     parser.add_argument("--mixed_precision", type=str, default="fp16", help="mixed precision mode") # no/fp16/bf16
+    parser.add_argument("--device", choices=["auto", "cuda", "cpu"], default="auto", help="run on CUDA if available (auto), or force a device")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="torch intra-op threads on CPU (default: all cores)")
+    parser.add_argument("--cpu_interop_threads", type=int, default=None, help="torch inter-op threads on CPU")
+    parser.add_argument("--no_cpu_optimizations", action="store_true", help="on CPU, keep the default thread settings and memory layout")
     parser.add_argument("--guidance_scale", type=float, default=9.0, help="classifier-free guidance scale")
     parser.add_argument("--conditioning_scale", type=float, default=1.0, help="conditioning scale for controlnet")
     parser.add_argument("--blending_alpha", type=float, default=1.0, help="blending alpha for personalized model")
     parser.add_argument("--multiplier", type=float, default=0.6, help="multiplier for personalized lora model")
     parser.add_argument("--num_inference_steps", type=int, default=20, help="denoising steps")
     parser.add_argument("--process_size", type=int, default=768, help="minimal input size for processing") # 512?
-    parser.add_argument("--decoder_tiled_size", type=int, default=224, help="decoder tile size for saving GPU memory") # for 24G
-    parser.add_argument("--encoder_tiled_size", type=int, default=1024, help="encoder tile size for saving GPU memory") # for 24G
-    parser.add_argument("--latent_tiled_size", type=int, default=320, help="unet latent tile size for saving GPU memory") # for 24G
+    parser.add_argument("--decoder_tiled_size", type=int, default=None, help="decoder tile size for saving GPU memory (default: from free memory, 224 for 24G)")
+    parser.add_argument("--encoder_tiled_size", type=int, default=None, help="encoder tile size for saving GPU memory (default: from free memory, 1024 for 24G)")
+    parser.add_argument("--latent_tiled_size", type=int, default=None, help="unet latent tile size for saving GPU memory (default: from free memory, 320 for 24G)")
     parser.add_argument("--latent_tiled_overlap", type=int, default=8, help="unet lantent overlap size for saving GPU memory") # for 24G
     parser.add_argument("--upscale", type=int, default=1, help="upsampling scale")
     parser.add_argument("--use_personalized_model", action="store_true", help="use personalized model or not")
@@ -307,5 +796,35 @@ if __name__ == "__main__":
     parser.add_argument("--added_noise_level", type=int, default=900, help="additional noise level")
     parser.add_argument("--offset_noise_scale", type=float, default=0.0, help="offset noise scale, not used")
     parser.add_argument("--seed", type=int, default=None, help="seed")
-    args = parser.parse_args()
+    parser.add_argument("--output_name", type=str, default=None, help="exact output file name inside output_dir (single image only)")
+    parser.add_argument("--result_manifest", type=str, default=None, help="write a JSON manifest with the exact output path, size, hash and timings of every image")
+    parser.add_argument("--prefetch_workers", type=int, default=2, help="threads decoding, captioning and resizing upcoming images")
+    parser.add_argument("--prefetch_depth", type=int, default=4, help="images prepared ahead of / waiting behind the denoiser")
+    parser.add_argument("--batch_size", type=int, default=1, help="max images of the same processed size denoised in one pipeline call")
+    parser.add_argument("--writer_workers", type=int, default=2, help="threads color-fixing and saving results")
+    parser.add_argument("--timings_jsonl", type=str, default=None, help="write one JSON line per timed stage (incl. text encoding, VAE decode and every denoising step)")
+    parser.add_argument("--timings_prometheus", type=str, default=None, help="write per-stage time totals in Prometheus text format")
+    parser.add_argument("--caption_cache", type=str, default=None, help="SQLite file caching generated prompts by image hash, high-level mode, model and prompt")
+    parser.add_argument("--prompt_cache_size", type=int, default=32, help="text-encoder outputs kept for repeated prompt/negative prompt pairs (0 disables)")
+    parser.add_argument("--model_bundle", type=str, default=None, help="load every component from a bundle written by model_bundle.py pack instead of the checkpoints")
+    parser.add_argument("--perf_profile", type=str, default=perf_profile.DEFAULT_PROFILE, help="tile sizes and attention backend from quick_test.py --calibrate, if the file exists ('' to ignore)")
+    parser.add_argument("--onnx_dir", type=str, default=None, help="run UNet, ControlNet and VAE with onnxruntime from a folder written by onnx_backend.py")
+    parser.add_argument("--onnx_int8", action="store_true", help="with --onnx_dir, use the int8 quantised graphs")
+    parser.add_argument("--tile_workers", type=str, default=None, help="denoise the latent tiles of each step in parallel on these workers, e.g. local,cuda:1 or local,cpu,cpu (see tile_parallel.py)")
+    parser.add_argument("--tile_window", type=str, default="gaussian", choices=["gaussian", "cosine"], help="blending window of the --tile_workers tiles")
+    parser.add_argument("--profile_startup", "--profile-startup", action="store_true", help="print where the time goes before the first image: imports and model loading")
+    parser.add_argument("--two_phase", action="store_true", help="prompt every image first (batched, half precision, on the accelerator), free the high-level net, then denoise")
+    parser.add_argument("--caption_batch_size", type=int, default=8, help="images per high-level net call in --two_phase mode")
+    return parser
+
+def parse_args(input_args=None):
+    parser = build_parser()
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
     main(args)
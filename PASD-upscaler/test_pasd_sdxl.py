@@ -1,11 +1,9 @@
 import os
 import sys
-import cv2
 import glob
 import argparse
 import numpy as np
 from PIL import Image
-import safetensors.torch
 
 import torch
 from torchvision import transforms
@@ -22,6 +20,7 @@ from transformers import CLIPTextModel, CLIPTokenizer, CLIPImageProcessor, AutoT
 from pasd.pipelines.pipeline_pasd_sdxl import StableDiffusionXLControlNetPipeline
 from pasd.myutils.misc import load_dreambooth_lora
 from pasd.myutils.wavelet_color_fix import wavelet_color_fix
+from prompt_cache import PromptEmbeddingCache
 #from pasd.annotator.retinaface import RetinaFaceDetection
 
 sys.path.append('PASD')
@@ -33,11 +32,11 @@ logger = get_logger(__name__, log_level="INFO")
 
 def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_attention=False):
     if args.use_pasd_light:
-        from models.pasd_light.unet_2d_condition import UNet2DConditionModel
-        from models.pasd_light.controlnet import ControlNetModel
+        from pasd.models.pasd_light.unet_2d_condition import UNet2DConditionModel
+        from pasd.models.pasd_light.controlnet import ControlNetModel
     else:
-        from models.pasd.unet_2d_condition import UNet2DConditionModel
-        from models.pasd.controlnet import ControlNetModel
+        from pasd.models.pasd.unet_2d_condition import UNet2DConditionModel
+        from pasd.models.pasd.controlnet import ControlNetModel
     # Load scheduler, tokenizer and models.
     if args.control_type=="grayscale":
         scheduler = EulerDiscreteScheduler.from_pretrained("/".join(args.pasd_model_path.split("/")[:-1]), subfolder="scheduler")
@@ -100,6 +99,9 @@ def load_pasd_pipeline(args, accelerator, enable_xformers_memory_efficient_atten
     )
     #validation_pipeline.enable_vae_tiling()
     #validation_pipeline._init_tiled_vae(encoder_tile_size=args.encoder_tiled_size, decoder_tile_size=args.decoder_tiled_size)
+    if args.prompt_cache_size > 0:
+        # Skips both text encoders for a repeated prompt/negative prompt pair
+        PromptEmbeddingCache(args.prompt_cache_size).wrap(validation_pipeline)
 
     if args.use_refiner:
         refiner_pipeline = StableDiffusionXLImg2ImgPipeline.from_pretrained(
@@ -209,79 +211,85 @@ def main(args, enable_xformers_memory_efficient_attention=False):
         transforms.Resize(args.process_size, max_size=args.process_size*2, interpolation=transforms.InterpolationMode.BILINEAR),
     ])
                 
-    if accelerator.is_main_process:
-        generator = torch.Generator(device=accelerator.device)
-        if args.seed is not None:
-            generator.manual_seed(args.seed)
+    generator = torch.Generator(device=accelerator.device)
 
-        if os.path.isdir(args.image_path):
-            image_names = sorted(glob.glob(f'{args.image_path}/*.*'))
+    if os.path.isdir(args.image_path):
+        image_names = sorted(glob.glob(f'{args.image_path}/*.*'))
+    else:
+        image_names = [args.image_path]
+
+    # Every process takes every num_processes-th image of the sorted list. The seed is
+    # derived from the image's position in that list, so the output of an image does
+    # not depend on how many processes share the folder.
+    accelerator.wait_for_everyone()
+    for n in range(accelerator.process_index, len(image_names), accelerator.num_processes):
+        image_name = image_names[n]
+        if args.seed is not None:
+            generator.manual_seed(args.seed + n)
+        validation_image = Image.open(image_name).convert("RGB")
+        #validation_image = Image.new(mode='RGB', size=validation_image.size, color=(0,0,0))
+        if args.control_type == "realisr":
+            validation_prompt = get_validation_prompt(args, validation_image, model, preprocess, category)
+            validation_prompt += args.added_prompt # clean, extremely detailed, best quality, sharp, clean
+            negative_prompt = args.negative_prompt #dirty, messy, low quality, frames, deformed, 
+        elif args.control_type == "grayscale":
+            validation_image = validation_image.convert("L").convert("RGB")
+            orig_img = validation_image.copy()
+            validation_prompt = get_validation_prompt(args, validation_image, model, preprocess, category, accelerator.device)
+            validation_prompt = validation_prompt.replace("black and white", "color")
+            negative_prompt = "b&w, color bleeding"
         else:
-            image_names = [args.image_path]
-
-        for n, image_name in enumerate(image_names[:]):
-            validation_image = Image.open(image_name).convert("RGB")
-            #validation_image = Image.new(mode='RGB', size=validation_image.size, color=(0,0,0))
-            if args.control_type == "realisr":
-                validation_prompt = get_validation_prompt(args, validation_image, model, preprocess, category)
-                validation_prompt += args.added_prompt # clean, extremely detailed, best quality, sharp, clean
-                negative_prompt = args.negative_prompt #dirty, messy, low quality, frames, deformed, 
-            elif args.control_type == "grayscale":
-                validation_image = validation_image.convert("L").convert("RGB")
-                orig_img = validation_image.copy()
-                validation_prompt = get_validation_prompt(args, validation_image, model, preprocess, category, accelerator.device)
-                validation_prompt = validation_prompt.replace("black and white", "color")
-                negative_prompt = "b&w, color bleeding"
-            else:
-                raise NotImplementedError
-            
-            print(n, image_name, validation_prompt)
-
-            ori_width, ori_height = validation_image.size
-            resize_flag = False
-            rscale = args.upscale if args.control_type=="realisr" else 1
-
-            validation_image = validation_image.resize((validation_image.size[0]*rscale, validation_image.size[1]*rscale))
-
-            if min(validation_image.size) < args.process_size or args.control_type=="grayscale":
-                validation_image = resize_preproc(validation_image)
-
-            validation_image = validation_image.resize((validation_image.size[0]//8*8, validation_image.size[1]//8*8))
-            #width, height = validation_image.size
-            resize_flag = True #
-
-            image = pipeline(
-                args, prompt=validation_prompt, image=validation_image, num_inference_steps=args.num_inference_steps, generator=generator, #height=height, width=width,
-                guidance_scale=args.guidance_scale, negative_prompt=negative_prompt, controlnet_conditioning_scale=args.conditioning_scale,
-                guess_mode=False,
-            ).images[0]
-
-            if args.use_refiner:
-                image = refiner_pipeline(validation_prompt, image=image, strength=0.1).images
-
-            if args.control_type=="realisr": 
-                if True: #args.conditioning_scale < 1.0:
-                    image = wavelet_color_fix(image, validation_image)
-
-                if resize_flag: 
-                    image = image.resize((ori_width*rscale, ori_height*rscale))
-
-            print(image.size)
-            name, ext = os.path.splitext(os.path.basename(image_name))
-            if args.control_type=='grayscale':
-                np_image = np.asarray(image)[:,:,::-1]
-                color_np = cv2.resize(np_image, orig_img.size)
-                orig_np = np.asarray(orig_img)
-                color_yuv = cv2.cvtColor(color_np, cv2.COLOR_BGR2YUV)
-                orig_yuv = cv2.cvtColor(orig_np, cv2.COLOR_BGR2YUV)
-                hires = np.copy(orig_yuv)
-                hires[:, :, 1:3] = color_yuv[:, :, 1:3]
-                np_image = cv2.cvtColor(hires, cv2.COLOR_YUV2BGR)
-                cv2.imwrite(f'{args.output_dir}/{name}.png', np_image)
-            else:
-                image.save(f'{args.output_dir}/{name}.png')
+            raise NotImplementedError
+        
+        print(n, image_name, validation_prompt)
+
+        ori_width, ori_height = validation_image.size
+        resize_flag = False
+        rscale = args.upscale if args.control_type=="realisr" else 1
+
+        validation_image = validation_image.resize((validation_image.size[0]*rscale, validation_image.size[1]*rscale))
+
+        if min(validation_image.size) < args.process_size or args.control_type=="grayscale":
+            validation_image = resize_preproc(validation_image)
+
+        validation_image = validation_image.resize((validation_image.size[0]//8*8, validation_image.size[1]//8*8))
+        #width, height = validation_image.size
+        resize_flag = True #
+
+        image = pipeline(
+            args, prompt=validation_prompt, image=validation_image, num_inference_steps=args.num_inference_steps, generator=generator, #height=height, width=width,
+            guidance_scale=args.guidance_scale, negative_prompt=negative_prompt, controlnet_conditioning_scale=args.conditioning_scale,
+            guess_mode=False,
+        ).images[0]
+
+        if args.use_refiner:
+            image = refiner_pipeline(validation_prompt, image=image, strength=0.1).images
+
+        if args.control_type=="realisr": 
+            if True: #args.conditioning_scale < 1.0:
+                image = wavelet_color_fix(image, validation_image)
+
+            if resize_flag: 
+                image = image.resize((ori_width*rscale, ori_height*rscale))
+
+        print(image.size)
+        name, ext = os.path.splitext(os.path.basename(image_name))
+        if args.control_type=='grayscale':
+            import cv2
+            np_image = np.asarray(image)[:,:,::-1]
+            color_np = cv2.resize(np_image, orig_img.size)
+            orig_np = np.asarray(orig_img)
+            color_yuv = cv2.cvtColor(color_np, cv2.COLOR_BGR2YUV)
+            orig_yuv = cv2.cvtColor(orig_np, cv2.COLOR_BGR2YUV)
+            hires = np.copy(orig_yuv)
+            hires[:, :, 1:3] = color_yuv[:, :, 1:3]
+            np_image = cv2.cvtColor(hires, cv2.COLOR_YUV2BGR)
+            cv2.imwrite(f'{args.output_dir}/{name}.png', np_image)
+        else:
+            image.save(f'{args.output_dir}/{name}.png')
+    accelerator.wait_for_everyone()
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pretrained_model_path", type=str, default="checkpoints/stable-diffusion-xl-base-1.0", help="path of base SD model")
     parser.add_argument("--pretrained_refiner_path", type=str, default="checkpoints/stable-diffusion-xl-refiner-1.0", help="path of refiner SDXL model")
@@ -312,5 +320,12 @@ if __name__ == "__main__":
     parser.add_argument("--use_blip", action="store_true", help="use blip or not")
     parser.add_argument("--use_refiner", action="store_true", help="use refiner or not")
     parser.add_argument("--seed", type=int, default=None, help="seed")
-    args = parser.parse_args()
+    parser.add_argument("--prompt_cache_size", type=int, default=32, help="text-encoder outputs kept for repeated prompt/negative prompt pairs (0 disables)")
+    return parser
+
+def parse_args(input_args=None):
+    return build_parser().parse_args(input_args)
+
+if __name__ == "__main__":
+    args = parse_args()
     main(args)
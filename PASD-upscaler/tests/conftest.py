@@ -0,0 +1,49 @@
+"""
+Shared fixtures: the tiny random-weight checkpoints of benchmarks/tiny_pasd.py and
+test_pasd.py arguments for them (CPU, fp32, no captioner, no performance profile)
+"""
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def tiny_pasd(tmp_path_factory):
+    """(pretrained_model_path, pasd_model_path) of the tiny fixture, built once per session"""
+    for module in ("torch", "diffusers", "transformers", "pasd"):
+        pytest.importorskip(module)
+    from tiny_pasd import build_tiny_pasd
+    return build_tiny_pasd(str(tmp_path_factory.mktemp("tiny_pasd")))
+
+
+@pytest.fixture(scope="session")
+def tiny_pasd_args(tiny_pasd):
+    """tiny_pasd_args(*options): test_pasd.parse_args for the tiny fixture plus options"""
+    import test_pasd
+
+    def parse(*options):
+        return test_pasd.parse_args([
+            "--pretrained_model_path", tiny_pasd[0],
+            "--pasd_model_path", tiny_pasd[1],
+            "--high_level_info",  # no value: no captioner
+            "--mixed_precision", "no",
+            "--device", "cpu",
+            "--perf_profile", "",
+            "--num_inference_steps", "1",
+            "--seed", "0",
+            *options,
+        ])
+    return parse
+
+
+@pytest.fixture(scope="session")
+def cpu_target():
+    """What load_pasd_pipeline reads from the accelerator, for the CPU in fp32"""
+    import torch
+    from types import SimpleNamespace
+    return SimpleNamespace(device=torch.device("cpu"), mixed_precision="no")
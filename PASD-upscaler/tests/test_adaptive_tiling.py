@@ -0,0 +1,98 @@
+"""
+adaptive_tiling.call_with_fallback: auto tile sizes shrink on out-of-memory, explicit ones are kept
+"""
+import weakref
+import argparse
+
+import pytest
+
+pytest.importorskip("torch")
+
+import adaptive_tiling
+
+
+@pytest.fixture(autouse=True)
+def reference_memory(monkeypatch):
+    # Plan as on the reference 24 GB GPU, whatever this machine has free
+    monkeypatch.setattr(adaptive_tiling, "free_memory_mb", lambda device: adaptive_tiling.REFERENCE_FREE_MB)
+
+
+class Pipeline:
+    """Just what apply_tiles touches; no enable_model_cpu_offload (as on the CPU)"""
+
+    def __init__(self):
+        self.vae_tiles = None
+
+    def _init_tiled_vae(self, encoder_tile_size, decoder_tile_size):
+        pass
+
+
+def run(tiles, failures):
+    """Tiles of every attempt of a call that runs out of memory failures times"""
+    args = argparse.Namespace(device="cpu", mixed_precision="fp16", onnx_dir=None, **tiles)
+    attempts = []
+
+    def call(call_args):
+        attempts.append({name: getattr(call_args, name) for name in adaptive_tiling.TILE_OPTIONS})
+        if len(attempts) <= failures:
+            raise RuntimeError("CUDA out of memory")
+        return "image"
+
+    try:
+        result, record = adaptive_tiling.call_with_fallback(args, Pipeline(), (2048, 2048), call)
+    except RuntimeError:
+        result, record = None, None
+    return attempts, result, record
+
+
+def test_explicit_tiles_are_kept():
+    explicit = {"latent_tiled_size": 320, "encoder_tiled_size": 1024, "decoder_tiled_size": 224}
+    attempts, result, _ = run(explicit, failures=1)
+    # Nothing left to shrink and no offload on the CPU: one attempt, the error is raised
+    assert attempts == [explicit] and result is None
+
+
+def test_only_auto_tiles_shrink():
+    attempts, result, record = run({"latent_tiled_size": 128, "encoder_tiled_size": None, "decoder_tiled_size": None}, failures=1)
+    assert result == "image" and record["fallback_level"] == 1
+    assert attempts == [{"latent_tiled_size": 128, "encoder_tiled_size": 1024, "decoder_tiled_size": 224},
+                        {"latent_tiled_size": 128, "encoder_tiled_size": 512, "decoder_tiled_size": 112}]
+
+
+def test_failed_call_is_released_before_the_retry():
+    # The traceback of a kept out-of-memory error would hold the failed call's frame and locals
+    class Activations:
+        pass
+
+    args = argparse.Namespace(device="cpu", mixed_precision="fp16", onnx_dir=None,
+                              latent_tiled_size=None, encoder_tiled_size=None, decoder_tiled_size=None)
+    refs = []
+
+    def call(call_args):
+        if refs:
+            assert refs[0]() is None, "the failed attempt's locals are still alive"
+            return "image"
+        activations = Activations()
+        refs.append(weakref.ref(activations))
+        raise RuntimeError("CUDA out of memory")
+
+    result, record = adaptive_tiling.call_with_fallback(args, Pipeline(), (2048, 2048), call)
+    assert result == "image" and record["fallback_level"] == 1
+
+
+def test_raised_error_has_no_stale_traceback():
+    args = argparse.Namespace(device="cpu", mixed_precision="fp16", onnx_dir=None,
+                              latent_tiled_size=320, encoder_tiled_size=1024, decoder_tiled_size=224)
+
+    def call(call_args):
+        raise RuntimeError("CUDA out of memory")
+
+    with pytest.raises(RuntimeError, match="out of memory") as raised:
+        adaptive_tiling.call_with_fallback(args, Pipeline(), (2048, 2048), call)
+    # Only the frames of the final raise, not those of call
+    frames = []
+    traceback = raised.value.__traceback__
+    while traceback is not None:
+        frames.append(traceback.tb_frame.f_code.co_name)
+        traceback = traceback.tb_next
+    assert "call" not in frames
@@ -0,0 +1,65 @@
+"""
+latent_tiler.TilePlan: exact coverage, minimum overlap, blend(split(x)) == x, parity with a
+per-tile loop, and finite fp16 / bf16 blends
+"""
+import itertools
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from latent_tiler import WINDOWS, TilePlan
+from bench_latent_tiler import HALF_TOLERANCES, blend_loop, split_loop
+
+SHAPES = [(1, 4, 64, 64), (2, 4, 100, 37), (1, 4, 257, 129), (1, 1, 8, 8)]
+PLANS = list(itertools.product(SHAPES, (16, 40, 96), (0, 4, 12), WINDOWS))
+
+
+def latents(shape, dtype=torch.float64):
+    return torch.randn(*shape, generator=torch.Generator().manual_seed(0), dtype=torch.float64).to(dtype)
+
+
+@pytest.mark.parametrize("shape,tile_size,overlap,window", PLANS)
+def test_tiles_cover_exactly_with_minimum_overlap(shape, tile_size, overlap, window):
+    height, width = shape[2:]
+    plan = TilePlan(height, width, tile_size, overlap, window)
+    for starts, length, tile in ((plan.tops, height, plan.tile_height), (plan.lefts, width, plan.tile_width)):
+        assert starts[0] == 0 and starts[-1] + tile == length
+        assert all(tile - (b - a) >= overlap for a, b in zip(starts, starts[1:]))
+    index, weights, total = plan.state("cpu")
+    assert float(total.min()) > 0
+    covered = torch.zeros(height * width, dtype=torch.float64).index_add_(0, index.flatten(), weights.flatten())
+    assert torch.allclose(covered, torch.ones_like(covered))
+
+
+@pytest.mark.parametrize("shape,tile_size,overlap,window", PLANS)
+def test_blend_inverts_split_and_matches_loop(shape, tile_size, overlap, window):
+    plan = TilePlan(shape[2], shape[3], tile_size, overlap, window)
+    x = latents(shape)
+    tiles = plan.split(x)
+    assert torch.equal(tiles, split_loop(plan, x))
+    assert torch.allclose(plan.blend(tiles), x, atol=1e-10)
+    assert torch.allclose(plan.blend(tiles * 2), blend_loop(plan, tiles * 2), atol=1e-10)
+    assert torch.allclose(plan.apply(lambda t: t * 3, x, tiles_per_call=3), x * 3, atol=1e-10)
+
+
+@pytest.mark.parametrize("dtype", list(HALF_TOLERANCES))
+@pytest.mark.parametrize("window", WINDOWS)
+def test_half_precision_blend(dtype, window):
+    # Gaussian corner weights (~1e-11) are 0 in fp16; the blend must still be finite there
+    plan = TilePlan(160, 144, 64, 8, window)
+    x = latents((2, 4, 160, 144), dtype)
+    blended = plan.blend(plan.split(x))
+    assert blended.dtype == dtype
+    assert torch.isfinite(blended).all()
+    assert torch.allclose(blended.double(), x.double(), atol=HALF_TOLERANCES[dtype])
+    # Tiles that disagree (as denoised tiles do) still blend to finite values in range
+    offsets = torch.linspace(-1, 1, len(plan), dtype=dtype).view(-1, 1, 1, 1, 1)
+    shifted = plan.blend(plan.split(x) + offsets)
+    assert torch.isfinite(shifted).all()
+    assert float((shifted.double() - x.double()).abs().max()) <= 1 + HALF_TOLERANCES[dtype]
+
+
+def test_overlap_must_be_smaller_than_tile():
+    with pytest.raises(ValueError):
+        TilePlan(100, 100, 32, 32)
@@ -0,0 +1,39 @@
+"""
+module_stand_in.stand_in: the mixin's forward wins over instance attributes of the module,
+and tile-parallel denoising does not pull in the ONNX exporter
+"""
+import os
+import sys
+import subprocess
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from module_stand_in import stand_in
+
+
+class Doubled:
+    def forward(self, x):
+        return x * 2
+
+
+def test_mixin_forward_is_not_shadowed():
+    module = torch.nn.Linear(2, 2)
+    module.scale = 3
+    # As _init_tiled_vae does on vae.encoder / vae.decoder
+    module.original_forward = module.forward
+    module.forward = lambda x: x + 100
+    replacement = stand_in(module, Doubled, tag="stand-in")
+    assert isinstance(replacement, torch.nn.Linear)
+    assert replacement.scale == 3 and replacement.tag == "stand-in"
+    assert "forward" not in vars(replacement) and "original_forward" not in vars(replacement)
+    assert not list(replacement.parameters())
+    assert torch.equal(replacement(torch.ones(2)), torch.full((2,), 2.0))
+
+
+def test_tile_parallel_does_not_import_onnx_backend():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, tile_parallel; print('onnx_backend' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=repo_dir, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "False"
@@ -0,0 +1,85 @@
+"""
+ONNX backend on the tiny random-weight checkpoints: fp32 parity of the exported UNet,
+ControlNet and VAE with PyTorch, and no PyTorch UNet/ControlNet/VAE code under --onnx_dir
+"""
+import os
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+from PIL import Image
+
+import onnx_backend
+
+TOLERANCE = 1e-3
+# Classes of the exported networks and their blocks; PyTorch-side glue such as the VAE's
+# quant convs (torch.nn) and the text encoder (transformers) may still run
+EXPORTED_CODE = ("diffusers.models", "pasd.models")
+
+
+def denoise(args, pipeline, size):
+    from test_pasd import denoise
+    prepared = {"image": Image.new("RGB", (size, size), (96, 128, 160)),
+                "prompt": f"{args.prompt}{args.added_prompt}", "negative_prompt": args.negative_prompt}
+    with torch.no_grad():
+        return denoise(args, pipeline, prepared, torch.Generator().manual_seed(0))
+
+
+@pytest.fixture(scope="module")
+def onnx_dir(tiny_pasd_args, tmp_path_factory):
+    output_dir = str(tmp_path_factory.mktemp("onnx"))
+    parity = onnx_backend.export(tiny_pasd_args(), output_dir, tolerance=TOLERANCE)
+    assert set(parity) == set(onnx_backend.TARGETS)
+    return output_dir
+
+
+def test_fp32_parity(tiny_pasd_args, cpu_target, onnx_dir):
+    from test_pasd import load_pasd_pipeline
+
+    # Calls recorded on a fresh PyTorch pipeline at another size than the export's,
+    # replayed through onnxruntime stand-ins
+    args = tiny_pasd_args("--no_cpu_optimizations")
+    pipeline = load_pasd_pipeline(args, cpu_target, False)
+    calls, handles = onnx_backend.record_calls(pipeline)
+    assert denoise(args, pipeline, 136) is not None
+    for handle in handles:
+        handle.remove()
+
+    with open(os.path.join(onnx_dir, onnx_backend.SPEC_FILE)) as f:
+        spec = json.load(f)
+    for name, entry in spec["modules"].items():
+        call_args, call_kwargs, output = calls[name]
+        owner, attr = onnx_backend.resolve(pipeline, entry["attribute"])
+        session = onnx_backend.create_session(os.path.join(onnx_dir, entry["fp32"]))
+        module = onnx_backend.ort_module(getattr(owner, attr), session, entry)
+        with torch.no_grad():
+            actual = module(*call_args, **call_kwargs)
+        expected_tensors, actual_tensors = [], []
+        onnx_backend.flatten(output, expected_tensors)
+        onnx_backend.flatten(actual, actual_tensors)
+        assert [t.shape for t in actual_tensors] == [t.shape for t in expected_tensors], name
+        diff, relative = onnx_backend.max_error(expected_tensors, actual_tensors)
+        assert relative <= TOLERANCE, f"{name}: max abs {diff:.2e}, relative {relative:.2e}"
+
+
+def test_onnx_dir_runs_no_pytorch_networks(tiny_pasd_args, cpu_target, onnx_dir):
+    from test_pasd import load_pasd_pipeline
+
+    args = tiny_pasd_args("--onnx_dir", onnx_dir)
+    pipeline = load_pasd_pipeline(args, cpu_target, False)
+    called = []
+
+    def hook(module, inputs):
+        if type(module).__module__.startswith(EXPORTED_CODE) and not isinstance(module, onnx_backend.OrtModule):
+            called.append(type(module).__name__)
+
+    handle = torch.nn.modules.module.register_module_forward_pre_hook(hook)
+    try:
+        image = denoise(args, pipeline, 136)
+    finally:
+        handle.remove()
+    assert image is not None
+    assert not called, f"PyTorch modules ran under --onnx_dir: {sorted(set(called))}"
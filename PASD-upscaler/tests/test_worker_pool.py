@@ -0,0 +1,68 @@
+"""
+WorkerPool.run with in-process stand-ins for the workers: a worker that crashes or hangs
+stops taking jobs, its job goes to the others, and the run only fails without live workers
+"""
+import threading
+
+from worker_pool import WorkerPool
+
+
+def make_pool(count):
+    return WorkerPool([f"127.0.0.1:{7870 + i}" for i in range(count)], authkey="test", names=[f"w{i}" for i in range(count)])
+
+
+def run(pool, jobs, execute, max_attempts=1):
+    events = list(pool.run(jobs, execute, max_attempts=max_attempts, retry_backoff=0.0))
+    done = {event[1]["id"]: event[2] for event in events if event[0] == "done"}
+    return events, done
+
+
+def jobs(count):
+    return [{"id": i, "cost": count - i} for i in range(count)]
+
+
+def test_crashed_worker_hands_its_jobs_to_the_others():
+    pool = make_pool(2)
+    crashed = pool.clients[0]
+    calls = []
+    lock = threading.Lock()
+
+    def execute(client, job):
+        with lock:
+            calls.append(client)
+        if client is crashed:
+            raise ConnectionRefusedError("connection refused")
+        return job["id"]
+
+    events, done = run(pool, jobs(6), execute)
+    assert sorted(done) == list(range(6)) and set(done.values()) == {"w1"}
+    assert [event[2] for event in events if event[0] == "lost"] == ["w0"]
+    # The crashed worker took one job, and that job did not use up its only attempt
+    assert calls.count(crashed) == 1
+    assert not [event for event in events if event[0] in ("failed", "retry")]
+
+
+def test_timed_out_job_uses_an_attempt_and_retires_the_worker():
+    pool = make_pool(2)
+    hung = pool.clients[0]
+
+    def execute(client, job):
+        if client is hung:
+            raise TimeoutError("no reply from the worker within 300s")
+        return job["id"]
+
+    events, done = run(pool, jobs(4), execute, max_attempts=2)
+    assert sorted(done) == list(range(4)) and set(done.values()) == {"w1"}
+    assert [event[0] for event in events if event[2] == "w0"] == ["start", "lost", "retry"]
+
+
+def test_run_fails_only_without_live_workers():
+    pool = make_pool(2)
+
+    def execute(client, job):
+        raise EOFError()
+
+    events, done = run(pool, jobs(5), execute, max_attempts=3)
+    assert not done
+    assert len([event for event in events if event[0] == "lost"]) == 2
+    assert sorted(event[1]["id"] for event in events if event[0] == "failed") == list(range(5))
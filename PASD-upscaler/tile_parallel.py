@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Tile-parallel denoising of one image across devices or worker processes
+install() replaces the pipeline's UNet and ControlNet with stand-ins. The pipeline then
+sees a single tile (prepare() lifts --latent_tiled_size for the call), so at every timestep
+it calls the ControlNet and then the UNet once on the whole latent. The ControlNet call is
+only recorded; the UNet call cuts the latent, the control image and every other spatial
+input into latent_tiler tiles and sends them round-robin to the workers. Each worker runs
+ControlNet + UNet on its tiles, and the noise predictions are merged with the tile windows
+before the scheduler step, so the workers are synchronised once per timestep.
+
+Workers (--tile_workers, comma-separated):
+    local    the pipeline's own UNet/ControlNet, on its device
+    cuda:N   a copy on GPU N, driven by a thread
+    cpu      a worker process with a CPU copy (shared memory when the pipeline runs on the CPU)
+
+The first ControlNet call runs once on one tile to learn the shape of its outputs; after
+that the pipeline gets placeholders, so it must pass the ControlNet outputs to the UNet
+unchanged (guess mode off).
+"""
+import copy
+import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.multiprocessing
+
+from latent_tiler import TilePlan
+from module_stand_in import stand_in
+
+# --latent_tiled_size the pipeline gets while the pool does the tiling
+UNTILED = 1 << 20
+
+
+class Deferred:
+    """Placeholder for the tensor at path (indices / keys) in the outputs of a recorded ControlNet call"""
+
+    def __init__(self, path):
+        self.path = path
+
+
+def defer(value, path=()):
+    """value with every tensor replaced by its Deferred placeholder"""
+    if torch.is_tensor(value):
+        return Deferred(path)
+    if hasattr(value, "to_tuple"):
+        return type(value)(**{key: defer(item, path + (key,)) for key, item in value.items()})
+    if isinstance(value, dict):
+        return {key: defer(item, path + (key,)) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(defer(item, path + (i,)) for i, item in enumerate(value))
+    return value
+
+
+def fill(value, outputs):
+    """value with every Deferred placeholder replaced by the output it stands for"""
+    if isinstance(value, Deferred):
+        for key in value.path:
+            outputs = outputs[key]
+        return outputs
+    if isinstance(value, dict):
+        return {key: fill(item, outputs) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(fill(item, outputs) for item in value)
+    return value
+
+
+def has_deferred(value):
+    if isinstance(value, Deferred):
+        return True
+    if isinstance(value, dict):
+        return any(has_deferred(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_deferred(item) for item in value)
+    return False
+
+
+def tree_map(fn, value):
+    """fn applied to every tensor of nested lists, tuples, dicts and diffusers outputs"""
+    if torch.is_tensor(value):
+        return fn(value)
+    if hasattr(value, "to_tuple"):  # diffusers BaseOutput
+        return type(value)(**{key: tree_map(fn, item) for key, item in value.items()})
+    if isinstance(value, dict):
+        return {key: tree_map(fn, item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(tree_map(fn, item) for item in value)
+    return value
+
+
+def merge(results, blend):
+    """Same-structured per-tile results -> one result, tensors merged with blend(list)"""
+    first = results[0]
+    if torch.is_tensor(first):
+        return blend(results)
+    if hasattr(first, "to_tuple"):
+        return type(first)(**{key: merge([result[key] for result in results], blend) for key in first.keys()})
+    if isinstance(first, dict):
+        return {key: merge([result[key] for result in results], blend) for key in first}
+    if isinstance(first, (list, tuple)):
+        return type(first)(merge([result[i] for result in results], blend) for i in range(len(first)))
+    return first
+
+
+def crop(tensor, top, left, height, width, latent_size):
+    """The tile of a latent-sized or pixel-sized (8x) 4-D tensor; other tensors unchanged"""
+    if tensor.dim() != 4:
+        return tensor
+    latent_height, latent_width = latent_size
+    if tuple(tensor.shape[-2:]) == (latent_height, latent_width):
+        return tensor[:, :, top:top + height, left:left + width]
+    if tuple(tensor.shape[-2:]) == (latent_height * 8, latent_width * 8):
+        return tensor[:, :, top * 8:(top + height) * 8, left * 8:(left + width) * 8]
+    return tensor
+
+
+def to_replica(value, device, dtype):
+    """Tensors moved to device; floating point ones also cast to dtype"""
+    return tree_map(lambda t: t.to(device, dtype) if t.is_floating_point() else t.to(device), value)
+
+
+def evaluate_tile(unet, controlnet, control_call, unet_call):
+    """ControlNet + UNet on one tile; the UNet call's placeholders get the ControlNet outputs"""
+    if control_call is not None:
+        unet_call = fill(unet_call, controlnet(*control_call[0], **control_call[1]))
+    args, kwargs = unet_call
+    return unet(*args, **kwargs)
+
+
+def module_dtype(module):
+    return next(module.parameters()).dtype
+
+
+def replicate(module, device, dtype):
+    """Copy of module on device in dtype, made through host memory (no second copy on the source GPU)"""
+    source = next(module.parameters()).device
+    module.to("cpu")
+    try:
+        clone = copy.deepcopy(module)
+    finally:
+        module.to(source)
+    return clone.to(device, dtype)
+
+
+class DeviceReplica:
+    """UNet + ControlNet on one device of this process"""
+
+    def __init__(self, unet, controlnet):
+        self.unet, self.controlnet = unet, controlnet
+        self.device = next(unet.parameters()).device
+        self.dtype = module_dtype(unet)
+        self.name = str(self.device)
+
+    def run(self, calls):
+        # Runs on a pool thread: grad mode and autocast are per thread
+        with torch.no_grad():
+            return [evaluate_tile(self.unet, self.controlnet, *to_replica(call, self.device, self.dtype)) for call in calls]
+
+    def close(self):
+        pass
+
+
+def serve_tiles(conn, unet, controlnet, threads):
+    """Worker process loop: lists of tile calls in, lists of results out (None stops it)"""
+    if threads:
+        torch.set_num_threads(threads)
+    dtype = module_dtype(unet)
+    with torch.no_grad():
+        while True:
+            calls = conn.recv()
+            if calls is None:
+                break
+            try:
+                conn.send([evaluate_tile(unet, controlnet, *to_replica(call, "cpu", dtype)) for call in calls])
+            except Exception as e:
+                conn.send(e)
+
+
+class ProcessReplica:
+    """UNet + ControlNet in a CPU worker process"""
+
+    def __init__(self, unet, controlnet, dtype, threads=None):
+        if next(unet.parameters()).device.type != "cpu" or module_dtype(unet) != dtype:
+            unet, controlnet = replicate(unet, "cpu", dtype), replicate(controlnet, "cpu", dtype)
+        # torch.multiprocessing passes the CPU weights through shared memory, not copies
+        context = torch.multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=serve_tiles, args=(child_conn, unet, controlnet, threads), daemon=True)
+        self.process.start()
+        self.name = f"cpu process {self.process.pid}"
+
+    def run(self, calls):
+        if not calls:
+            return []
+        self.conn.send(calls)
+        results = self.conn.recv()
+        if isinstance(results, Exception):
+            raise results
+        return results
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join(timeout=10)
+
+
+class TileParallel:
+    """Splits every UNet call into tiles, evaluates them on the replicas and merges them"""
+
+    def __init__(self, controlnet, replicas, window="gaussian"):
+        self.controlnet = controlnet
+        self.replicas = replicas
+        self.window = window
+        self.executor = ThreadPoolExecutor(len(replicas))
+        self.tile_size = 96
+        self.overlap = 8
+        self.pending_control = None
+        self.control_outputs = None
+        self.plans = {}
+
+    def plan(self, height, width):
+        key = (height, width, self.tile_size, self.overlap)
+        if key not in self.plans:
+            self.plans[key] = TilePlan(height, width, self.tile_size, self.overlap, self.window)
+        return self.plans[key]
+
+    def tile_calls(self, call):
+        """The plan for the (args, kwargs) call's sample and the call cut into its tiles"""
+        args, kwargs = call
+        sample = args[0] if args else kwargs["sample"]
+        latent_size = tuple(sample.shape[-2:])
+        plan = self.plan(*latent_size)
+        tiles = [functools.partial(crop, top=top, left=left, height=plan.tile_height, width=plan.tile_width, latent_size=latent_size)
+                 for top, left in plan.tiles]
+        return plan, [tree_map(tile, call) for tile in tiles]
+
+    def control(self, args, kwargs):
+        """Record the ControlNet call of this step; it runs per tile with the UNet"""
+        self.pending_control = (args, kwargs)
+        if self.control_outputs is None:
+            # The pipeline unpacks the outputs: learn their structure from one tile
+            tile_args, tile_kwargs = self.tile_calls((args, kwargs))[1][0]
+            with torch.no_grad():
+                self.control_outputs = defer(self.controlnet(*tile_args, **tile_kwargs))
+        return self.control_outputs
+
+    def unet(self, args, kwargs, dtype):
+        control, self.pending_control = self.pending_control, None
+        if not has_deferred(kwargs):
+            control = None  # e.g. conditioning_scale 0: the pipeline did not call the ControlNet
+        elif control is None:
+            raise RuntimeError("UNet called with ControlNet outputs but no ControlNet call was recorded")
+
+        plan, unet_calls = self.tile_calls((args, kwargs))
+        control_calls = self.tile_calls(control)[1] if control is not None else [None] * len(unet_calls)
+        calls = list(zip(control_calls, unet_calls))
+        sample = args[0] if args else kwargs["sample"]
+
+        # Replica r takes tiles r, r + R, ...; all of them finish before the scheduler step
+        count = len(self.replicas)
+        futures = [self.executor.submit(replica.run, calls[r::count]) for r, replica in enumerate(self.replicas)]
+        results = [None] * len(calls)
+        for r, future in enumerate(futures):
+            for i, result in zip(range(r, len(calls), count), future.result()):
+                results[i] = to_replica(result, sample.device, dtype)
+        return merge(results, lambda tensors: plan.blend(torch.stack(tensors)))
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+        self.executor.shutdown()
+
+
+class TiledUNet:
+    """Mixed into the UNet's class: calls go through the tile pool"""
+
+    @property
+    def device(self):
+        return self.tile_device
+
+    @property
+    def dtype(self):
+        return self.tile_dtype
+
+    def forward(self, *args, **kwargs):
+        return self.tile_parallel.unet(args, kwargs, self.tile_dtype)
+
+
+class DeferredControlNet:
+    """Mixed into the ControlNet's class: calls are recorded for the next UNet call"""
+
+    @property
+    def device(self):
+        return self.tile_device
+
+    @property
+    def dtype(self):
+        return self.tile_dtype
+
+    def forward(self, *args, **kwargs):
+        return self.tile_parallel.control(args, kwargs)
+
+
+def install(pipeline, workers, window="gaussian", cpu_threads=None):
+    """Denoise the latent tiles of every pipeline call on workers ("local,cuda:1,cpu,...")"""
+    import cpu_backend
+
+    unet, controlnet = pipeline.unet, pipeline.controlnet
+    device, dtype = next(unet.parameters()).device, module_dtype(unet)
+    # CPU workers compute in bf16 where the CPU supports it natively, else fp32
+    cpu_dtype = torch.bfloat16 if dtype != torch.float32 and cpu_backend.cpu_supports_bf16() else torch.float32
+    replicas = []
+    for worker in workers.split(","):
+        worker = worker.strip()
+        if worker == "local":
+            replicas.append(DeviceReplica(unet, controlnet))
+        elif worker.startswith("cuda"):
+            replicas.append(DeviceReplica(replicate(unet, worker, dtype), replicate(controlnet, worker, dtype)))
+        elif worker == "cpu":
+            replicas.append(ProcessReplica(unet, controlnet, cpu_dtype, cpu_threads))
+        else:
+            raise ValueError(f"unknown tile worker {worker!r} (local, cuda:N or cpu)")
+    print(f"Tile-parallel denoising on {len(replicas)} workers: {', '.join(replica.name for replica in replicas)}")
+
+    coordinator = TileParallel(controlnet, replicas, window)
+    pipeline.unet = stand_in(unet, TiledUNet, tile_parallel=coordinator, tile_device=device, tile_dtype=dtype)
+    pipeline.controlnet = stand_in(controlnet, DeferredControlNet, tile_parallel=coordinator, tile_device=device, tile_dtype=dtype)
+    pipeline.tile_parallel = coordinator
+    return coordinator
+
+
+def prepare(pipeline, args):
+    """Call arguments for pipeline: with a tile pool installed, the pool tiles the latent
+    with --latent_tiled_size / --latent_tiled_overlap and the pipeline sees one tile"""
+    coordinator = getattr(pipeline, "tile_parallel", None)
+    if coordinator is None:
+        return args
+    coordinator.tile_size = args.latent_tiled_size
+    coordinator.overlap = args.latent_tiled_overlap
+    return argparse.Namespace(**{**vars(args), "latent_tiled_size": UNTILED})
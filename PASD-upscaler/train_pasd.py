@@ -191,6 +191,75 @@ def import_model_class_from_model_name_or_path(pretrained_model_name_or_path: st
         raise ValueError(f"{model_class} is not supported.")
 
 
+def training_loss(args, batch, vae, text_encoder, unet, controlnet, noise_scheduler, weight_dtype, device):
+    """Diffusion loss (plus the PASD control-branch losses) of one training batch"""
+    pixel_values, text, input_ids, conditioning_pixel_values = batch
+    #print(pixel_values.shape, text, input_ids.shape, conditioning_pixel_values.shape)
+
+    # Convert images to latent space
+    pixel_values = pixel_values.to(device, dtype=weight_dtype, non_blocking=True)
+    latents = vae.encode(pixel_values).latent_dist.sample()
+    latents = latents * vae.config.scaling_factor
+
+    # Sample noise that we'll add to the latents
+    noise = torch.randn_like(latents)
+    bsz = latents.shape[0]
+    # Sample a random timestep for each image
+    timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
+    timesteps = timesteps.long()
+
+    # Add noise to the latents according to the noise magnitude at each timestep
+    # (this is the forward diffusion process)
+    noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+
+    # Get the text embedding for conditioning
+    encoder_hidden_states = text_encoder(input_ids.to(device))[0]
+
+    controlnet_image = conditioning_pixel_values.to(device, dtype=weight_dtype, non_blocking=True)
+    #print(pixel_values.shape, latents.shape, encoder_hidden_states.shape, controlnet_image.shape)
+
+    controlnet_cond_mid, down_block_res_samples, mid_block_res_sample = controlnet(
+        noisy_latents,
+        timesteps,
+        encoder_hidden_states=encoder_hidden_states,
+        controlnet_cond=controlnet_image,
+        return_dict=False,
+    )
+
+    # Predict the noise residual
+    model_pred = unet(
+        noisy_latents,
+        timesteps,
+        encoder_hidden_states=encoder_hidden_states,
+        down_block_additional_residuals=down_block_res_samples,
+        mid_block_additional_residual=mid_block_res_sample,
+    ).sample
+
+    # Get the target for loss depending on the prediction type
+    if noise_scheduler.config.prediction_type == "epsilon":
+        target = noise
+    elif noise_scheduler.config.prediction_type == "v_prediction":
+        target = noise_scheduler.get_velocity(latents, noise, timesteps)
+    else:
+        raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
+    
+    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean") 
+    if controlnet_cond_mid is not None:
+        if isinstance(controlnet_cond_mid, list):
+            for values in controlnet_cond_mid:
+                loss += F.l1_loss(F.interpolate(pixel_values, size=values.shape[-2:], mode='bilinear').float(), values.float(), reduction="mean")
+                if args.control_type == "grayscale":
+                    loss_colorful = sum([colorful_loss(values) for values in controlnet_cond_mid])
+                    loss += 0.001 * loss_colorful
+        else:
+            loss += F.l1_loss(pixel_values.float(), controlnet_cond_mid.float(), reduction="mean")
+            if args.control_type == "grayscale":
+                loss_colorful = colorful_loss(controlnet_cond_mid)
+                loss += 0.001 * loss_colorful
+    #print(pixel_values.min(), pixel_values.max(), controlnet_cond_mid.min(), controlnet_cond_mid.max())
+
+    return loss
+
 def parse_args(input_args=None):
     parser = argparse.ArgumentParser(description="Simple example of a ControlNet training script.")
     parser.add_argument(
@@ -900,70 +969,7 @@ def main(args):
         for step, batch in enumerate(train_dataloader):
             #with accelerator.accumulate(controlnet):
             with accelerator.accumulate(controlnet), accelerator.accumulate(unet):
-                pixel_values, text, input_ids, conditioning_pixel_values = batch
-                #print(pixel_values.shape, text, input_ids.shape, conditioning_pixel_values.shape)
-
-                # Convert images to latent space
-                pixel_values = pixel_values.to(accelerator.device, dtype=weight_dtype, non_blocking=True)
-                latents = vae.encode(pixel_values).latent_dist.sample()
-                latents = latents * vae.config.scaling_factor
-
-                # Sample noise that we'll add to the latents
-                noise = torch.randn_like(latents)
-                bsz = latents.shape[0]
-                # Sample a random timestep for each image
-                timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-                timesteps = timesteps.long()
-
-                # Add noise to the latents according to the noise magnitude at each timestep
-                # (this is the forward diffusion process)
-                noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
-
-                # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(input_ids.to(accelerator.device))[0]
-
-                controlnet_image = conditioning_pixel_values.to(accelerator.device, dtype=weight_dtype, non_blocking=True)
-                #print(pixel_values.shape, latents.shape, encoder_hidden_states.shape, controlnet_image.shape)
-
-                controlnet_cond_mid, down_block_res_samples, mid_block_res_sample = controlnet(
-                    noisy_latents,
-                    timesteps,
-                    encoder_hidden_states=encoder_hidden_states,
-                    controlnet_cond=controlnet_image,
-                    return_dict=False,
-                )
-
-                # Predict the noise residual
-                model_pred = unet(
-                    noisy_latents,
-                    timesteps,
-                    encoder_hidden_states=encoder_hidden_states,
-                    down_block_additional_residuals=down_block_res_samples,
-                    mid_block_additional_residual=mid_block_res_sample,
-                ).sample
-
-                # Get the target for loss depending on the prediction type
-                if noise_scheduler.config.prediction_type == "epsilon":
-                    target = noise
-                elif noise_scheduler.config.prediction_type == "v_prediction":
-                    target = noise_scheduler.get_velocity(latents, noise, timesteps)
-                else:
-                    raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
-                
-                loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean") 
-                if controlnet_cond_mid is not None:
-                    if isinstance(controlnet_cond_mid, list):
-                        for values in controlnet_cond_mid:
-                            loss += F.l1_loss(F.interpolate(pixel_values, size=values.shape[-2:], mode='bilinear').float(), values.float(), reduction="mean")
-                            if args.control_type == "grayscale":
-                                loss_colorful = sum([colorful_loss(values) for values in controlnet_cond_mid])
-                                loss += 0.001 * loss_colorful
-                    else:
-                        loss += F.l1_loss(pixel_values.float(), controlnet_cond_mid.float(), reduction="mean")
-                        if args.control_type == "grayscale":
-                            loss_colorful = colorful_loss(controlnet_cond_mid)
-                            loss += 0.001 * loss_colorful
-                #print(pixel_values.min(), pixel_values.max(), controlnet_cond_mid.min(), controlnet_cond_mid.max())
+                loss = training_loss(args, batch, vae, text_encoder, unet, controlnet, noise_scheduler, weight_dtype, accelerator.device)
 
                 accelerator.backward(loss)
                 if accelerator.sync_gradients:
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+PASD worker pool
+One model-resident pasd_worker.py per device (or CPU process group), fed longest-job-first
+so the expensive 8x jobs start early instead of leaving a long tail at the end of a run.
+"""
+import os
+import sys
+import time
+import heapq
+import queue
+import secrets
+import subprocess
+import threading
+
+from pasd_worker import PASDWorkerClient
+
+# Longest wait for one job, as the batch scripts' test_pasd.py subprocess timeout
+JOB_TIMEOUT = 300
+
+
+def job_cost(width, height, scale, num_inference_steps, process_size=768):
+    """Relative cost of a job: output pixels x denoising steps
+
+    Mirrors the resizing in test_pasd.upscale_pil: inputs whose upscaled short side is
+    below process_size are enlarged to it before denoising.
+    """
+    out_w, out_h = width * scale, height * scale
+    short_side = min(out_w, out_h)
+    if short_side < process_size:
+        out_w, out_h = out_w * process_size / short_side, out_h * process_size / short_side
+    return out_w * out_h * num_inference_steps
+
+
+class WorkerPool:
+    """Runs jobs on several resident workers, costliest first"""
+
+    def __init__(self, addresses, authkey=None, names=None, job_timeout=JOB_TIMEOUT):
+        self.clients = [PASDWorkerClient(address, authkey, job_timeout) for address in addresses]
+        self.names = list(names or addresses)
+        self.processes = []
+        self.utilisation = {name: {"busy": 0.0, "jobs": 0, "failed": 0} for name in self.names}
+        self.wall_time = 0.0
+
+    @classmethod
+    def launch(cls, devices, worker_args=(), base_port=7870, authkey=None, cpu_threads=None, startup_timeout=1800,
+               job_timeout=JOB_TIMEOUT):
+        """Start one pasd_worker.py per device
+
+        devices: GPU indices ("0", "1", ...) or "cpu" for a CPU worker
+        worker_args: extra test_pasd.py arguments (model paths, precision, ...)
+        cpu_threads: torch threads per CPU worker
+        authkey: shared secret of the workers (default: a random one for this pool)
+        job_timeout: seconds a worker may take for one job before it is considered hung
+        """
+        authkey = authkey or secrets.token_hex(16)
+        addresses, names, processes = [], [], []
+        for i, device in enumerate(devices):
+            env = os.environ.copy()
+            env["PASD_WORKER_AUTHKEY"] = authkey
+            args = list(worker_args)
+            if device == "cpu":
+                env["CUDA_VISIBLE_DEVICES"] = ""
+                if cpu_threads:
+                    env["OMP_NUM_THREADS"] = str(cpu_threads)
+                    env["MKL_NUM_THREADS"] = str(cpu_threads)
+                args += ["--device", "cpu", "--disable_xformers"]
+                if cpu_threads:
+                    args += ["--cpu_threads", str(cpu_threads)]
+                name = f"cpu{i}"
+            else:
+                env["CUDA_VISIBLE_DEVICES"] = str(device)
+                name = f"cuda:{device}"
+            address = f"127.0.0.1:{base_port + i}"
+            cmd = [sys.executable, "pasd_worker.py", "--address", address, *args]
+            print(f"Starting worker {name} on {address}")
+            processes.append(subprocess.Popen(cmd, env=env))
+            addresses.append(address)
+            names.append(name)
+
+        pool = cls(addresses, authkey, names, job_timeout)
+        pool.processes = processes
+        deadline = time.time() + startup_timeout
+        for name, client, process in zip(names, pool.clients, processes):
+            while not client.ping():
+                if process.poll() is not None:
+                    pool.shutdown()
+                    raise RuntimeError(f"worker {name} exited with code {process.returncode} during start-up")
+                if time.time() > deadline:
+                    pool.shutdown()
+                    raise TimeoutError(f"worker {name} did not come up within {startup_timeout}s")
+                time.sleep(2)
+            print(f"[OK] Worker {name} ready")
+        return pool
+
+    def run(self, jobs, execute, max_attempts=1, retry_backoff=30.0):
+        """Dispatch jobs (dicts with a "cost" key) longest-first and yield events
+
+        execute(client, job) runs in the worker's thread and returns the result.
+        Yields ("start", job, worker, attempt), ("done", job, worker, result, seconds),
+        ("retry", job, worker, error, delay), ("failed", job, worker, error) and
+        ("lost", job, worker, error) in the calling thread, so ledger/cache updates need no
+        locking. A worker is lost when its process exits, its connection breaks or a job
+        times out (it is hung; a process of the pool is then killed). Its thread stops and
+        the job goes back to the others, without using up an attempt unless it timed out.
+        Once no worker is left, the remaining jobs fail.
+        """
+        cond = threading.Condition()
+        ready = []  # heap of (-cost, seq, attempt, job)
+        delayed = []  # (ready_at, seq, attempt, job)
+        in_flight = [0]
+        live = [len(self.clients)]
+        events = queue.Queue()
+        for seq, job in enumerate(jobs):
+            heapq.heappush(ready, (-job["cost"], seq, 1, job))
+        seq_counter = [len(ready)]
+
+        def next_job():
+            with cond:
+                while True:
+                    now = time.time()
+                    for item in [d for d in delayed if d[0] <= now]:
+                        delayed.remove(item)
+                        _, seq, attempt, job = item
+                        heapq.heappush(ready, (-job["cost"], seq, attempt, job))
+                    if ready:
+                        _, _, attempt, job = heapq.heappop(ready)
+                        in_flight[0] += 1
+                        return attempt, job
+                    if not delayed and in_flight[0] == 0:
+                        cond.notify_all()
+                        return None
+                    timeout = min(d[0] for d in delayed) - now if delayed else None
+                    cond.wait(timeout)
+
+        def worker_loop(i, name, client):
+            stats = self.utilisation[name]
+            process = self.processes[i] if i < len(self.processes) else None
+            while True:
+                item = next_job()
+                if item is None:
+                    break
+                attempt, job = item
+                events.put(("start", job, name, attempt))
+                start = time.time()
+                lost = requeue = False
+                try:
+                    result = execute(client, job)
+                    error = None
+                except TimeoutError as e:
+                    # Hung: the job counts as an attempt, the worker gets no more jobs
+                    result, error, lost = None, str(e), True
+                    if process is not None:
+                        process.kill()
+                except (ConnectionError, EOFError, OSError) as e:
+                    result, error, lost, requeue = None, f"worker lost: {e}", True, True
+                except Exception as e:
+                    result, error = None, str(e)
+                if error is not None and not lost and process is not None and process.poll() is not None:
+                    error, lost, requeue = f"worker exited with code {process.returncode}: {error}", True, True
+                elapsed = time.time() - start
+                stats["busy"] += elapsed
+                with cond:
+                    if lost:
+                        live[0] -= 1
+                        events.put(("lost", job, name, error))
+                    if requeue:
+                        # Not the job's fault: back to the heap with the same attempt
+                        heapq.heappush(ready, (-job["cost"], seq_counter[0], attempt, job))
+                        seq_counter[0] += 1
+                    elif error is None:
+                        stats["jobs"] += 1
+                        events.put(("done", job, name, result, elapsed))
+                    elif attempt < max_attempts:
+                        delay = retry_backoff * 2 ** (attempt - 1)
+                        delayed.append((time.time() + delay, seq_counter[0], attempt + 1, job))
+                        seq_counter[0] += 1
+                        events.put(("retry", job, name, error, delay))
+                    else:
+                        stats["failed"] += 1
+                        events.put(("failed", job, name, error))
+                    if lost and live[0] == 0:
+                        # Nobody left to run the rest
+                        for item in ready + delayed:
+                            stats["failed"] += 1
+                            events.put(("failed", item[3], name, f"no live workers left ({error})"))
+                        ready.clear()
+                        delayed.clear()
+                    in_flight[0] -= 1
+                    cond.notify_all()
+                if lost:
+                    break
+            events.put(None)
+
+        run_start = time.time()
+        threads = [
+            threading.Thread(target=worker_loop, args=(i, name, client), daemon=True)
+            for i, (name, client) in enumerate(zip(self.names, self.clients))
+        ]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        while finished < len(threads):
+            event = events.get()
+            if event is None:
+                finished += 1
+            else:
+                yield event
+        self.wall_time += time.time() - run_start
+
+    def utilisation_report(self):
+        """{worker: {"busy": s, "jobs": n, "failed": n, "utilisation": fraction}}"""
+        return {
+            name: {**stats, "utilisation": stats["busy"] / self.wall_time if self.wall_time else 0.0}
+            for name, stats in self.utilisation.items()
+        }
+
+    def shutdown(self):
+        for client, process in zip(self.clients, self.processes):
+            if process.poll() is None:
+                try:
+                    client.shutdown()
+                except (ConnectionError, OSError, EOFError):
+                    pass
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()